@@ -1,12 +1,16 @@
 import os
 import logging
+import threading
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+
+logger = logging.getLogger(__name__)
 
 # SQLAlchemy setup
 class Base(DeclarativeBase):
@@ -14,29 +18,105 @@ class Base(DeclarativeBase):
 
 db = SQLAlchemy(model_class=Base)
 
-# Create Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Database configuration
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///wordpress_editor.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-
-# Initialize DB
-db.init_app(app)
-
-# Import and register routes
-from routes import register_routes
-register_routes(app)
-
-# Create tables
-with app.app_context():
-    import models
-    db.create_all()
+def add_missing_columns():
+    """Add columns and indexes introduced after a table was first created"""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(db.engine.dialect)
+                db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        db.session.commit()
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def init_schema(app):
+    """Create missing tables, columns and indexes once per process"""
+    with app.extensions['schema_lock']:
+        if app.extensions['schema_ready']:
+            return
+        with app.app_context():
+            import models
+            db.create_all()
+            add_missing_columns()
+        app.extensions['schema_ready'] = True
+        logger.info("Database schema is up to date")
+
+def create_app(config=None):
+    """Build the Flask app without touching the database
+
+    Schema setup is controlled by SCHEMA_SETUP: "lazy" (default) runs it
+    before the first request, "startup" runs it here, and "skip" leaves it
+    to `flask --app main init-db`, e.g. in a release step.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+
+    # Database configuration
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///wordpress_editor.db")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+    app.config["SCHEMA_SETUP"] = os.environ.get("SCHEMA_SETUP", "lazy")
+
+    # Background image job settings
+    app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", 2))
+    app.config["JOB_QUEUE_DEPTH"] = int(os.environ.get("JOB_QUEUE_DEPTH", 50))
+    app.config["JOB_MAX_RETRIES"] = int(os.environ.get("JOB_MAX_RETRIES", 2))
+    app.config["JOB_HEARTBEAT_SECONDS"] = int(os.environ.get("JOB_HEARTBEAT_SECONDS", 30))
+    app.config["JOB_STALE_SECONDS"] = int(os.environ.get("JOB_STALE_SECONDS", 120))
+
+    if config:
+        app.config.update(config)
+
+    # Initialize DB
+    db.init_app(app)
+    app.extensions['schema_lock'] = threading.Lock()
+    app.extensions['schema_ready'] = app.config["SCHEMA_SETUP"] == "skip"
+
+    # Request IDs, latency histograms and opt-in profiling
+    import telemetry
+    telemetry.init_app(app)
+
+    # Initialize background job queue
+    from job_queue import job_queue
+    job_queue.init_app(app)
+
+    # Import and register routes
+    from routes import register_routes
+    register_routes(app)
+
+    @app.before_request
+    def ensure_schema():
+        if not app.extensions['schema_ready']:
+            init_schema(app)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create or upgrade the database schema."""
+        app.extensions['schema_ready'] = False
+        init_schema(app)
+
+    @app.cli.command("gc-uploads")
+    def gc_uploads_command():
+        """Delete orphaned processed images, evict old ones over the disk budget and drop expired Gemini responses."""
+        from gemini_cache import gemini_cache
+        from upload_store import upload_store
+        init_schema(app)
+        upload_store.collect()
+        gemini_cache.purge_expired(force=True)
+
+    if app.config["SCHEMA_SETUP"] == "startup":
+        init_schema(app)
+
+    return app
+
+app = create_app()
 
 # Optional local run
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+"""Measure responsive WebP encoding throughput at several process pool sizes.
+
+Usage: python benchmarks/encode_throughput.py [--images 16] [--workers 1 2 4 8]
+
+Each image is a synthetic 1200x800 photo-like frame that goes through
+ImageProcessor.encode_variants, producing every responsive width. Images are
+submitted concurrently, the way the job queue does, so throughput reflects
+how well encoding spreads across cores.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import image_processor
+from image_processor import ImageProcessor
+from upload_store import UploadStore
+
+def synthetic_photo(seed, width=1200, height=800):
+    """Gradients overlaid with noise texture, which compresses roughly like a real photo"""
+    gradient = Image.linear_gradient('L').rotate(seed * 37 % 360).resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    base = Image.merge('RGB', (gradient, radial, Image.effect_noise((width, height), 40 + seed % 20)))
+    texture = Image.merge('RGB', [Image.effect_noise((width, height), 25) for _ in range(3)])
+    return Image.blend(base, texture, 0.25)
+
+def run(workers, images, upload_dir):
+    image_processor._encode_pool = None
+    os.environ['IMAGE_ENCODE_WORKERS'] = str(workers)
+    pool = image_processor.get_encode_pool()
+    if pool:
+        # Start the worker processes before timing
+        list(pool.map(abs, range(workers)))
+
+    processor = ImageProcessor()
+    processor.store = UploadStore(upload_dir)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as requests:
+        results = list(requests.map(
+            lambda item: processor.encode_variants(item[1], f"bench{item[0]:012d}"),
+            enumerate(images)))
+    elapsed = time.perf_counter() - start
+
+    if pool:
+        pool.shutdown()
+    image_processor._encode_pool = None
+
+    assert all(results), "an image failed to encode"
+    return len(images) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    images = [synthetic_photo(seed) for seed in range(args.images)]
+    print(f"{len(images)} images, widths {image_processor.VARIANT_WIDTHS}, {os.cpu_count()} CPUs")
+
+    with tempfile.TemporaryDirectory() as upload_dir:
+        baseline = None
+        for workers in args.workers:
+            rate = run(workers, images, upload_dir)
+            baseline = baseline or rate
+            print(f"workers={workers:<3} {rate:6.2f} images/sec  ({rate / baseline:.2f}x)")
+
+if __name__ == '__main__':
+    main()
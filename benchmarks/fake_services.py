@@ -0,0 +1,381 @@
+"""Local stand-ins for the external APIs, for benchmarks that must not hit the network.
+
+Each fake is a ThreadingHTTPServer bound to 127.0.0.1 on a free port and
+running on a daemon thread. The start_* helpers return the server and its
+base URL: point GEMINI_BASE_URL and PEXELS_BASE_URL at the Gemini and Pexels
+fakes, and connect to the WordPress fake as a site URL.
+
+Every fake takes latency (seconds, with +/- latency_jitter as a fraction),
+error_rate (share of requests answered with a 503) and throttle_rate (share
+answered with a 429 and Retry-After) as keyword settings.
+"""
+import gzip
+import io
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+WORD_RE = re.compile(r"[A-Za-z][A-Za-z'-]+")
+BLOCK_COMMENT_RE = re.compile(r"<!--.*?-->\n?", re.DOTALL)
+STOP_WORDS = {'the', 'and', 'for', 'with', 'your', 'how', 'what', 'why', 'from', 'into', 'that', 'this'}
+
+TOPICS = ['Choosing a Trail Running Shoe', 'Packing Light for a Weekend Hike', 'Reading Topographic Maps',
+          'Staying Warm at Camp', 'Water Filters Compared', 'Cooking on a Backpacking Stove',
+          'Hiking with Dogs', 'First Aid Essentials', 'Planning a Thru-Hike', 'Night Sky Photography']
+
+def estimate_tokens(text):
+    """Roughly four characters per token, like Gemini's English tokenisation"""
+    return max(1, len(text) // 4)
+
+def fake_query(title):
+    words = [w.lower() for w in WORD_RE.findall(title) if w.lower() not in STOP_WORDS]
+    return ' '.join((words + ['stock', 'photo', 'scene'])[:5])
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """Shared latency, failure injection and JSON helpers"""
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    latency_jitter = 0.3
+    error_rate = 0.0
+    throttle_rate = 0.0
+    retry_after = 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate(self, extra_latency=0.0):
+        """Sleep for the configured latency; answer a 503 or 429 and return False when injected"""
+        time.sleep(max(0.0, self.latency * random.uniform(1 - self.latency_jitter, 1 + self.latency_jitter))
+                   + extra_latency)
+        roll = random.random()
+        if roll < self.throttle_rate:
+            self.send_body(429, {'error': 'rate limited'}, headers={'Retry-After': self.retry_after})
+            return False
+        if roll < self.throttle_rate + self.error_rate:
+            self.send_body(503, {'error': 'unavailable'})
+            return False
+        return True
+
+class FakeGeminiHandler(FakeServiceHandler):
+    """Answers generateContent with a latency of base + per-token costs
+
+    Batched prompts (a JSON array of sections) get a JSON array back; with
+    drop_rate some entries are left out or garbled to exercise the fallback.
+    """
+    base_latency = 0.4
+    prompt_token_latency = 0.00005
+    output_token_latency = 0.004
+    drop_rate = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.read_body() or b'{}')
+        prompt = ''.join(part.get('text', '')
+                         for content in body.get('contents', [])
+                         for part in content.get('parts', []))
+        config = body.get('generationConfig') or {}
+
+        if config.get('responseMimeType') == 'application/json':
+            text = self.batched_answer(prompt)
+        else:
+            title = re.search(r'H2/H3 Title: (.*)', prompt)
+            text = fake_query(title.group(1) if title else prompt[:80])
+
+        prompt_tokens = estimate_tokens(prompt)
+        output_tokens = estimate_tokens(text)
+        if not self.simulate(self.base_latency
+                             + prompt_tokens * self.prompt_token_latency
+                             + output_tokens * self.output_token_latency):
+            return
+
+        self.send_body(200, {
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}, 'finishReason': 'STOP'}],
+            'usageMetadata': {
+                'promptTokenCount': prompt_tokens,
+                'candidatesTokenCount': output_tokens,
+                'totalTokenCount': prompt_tokens + output_tokens
+            }
+        })
+
+    def batched_answer(self, prompt):
+        match = re.search(r'^\[.*\]$', prompt, re.MULTILINE)
+        sections = json.loads(match.group(0)) if match else []
+        entries = []
+        for section in sections:
+            roll = random.random()
+            if roll < self.drop_rate / 2:
+                continue
+            if roll < self.drop_rate:
+                entries.append({'index': section['index'], 'query': ''})
+                continue
+            entries.append({'index': section['index'], 'query': fake_query(section['title'])})
+        return json.dumps(entries)
+
+class FakePexelsHandler(FakeServiceHandler):
+    """/v1/search with X-Ratelimit headers, plus the photo files its results point at
+
+    Results are deterministic per query, drawn from photo_pool distinct photos,
+    so repeated searches hit the same images the way popular queries do.
+    """
+    latency = 0.15
+    photo_pool = 500
+    photo_sizes = ((1200, 800), (1880, 1253), (940, 627))
+    hourly_limit = 20000
+    _photos = {}
+    _lock = threading.Lock()
+    _remaining = None
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path.startswith('/photos/'):
+            return self.photo(parts.path)
+        if parts.path != '/v1/search':
+            return self.send_body(404, {'error': 'not found'})
+        if not self.simulate():
+            return
+
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        per_page = int(params.get('per_page', 15))
+        page = int(params.get('page', 1))
+        seed = sum(ord(c) for c in params.get('query', '')) * 7919
+
+        photos = []
+        for position in range(per_page):
+            photo_id = (seed + (page - 1) * per_page + position) % self.photo_pool + 1
+            width, height = self.photo_sizes[photo_id % len(self.photo_sizes)]
+            src = f"{self.base_url()}/photos/{photo_id}.jpg"
+            photos.append({
+                'id': photo_id,
+                'width': width,
+                'height': height,
+                'photographer': f"Photographer {photo_id % 37}",
+                'photographer_url': f"https://www.pexels.com/@photographer-{photo_id % 37}",
+                'alt': f"{params.get('query', 'photo')} {photo_id}",
+                'src': {'large': src, 'medium': src, 'small': src}
+            })
+
+        with self._lock:
+            cls = type(self)
+            cls._remaining = self.hourly_limit if cls._remaining is None else max(0, cls._remaining - 1)
+            remaining = cls._remaining
+        self.send_body(200, {'page': page, 'per_page': per_page, 'photos': photos,
+                             'total_results': self.photo_pool},
+                       headers={'X-Ratelimit-Limit': self.hourly_limit,
+                                'X-Ratelimit-Remaining': remaining,
+                                'X-Ratelimit-Reset': int(time.time()) + 3600})
+
+    def photo(self, path):
+        photo_id = int(re.sub(r'\D', '', path) or 0)
+        width, height = self.photo_sizes[photo_id % len(self.photo_sizes)]
+        with self._lock:
+            data = self._photos.get((width, height, photo_id % 8))
+            if data is None:
+                data = self._photos[(width, height, photo_id % 8)] = synthetic_jpeg(width, height, photo_id % 8)
+        self.send_body(200, data, content_type='image/jpeg')
+
+def synthetic_jpeg(width, height, seed):
+    """Gradient and noise image encoded as JPEG; compresses roughly like a real photo"""
+    from PIL import Image
+
+    gradient = Image.linear_gradient('L').rotate(seed * 37 % 360).resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    base = Image.merge('RGB', (gradient, radial, Image.effect_noise((width, height), 40 + seed)))
+    texture = Image.merge('RGB', [Image.effect_noise((width, height), 25) for _ in range(3)])
+    buffer = io.BytesIO()
+    Image.blend(base, texture, 0.25).save(buffer, format='JPEG', quality=88)
+    return buffer.getvalue()
+
+def fake_post(post_id):
+    """A post with four to eight H2 sections and no images"""
+    count = 4 + post_id % 5
+    sections = []
+    for position in range(count):
+        topic = TOPICS[(post_id + position) % len(TOPICS)]
+        sections.append(f"<!-- wp:heading -->\n<h2 class=\"wp-block-heading\">{topic}</h2>\n<!-- /wp:heading -->\n\n"
+                        f"<!-- wp:paragraph -->\n<p>{' '.join([f'Notes on {topic.lower()} for post {post_id}.'] * 15)}</p>\n"
+                        f"<!-- /wp:paragraph -->")
+    created = datetime(2025, 1, 1) + timedelta(hours=post_id)
+    return {
+        'id': post_id,
+        'title': {'rendered': f"Trail Guide {post_id}: {TOPICS[post_id % len(TOPICS)]}"},
+        'excerpt': {'rendered': f"<p>Everything about {TOPICS[post_id % len(TOPICS)].lower()}.</p>"},
+        'content': post_content('\n\n'.join(sections)),
+        'status': 'publish' if post_id % 4 else 'draft',
+        'date': created.isoformat(),
+        'modified': created.isoformat(),
+        'link': f"https://example.com/trail-guide-{post_id}",
+        'featured_media': 0
+    }
+
+def post_content(raw):
+    """Content as the REST API returns it: raw block markup for context=edit, rendered without the comments"""
+    return {'raw': raw, 'rendered': BLOCK_COMMENT_RE.sub('', raw)}
+
+def public_view(post, params):
+    """A post as returned outside context=edit, which leaves out the raw content"""
+    if params.get('context') == 'edit':
+        return post
+    return dict(post, content={'rendered': post['content']['rendered']})
+
+class FakeWordPressHandler(FakeServiceHandler):
+    """The slice of the WP REST API the app uses: posts list/get/update and media upload/delete
+
+    With accept_gzip (1 or 0), responses advertise gzip request bodies via
+    Accept-Encoding (RFC 7694) and compressed updates are decoded; otherwise
+    compressed bodies get a 415. Media uploads of the comma-separated MIME
+    types in rejected_types fail as WordPress fails unsupported file types.
+    """
+    latency = 0.08
+    post_count = 200
+    accept_gzip = 1
+    rejected_types = ''
+    _posts = None
+    _media_ids = iter(range(1000, 10 ** 9))
+    _media = set()
+    _lock = threading.Lock()
+
+    @classmethod
+    def posts(cls):
+        with cls._lock:
+            if cls._posts is None:
+                cls._posts = {post_id: fake_post(post_id) for post_id in range(1, cls.post_count + 1)}
+            return cls._posts
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        media = re.match(r'^/wp-json/wp/v2/media/(\d+)$', parts.path)
+        if not parts.path.startswith('/wp-json/wp/v2/posts') and not media:
+            return self.send_body(404, {'code': 'rest_no_route'})
+        if not self.simulate():
+            return
+
+        if media:
+            media_id = int(media.group(1))
+            if media_id not in self._media:
+                return self.send_body(404, {'code': 'rest_post_invalid_id'})
+            return self.send_body(200, {'id': media_id})
+
+        posts = self.posts()
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        match = re.match(r'^/wp-json/wp/v2/posts/(\d+)$', parts.path)
+        if match:
+            post = posts.get(int(match.group(1)))
+            if post is None:
+                return self.send_body(404, {'code': 'rest_post_invalid_id'})
+            etag = f'"{post["id"]}-{post["modified"]}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send_body(200, public_view(post, params), headers={'ETag': etag})
+
+        statuses = params.get('status', 'publish').split(',')
+        items = [post for post in posts.values() if post['status'] in statuses]
+        if 'modified_after' in params:
+            items = [post for post in items if post['modified'] > params['modified_after']]
+        order_key = 'modified' if params.get('orderby') == 'modified' else 'date'
+        items.sort(key=lambda post: post[order_key], reverse=params.get('order', 'desc') == 'desc')
+
+        per_page = int(params.get('per_page', 10))
+        page = int(params.get('page', 1))
+        total_pages = max(1, -(-len(items) // per_page))
+        self.send_body(200, [public_view(post, params) for post in items[(page - 1) * per_page:page * per_page]],
+                       headers={'X-WP-Total': len(items), 'X-WP-TotalPages': total_pages})
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip' if self.accept_gzip else 'identity'})
+        super().send_body(status, body, content_type, headers)
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        body = self.read_body()
+        if not self.simulate():
+            return
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not self.accept_gzip:
+                return self.send_body(415, {'code': 'unsupported_encoding'})
+            body = gzip.decompress(body)
+
+        if parts.path == '/wp-json/wp/v2/media':
+            mime_type = re.search(rb'Content-Type: ([\w/.+-]+)', body)
+            if mime_type and mime_type.group(1).decode() in self.rejected_types.split(','):
+                return self.send_body(500, {'code': 'rest_upload_sideload_error',
+                                            'message': 'Sorry, you are not allowed to upload this file type.'})
+            with self._lock:
+                media_id = next(self._media_ids)
+                self._media.add(media_id)
+            # Keep the uploaded file's extension, as WordPress does
+            filename = re.search(rb'filename="[^"]*?(\.[A-Za-z0-9]+)"', body)
+            extension = filename.group(1).decode() if filename else '.webp'
+            return self.send_body(201, {'id': media_id,
+                                        'source_url': f"https://example.com/wp-content/uploads/{media_id}{extension}"})
+
+        match = re.match(r'^/wp-json/wp/v2/posts/(\d+)$', parts.path)
+        post = self.posts().get(int(match.group(1))) if match else None
+        if post is None:
+            return self.send_body(404, {'code': 'rest_post_invalid_id'})
+
+        data = json.loads(body or b'{}')
+        with self._lock:
+            if 'content' in data:
+                post['content'] = post_content(data['content'])
+            if 'status' in data:
+                post['status'] = data['status']
+            post['modified'] = datetime.utcnow().isoformat(timespec='seconds')
+        self.send_body(200, post)
+
+    def do_DELETE(self):
+        media = re.match(r'^/wp-json/wp/v2/media/(\d+)$', urlsplit(self.path).path)
+        if not media:
+            return self.send_body(404, {'code': 'rest_no_route'})
+        if not self.simulate():
+            return
+        media_id = int(media.group(1))
+        with self._lock:
+            if media_id not in self._media:
+                return self.send_body(404, {'code': 'rest_post_invalid_id'})
+            self._media.discard(media_id)
+        self.send_body(200, {'deleted': True, 'previous': {'id': media_id}})
+
+def serve(handler, settings):
+    """Start a subclass of handler with settings as class attributes"""
+    handler = type(handler.__name__.replace('Handler', ''), (handler,), dict(settings))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def start_fake_gemini(**settings):
+    """Start a fake Gemini API; settings override FakeGeminiHandler's latency and drop_rate"""
+    return serve(FakeGeminiHandler, settings)
+
+def start_fake_pexels(**settings):
+    """Start a fake Pexels API; its base URL + '/v1' is the PEXELS_BASE_URL"""
+    return serve(FakePexelsHandler, settings)
+
+def start_fake_wordpress(**settings):
+    """Start a fake WordPress site with post_count generated posts"""
+    return serve(FakeWordPressHandler, settings)
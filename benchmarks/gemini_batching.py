@@ -0,0 +1,83 @@
+"""Compare batched and per-heading Gemini search query generation against a fake Gemini API.
+
+Usage: python benchmarks/gemini_batching.py [--headings 4 8 16] [--concurrency 4] [--drop-rate 0.1]
+
+The fake server charges a fixed round-trip latency plus per-token costs and
+reports token usage, so the numbers show how much batching saves in wall time
+and in repeated prompt instructions. Per-heading mode runs with the same
+concurrency limit SuggestionService applies to Gemini.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import start_fake_gemini
+
+TOPICS = ['Choosing a Trail Running Shoe', 'Packing Light for a Weekend Hike', 'Reading Topographic Maps',
+          'Staying Warm at Camp', 'Water Filters Compared', 'Cooking on a Backpacking Stove',
+          'Hiking with Dogs', 'First Aid Essentials', 'Planning a Thru-Hike', 'Night Sky Photography']
+
+def synthetic_sections(count):
+    return [{
+        'index': index,
+        'type': 'h2',
+        'text': f"{TOPICS[index % len(TOPICS)]} ({index + 1})",
+        'content': ' '.join([f"Section {index} covers {TOPICS[index % len(TOPICS)].lower()} in detail."] * 12)
+    } for index in range(count)]
+
+def run_per_heading(client, title, sections, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda section: client.generate_image_search_query(title, section['text'], section['content']),
+            sections))
+    return sum(1 for query in results if query)
+
+def run_batched(client, title, sections, concurrency):
+    # Same shape as SuggestionService.suggest_all: one batch, then concurrent retries for the misses
+    queries = client.generate_image_search_queries(title, sections, fallback=False)
+    missed = [section for section in sections if section['index'] not in queries]
+    return len(queries) + run_per_heading(client, title, missed, concurrency)
+
+def measure(mode, run, headings, concurrency):
+    from gemini_cache import gemini_cache
+    from gemini_client import GeminiClient
+
+    gemini_cache._entries.clear()
+    client = GeminiClient()
+    sections = synthetic_sections(headings)
+
+    start = time.perf_counter()
+    answered = run(client, 'The Beginner Hiking Guide', sections, concurrency)
+    elapsed = time.perf_counter() - start
+
+    usage = client.usage
+    print(f"{mode:<12} headings={headings:<3} {elapsed:6.2f}s  calls={usage['calls']:<3} "
+          f"prompt_tokens={usage['prompt_tokens']:<6} output_tokens={usage['output_tokens']:<5} "
+          f"answered={answered}/{headings}")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--headings', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='fraction of batched entries the fake server omits or leaves blank')
+    args = parser.parse_args()
+
+    server, base_url = start_fake_gemini(drop_rate=args.drop_rate)
+    os.environ['GEMINI_BASE_URL'] = base_url
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+
+    for headings in args.headings:
+        per_heading = measure('per-heading', run_per_heading, headings, args.concurrency)
+        batched = measure('batched', run_batched, headings, args.concurrency)
+        print(f"{'':<12} batched is {per_heading / batched:.2f}x faster")
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
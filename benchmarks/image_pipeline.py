@@ -0,0 +1,293 @@
+"""Micro-benchmarks for ImageProcessor with a JSON baseline and regression gate.
+
+Usage: python benchmarks/image_pipeline.py run [--out results.json] [--repeat 3] [--samples DIR]
+       python benchmarks/image_pipeline.py compare [--baseline FILE] [--current results.json]
+                                                   [--time-threshold 0.2] [--memory-threshold 0.15]
+                                                   [--decode-memory-limit 40]
+
+Every sample is served by a local fixture HTTP server and goes through
+download_image, open_image and the per-width encode that process_image runs,
+so nothing touches the network. Synthetic samples cover RGB and RGBA PNGs, a
+palette image and JPEGs up to 24MP; --samples adds real images from a folder.
+
+Each sample runs in a fresh process so its peak RSS is measured on its own,
+both for the whole pipeline and for download_image plus open_image alone.
+compare exits with status 1 when any sample's total time or peak memory
+grows beyond the thresholds relative to the baseline (by default the file
+committed in benchmarks/baselines/), or when downloading and decoding any
+sample peaks above --decode-memory-limit MB, which makes it usable as a CI
+gate. A 24MP JPEG decoded at full size needs 72MB for its pixels alone, so
+the limit fails as soon as streaming or reduced-scale decoding stops working.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'image_pipeline.json')
+IMAGE_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+               '.gif': 'image/gif', '.webp': 'image/webp'}
+
+def synthetic_photo(width, height, seed=0):
+    """Gradients overlaid with noise texture, which compresses roughly like a real photo"""
+    gradient = Image.linear_gradient('L').rotate(seed * 37 % 360).resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    base = Image.merge('RGB', (gradient, radial, Image.effect_noise((width, height), 40 + seed % 20)))
+    texture = Image.merge('RGB', [Image.effect_noise((width, height), 25) for _ in range(3)])
+    return Image.blend(base, texture, 0.25)
+
+def encoded(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+def synthetic_samples():
+    """(name, content type, bytes) for each built-in sample"""
+    photo = synthetic_photo(1600, 1067, seed=1)
+    rgba = synthetic_photo(1400, 933, seed=2).convert('RGBA')
+    rgba.putalpha(Image.radial_gradient('L').resize(rgba.size))
+    return [
+        ('jpeg_1200x800_rgb', 'image/jpeg', encoded(synthetic_photo(1200, 800, seed=3), 'JPEG', quality=90)),
+        ('jpeg_4000x3000_rgb', 'image/jpeg', encoded(synthetic_photo(4000, 3000, seed=4), 'JPEG', quality=90)),
+        ('jpeg_6000x4000_rgb', 'image/jpeg', encoded(synthetic_photo(6000, 4000, seed=5), 'JPEG', quality=90)),
+        ('png_1600x1067_rgb', 'image/png', encoded(photo, 'PNG')),
+        ('png_1400x933_rgba', 'image/png', encoded(rgba, 'PNG')),
+        ('png_1600x1067_p', 'image/png', encoded(photo.quantize(256), 'PNG')),
+    ]
+
+def folder_samples(folder):
+    samples = []
+    for filename in sorted(os.listdir(folder)):
+        content_type = IMAGE_TYPES.get(os.path.splitext(filename)[1].lower())
+        if content_type:
+            with open(os.path.join(folder, filename), 'rb') as f:
+                samples.append((f"file_{filename}", content_type, f.read()))
+    return samples
+
+def start_fixture_server(samples):
+    """Serve each sample at /<name> from 127.0.0.1"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    files = {f"/{name}": (content_type, data) for name, content_type, data in samples}
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            content_type, data = files.get(self.path.split('?')[0], (None, None))
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def peak_rss_kb():
+    """High-water RSS of this process in KiB
+
+    VmHWM starts fresh in a spawned process, unlike ru_maxrss, which Linux
+    carries over from the parent across exec.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure_sample(url, repeat, results):
+    """Runs in a fresh process: download, decode and encode url repeat times"""
+    os.environ['IMAGE_ENCODE_WORKERS'] = '1'
+    import image_processor
+    from image_processor import ImageProcessor, encode_variant
+
+    rss_before = peak_rss_kb()
+    rss_decoded = None
+    runs = []
+    for _ in range(repeat):
+        # Fresh history each time so quality prediction starts from the same state
+        image_processor.quality_history.clear()
+        processor = ImageProcessor()
+
+        start = time.perf_counter()
+        source = processor.download_image(url)
+        downloaded = time.perf_counter()
+        with source:
+            img = processor.open_image(source)
+        decoded = time.perf_counter()
+        if rss_decoded is None:
+            # Before the first encode, the high-water mark is the download and decode alone
+            rss_decoded = peak_rss_kb()
+
+        widths = sorted({w for w in processor.variant_widths if w < img.width} | {img.width})
+        pixels = img.tobytes()
+        budgets = [int(processor.max_file_size * width / img.width) for width in widths]
+        # As in encode_variants: the widest variant picks the format the narrower ones use
+        widest = encode_variant(img.mode, img.size, pixels, widths[-1], budgets[-1])
+        formats = [widest['format']] if widest else None
+        variants = [encode_variant(img.mode, img.size, pixels, width, budget, formats)
+                    for width, budget in zip(widths[:-1], budgets[:-1])] + [widest]
+        finished = time.perf_counter()
+
+        if not all(variants):
+            raise RuntimeError(f"{url} failed to encode within budget")
+        attempts = [seconds for variant in variants for _, seconds in variant['encode_seconds']]
+        runs.append({
+            'download_seconds': downloaded - start,
+            'decode_seconds': decoded - downloaded,
+            'encode_seconds': finished - decoded,
+            'total_seconds': finished - start,
+            'seconds_per_encode': statistics.mean(attempts),
+            'encodes': len(attempts),
+            'bytes_out': sum(variant['size'] for variant in variants),
+            'widths': widths
+        })
+
+    rss_after = peak_rss_kb()
+    summary = {key: round(statistics.median(run[key] for run in runs), 5)
+               for key in ('download_seconds', 'decode_seconds', 'encode_seconds',
+                           'total_seconds', 'seconds_per_encode')}
+    summary.update({
+        'encodes': runs[-1]['encodes'],
+        'bytes_out': runs[-1]['bytes_out'],
+        'widths': runs[-1]['widths'],
+        # Growth over the interpreter with its imports loaded is the pipeline's peak
+        'peak_memory_mb': round(max(0, rss_after - rss_before) / 1024, 1),
+        'decode_peak_memory_mb': round(max(0, rss_decoded - rss_before) / 1024, 1),
+        'images_per_second': round(1 / statistics.median(run['total_seconds'] for run in runs), 3)
+    })
+    results.put(summary)
+
+def run(args):
+    samples = synthetic_samples()
+    if args.samples:
+        samples += folder_samples(args.samples)
+    server, base_url = start_fixture_server(samples)
+    context = multiprocessing.get_context('spawn')
+
+    results = {}
+    try:
+        for name, content_type, data in samples:
+            queue = context.Queue()
+            process = context.Process(target=measure_sample, args=(f"{base_url}/{name}", args.repeat, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0 or queue.empty():
+                raise SystemExit(f"{name}: benchmark process failed")
+            results[name] = dict(queue.get(), bytes_in=len(data))
+            sample = results[name]
+            print(f"{name:<22} {sample['total_seconds'] * 1000:8.1f}ms total  "
+                  f"decode {sample['decode_seconds'] * 1000:7.1f}ms  "
+                  f"encode {sample['encode_seconds'] * 1000:7.1f}ms ({sample['encodes']} encodes, "
+                  f"{sample['seconds_per_encode'] * 1000:.1f}ms each)  "
+                  f"{sample['bytes_out'] // 1024:4d}KB out  {sample['peak_memory_mb']:6.1f}MB peak "
+                  f"({sample['decode_peak_memory_mb']:.1f}MB decoding)")
+    finally:
+        server.shutdown()
+
+    report = {
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count(), 'pillow': Image.__version__},
+        'repeat': args.repeat,
+        'samples': results
+    }
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Wrote {args.out}")
+    return report
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        current = run(argparse.Namespace(out=None, repeat=baseline.get('repeat', 3), samples=None))
+
+    failures = []
+    for name, after in sorted(current['samples'].items()):
+        decode_memory = after.get('decode_peak_memory_mb', 0)
+        if decode_memory > args.decode_memory_limit:
+            print(f"{name:<22} download and decode peaked at {decode_memory}MB, "
+                  f"over the {args.decode_memory_limit}MB limit  DECODE MEMORY")
+            failures.append(name)
+
+    for name, before in sorted(baseline['samples'].items()):
+        after = current['samples'].get(name)
+        if after is None:
+            print(f"{name:<22} missing from current results")
+            continue
+
+        time_change = after['total_seconds'] / before['total_seconds'] - 1
+        # Ignore memory noise under a few MB, where RSS granularity dominates
+        memory_change = ((after['peak_memory_mb'] - before['peak_memory_mb']) / before['peak_memory_mb']
+                         if before['peak_memory_mb'] >= 5 else 0.0)
+        flags = []
+        if time_change > args.time_threshold:
+            flags.append('SLOWER')
+        if memory_change > args.memory_threshold:
+            flags.append('MORE MEMORY')
+        print(f"{name:<22} time {time_change:+7.1%}  memory {memory_change:+7.1%}  "
+              f"encodes {before['encodes']}->{after['encodes']}  "
+              f"bytes {before['bytes_out']}->{after['bytes_out']}  {' '.join(flags)}")
+        if flags and name not in failures:
+            failures.append(name)
+
+    if failures:
+        print(f"Regression in {len(failures)} sample(s): {', '.join(failures)}")
+        return 1
+    print("No regressions")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='measure every sample')
+    run_parser.add_argument('--out', help='write results as JSON (use the baseline path to refresh it)')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--samples', help='folder of extra images to include')
+
+    compare_parser = commands.add_parser('compare', help='fail when results regress against a baseline')
+    compare_parser.add_argument('--baseline', default=BASELINE)
+    compare_parser.add_argument('--current', help='results from run --out; measured now when omitted')
+    compare_parser.add_argument('--time-threshold', type=float, default=0.2)
+    compare_parser.add_argument('--memory-threshold', type=float, default=0.15)
+    compare_parser.add_argument('--decode-memory-limit', type=float, default=40,
+                                help='MB that downloading and decoding any one sample may peak at')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""Replay editor sessions against the app under gunicorn, with every external API faked locally.
+
+Usage: python benchmarks/load_test.py [--workers 1 2 4] [--users 1 2 4 8 16] [--duration 30]
+       python benchmarks/load_test.py --app-url http://127.0.0.1:5000 --wp-url http://... [--users ...]
+
+For each gunicorn worker count the app is started against fresh fake
+WordPress, Pexels and Gemini services (benchmarks/fake_services.py) and a
+temporary SQLite database. Virtual editors then loop through a session:
+list posts, open a post, suggest images for each heading, process a couple
+of the suggestions, and save. Load steps up through --users; each step
+reports p50/p95/p99 latency per route, and the run reports the step where
+throughput stopped growing or latency took off: the saturation point.
+
+Fake latency, error and 429 rates are set with --wp, --pexels and --gemini,
+e.g. --gemini latency=0.8 throttle_rate=0.05.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from fake_services import start_fake_gemini, start_fake_pexels, start_fake_wordpress
+from post_sections import index_sections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The post and its headings as the edit page hands them to the editor script
+PAGE_DATA_RE = re.compile(r'^let (postData|headingsData) = (.*);$', re.MULTILINE)
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+class Recorder:
+    """Latencies and failures per route for one load step"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.sessions = 0
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.failures[route] += 1
+
+    def session_done(self):
+        with self._lock:
+            self.sessions += 1
+
+class EditorSession:
+    """One virtual editor with its own cookie jar"""
+
+    def __init__(self, app_url, wp_url, recorder, think, post_count, images_per_post=2):
+        self.app_url = app_url.rstrip('/')
+        self.wp_url = wp_url
+        self.recorder = recorder
+        self.think = think
+        self.post_count = post_count
+        self.images_per_post = images_per_post
+        self.http = requests.Session()
+
+    def call(self, route, method, path, expect=(200,), **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, f"{self.app_url}{path}", timeout=120, **kwargs)
+            ok = response.status_code in expect
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(route, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    def pause(self):
+        if self.think:
+            time.sleep(random.expovariate(1 / self.think))
+
+    def connect(self):
+        response = self.call('connect', 'POST', '/connect', data={
+            'site_url': self.wp_url, 'username': 'editor', 'app_password': 'xxxx xxxx xxxx'
+        }, allow_redirects=False, expect=(302,))
+        return response is not None and '/posts' in response.headers.get('Location', '')
+
+    def run_once(self):
+        self.call('posts', 'GET', f"/posts?page={random.randint(1, 3)}")
+        self.pause()
+
+        post_id = random.randint(1, self.post_count)
+        page = self.call('edit', 'GET', f"/edit/{post_id}")
+        if page is None:
+            return
+        data = {name: json.loads(value) for name, value in PAGE_DATA_RE.findall(page.text)}
+        post = data['postData']
+        self.pause()
+
+        picks = []
+        for index in range(len(data['headingsData'])):
+            response = self.call('suggest', 'GET', f"/api/suggest-images/{post_id}/{index}")
+            if response is not None and response.json().get('images'):
+                picks.append((index, response.json()['images'][0]))
+            self.pause()
+
+        # Insert each figure after its heading, as the editor does, last heading first
+        content = post['content']
+        sections = index_sections(content).sections
+        inserts = []
+        for index, image in picks[:self.images_per_post]:
+            result = self.process(image)
+            if result:
+                inserts.append((sections[index]['offset'],
+                                f'<figure class="wp-block-image"><img src="{result["processed_url"]}" '
+                                f'srcset="{result["srcset"]}" sizes="{result["sizes"]}" alt=""></figure>'))
+            self.pause()
+        for offset, figure in sorted(inserts, reverse=True):
+            content = content[:offset] + figure + content[offset:]
+
+        self.call('save', 'POST', '/api/save-post', json={
+            'post_id': post_id, 'base_modified': post['modified'], 'content': content
+        })
+        self.recorder.session_done()
+
+    def process(self, image):
+        start = time.perf_counter()
+        response = self.call('process_image', 'POST', '/api/process-image', expect=(202,), json={
+            'image_url': image['url'], 'author': image['photographer'], 'alt_text': image['alt']
+        })
+        if response is None:
+            self.recorder.record('image_job', time.perf_counter() - start, False)
+            return None
+
+        job = response.json()
+        while True:
+            status = self.call('job_status', 'GET', job['status_url'])
+            if status is None or status.json()['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.5)
+        result = self.call('job_result', 'GET', job['result_url'])
+        self.recorder.record('image_job', time.perf_counter() - start, result is not None)
+        return result.json() if result is not None else None
+
+def run_step(args, app_url, wp_url, users):
+    """Run users concurrent editors for args.duration seconds"""
+    recorder = Recorder()
+    stop = time.monotonic() + args.duration
+
+    def editor():
+        session = EditorSession(app_url, wp_url, recorder, args.think, args.posts)
+        if not session.connect():
+            return
+        while time.monotonic() < stop:
+            session.run_once()
+
+    threads = [threading.Thread(target=editor, daemon=True) for _ in range(users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    requests_done = sum(len(values) for route, values in recorder.latencies.items() if route != 'image_job')
+    return {
+        'users': users,
+        'elapsed': elapsed,
+        'sessions': recorder.sessions,
+        'throughput': requests_done / elapsed,
+        'routes': {route: {
+            'count': len(values),
+            'failures': recorder.failures[route],
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99)
+        } for route, values in sorted(recorder.latencies.items())}
+    }
+
+def print_step(step):
+    print(f"\n  {step['users']} editors: {step['throughput']:.1f} req/s, {step['sessions']} sessions "
+          f"in {step['elapsed']:.0f}s")
+    print(f"    {'route':<14}{'count':>7}{'fail':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in step['routes'].items():
+        print(f"    {route:<14}{stats['count']:>7}{stats['failures']:>6}"
+              f"{stats['p50'] * 1000:>10.0f}{stats['p95'] * 1000:>10.0f}{stats['p99'] * 1000:>10.0f}")
+
+def interactive_p95(step):
+    """Worst p95 among the routes an editor waits on directly"""
+    return max((stats['p95'] for route, stats in step['routes'].items()
+                if route in ('posts', 'edit', 'suggest', 'save')), default=0)
+
+def saturation_point(steps, min_gain=0.1, latency_factor=3.0):
+    """First step where throughput grew by less than min_gain, or interactive p95 passed
+    latency_factor times the lightest step's; returns the last healthy step"""
+    baseline_p95 = interactive_p95(steps[0]) or 1e-9
+    for previous, step in zip(steps, steps[1:]):
+        gain = step['throughput'] / previous['throughput'] - 1 if previous['throughput'] else 0
+        if gain < min_gain or interactive_p95(step) > baseline_p95 * latency_factor:
+            return previous
+    return None
+
+def start_app(args, workers, fakes, workdir):
+    port = args.port
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'load.db')}",
+               GEMINI_BASE_URL=fakes['gemini'],
+               GEMINI_API_KEY='load-test',
+               PEXELS_BASE_URL=f"{fakes['pexels']}/v1",
+               PEXELS_API_KEY='load-test',
+               # The fakes have no request quota; Pexels' comes from its X-Ratelimit headers
+               GEMINI_REQUESTS_PER_MINUTE='0',
+               WP_REQUESTS_PER_MINUTE='0',
+               PYTHONPATH=ROOT)
+    # Run from a scratch directory so processed images do not land in the repo
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f"127.0.0.1:{port}",
+         '--timeout', '120', '--log-level', 'warning', *args.gunicorn_args, 'main:app'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=None if args.app_logs else subprocess.DEVNULL)
+
+    app_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn exited with status {process.returncode}")
+        try:
+            if requests.get(app_url, timeout=2).status_code == 200:
+                return process, app_url
+        except requests.RequestException:
+            time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("gunicorn did not start within 60s")
+
+def parse_settings(values):
+    settings = {}
+    for value in values or []:
+        name, _, number = value.partition('=')
+        settings[name] = float(number)
+    return settings
+
+def report(label, steps):
+    point = saturation_point(steps)
+    if point is None:
+        print(f"\n{label}: no saturation up to {steps[-1]['users']} editors "
+              f"({steps[-1]['throughput']:.1f} req/s)")
+    else:
+        print(f"\n{label}: saturates at about {point['users']} concurrent editors "
+              f"({point['throughput']:.1f} req/s, interactive p95 {interactive_p95(point) * 1000:.0f}ms)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='gunicorn worker counts')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='concurrent editors per step')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per load step')
+    parser.add_argument('--think', type=float, default=0.5, help='mean editor pause between actions')
+    parser.add_argument('--posts', type=int, default=200, help='posts on the fake site')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--wp', nargs='*', metavar='NAME=VALUE', help='fake WordPress settings')
+    parser.add_argument('--pexels', nargs='*', metavar='NAME=VALUE', help='fake Pexels settings')
+    parser.add_argument('--gemini', nargs='*', metavar='NAME=VALUE', help='fake Gemini settings')
+    parser.add_argument('--app-url', help='load an already running app instead of starting gunicorn')
+    parser.add_argument('--wp-url', help='WordPress site the running app should connect to (with --app-url)')
+    parser.add_argument('--gunicorn-args', nargs=argparse.REMAINDER, default=[],
+                        help='extra gunicorn arguments, e.g. --threads 4')
+    parser.add_argument('--app-logs', action='store_true', help='show the app\'s log output')
+    args = parser.parse_args()
+
+    wp_server, wp_url = start_fake_wordpress(post_count=args.posts, **parse_settings(args.wp))
+    pexels_server, pexels_url = start_fake_pexels(**parse_settings(args.pexels))
+    gemini_server, gemini_url = start_fake_gemini(**parse_settings(args.gemini))
+    fakes = {'wordpress': wp_url, 'pexels': pexels_url, 'gemini': gemini_url}
+
+    if args.app_url:
+        steps = []
+        for users in args.users:
+            steps.append(run_step(args, args.app_url, args.wp_url or wp_url, users))
+            print_step(steps[-1])
+        report(args.app_url, steps)
+        return
+
+    for workers in args.workers:
+        print(f"\n=== gunicorn --workers {workers} ===")
+        with tempfile.TemporaryDirectory() as workdir:
+            # Each worker count starts from an untouched site
+            wp_server.RequestHandlerClass._posts = None
+            process, app_url = start_app(args, workers, fakes, workdir)
+            try:
+                steps = []
+                for users in args.users:
+                    steps.append(run_step(args, app_url, wp_url, users))
+                    print_step(steps[-1])
+            finally:
+                process.terminate()
+                process.wait()
+        report(f"{workers} worker(s)", steps)
+
+if __name__ == '__main__':
+    main()
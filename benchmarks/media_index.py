@@ -0,0 +1,125 @@
+"""Lookup speed of the near-duplicate media index, and how well the perceptual hash separates images.
+
+Usage: python benchmarks/media_index.py [--sizes 10000 100000 300000] [--queries 2000] [--distance 6]
+
+For each index size, random 64-bit hashes are indexed and queried with
+near-duplicates (a few bits flipped) and with unrelated hashes. Lookup
+latency is compared against a NumPy linear scan, which also checks that the
+index finds exactly the same matches. The hash section reports the bit
+distance between a synthetic photo and its re-encodes, resized copies and
+crops, next to the distance between unrelated photos.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from image_pipeline import synthetic_photo
+from media_index import MultiIndexHash, perceptual_hash
+
+def flip_bits(value, count, rng):
+    for bit in rng.choice(64, size=count, replace=False):
+        value ^= 1 << int(bit)
+    return value
+
+def linear_scan(hashes, query, max_distance):
+    distances = np.bitwise_count(hashes ^ np.uint64(query))
+    return sorted(zip(distances[distances <= max_distance].tolist(),
+                      np.nonzero(distances <= max_distance)[0].tolist()))
+
+def bench_index(size, queries, max_distance, rng):
+    hashes = rng.integers(0, 2 ** 64, size=size, dtype=np.uint64)
+
+    start = time.perf_counter()
+    index = MultiIndexHash(max_distance)
+    for position, value in enumerate(hashes.tolist()):
+        index.add(value, position)
+    build = time.perf_counter() - start
+
+    near = [flip_bits(int(hashes[rng.integers(size)]), int(rng.integers(0, max_distance + 1)), rng)
+            for _ in range(queries // 2)]
+    unrelated = rng.integers(0, 2 ** 64, size=queries - len(near), dtype=np.uint64).tolist()
+
+    index_times, scan_times, found = [], [], 0
+    for query in near + unrelated:
+        start = time.perf_counter()
+        matches = index.search(query)
+        index_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        expected = linear_scan(hashes, query, max_distance)
+        scan_times.append(time.perf_counter() - start)
+
+        if matches != expected:
+            raise SystemExit(f"Index and linear scan disagree for {query:016x}")
+        found += bool(matches)
+
+    index_times.sort()
+    print(f"{size:>8} entries: build {build:6.2f}s  "
+          f"lookup p50 {statistics.median(index_times) * 1e6:7.0f}us  "
+          f"p99 {index_times[int(len(index_times) * 0.99)] * 1e6:7.0f}us  "
+          f"linear scan p50 {statistics.median(scan_times) * 1e6:7.0f}us  "
+          f"({found}/{queries} queries matched)")
+
+def smooth_field(seed, width=800, height=533):
+    """Low-frequency random colour field: a stand-in for an unrelated photo"""
+    rng = np.random.default_rng(seed)
+    cells = rng.integers(0, 256, size=(9, 13, 3), dtype=np.uint8)
+    return Image.fromarray(cells, 'RGB').resize((width, height), Image.Resampling.BICUBIC)
+
+def distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+def reencoded(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **options)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+def bench_hash():
+    photo = synthetic_photo(1600, 1067, seed=1)
+    original = perceptual_hash(photo)
+    width, height = photo.size
+    variants = {
+        'jpeg q=60': reencoded(photo, 'JPEG', quality=60),
+        'webp q=40': reencoded(photo, 'WEBP', quality=40),
+        'resized to 480w': photo.resize((480, 320)),
+        'resized to 4000w': photo.resize((4000, 2667)),
+        'cropped 2% each side': photo.crop((width // 50, height // 50, width - width // 50, height - height // 50)),
+        'brightness +10%': photo.point(lambda value: min(255, int(value * 1.1))),
+    }
+    print("\nHash distance from the original (64 bits):")
+    for name, img in variants.items():
+        print(f"  {name:<24}{distance(original, perceptual_hash(img)):3d}")
+
+    hashes = [original] + [perceptual_hash(smooth_field(seed)) for seed in range(200)]
+    unrelated = [distance(a, b) for position, a in enumerate(hashes) for b in hashes[position + 1:]]
+    print(f"  {'unrelated images':<24}{min(unrelated):3d} min, {statistics.median(unrelated):.0f} median "
+          f"over {len(unrelated)} pairs")
+
+    start = time.perf_counter()
+    for _ in range(20):
+        perceptual_hash(photo)
+    print(f"  hashing a 1600x1067 image takes {(time.perf_counter() - start) / 20 * 1000:.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 300000])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--distance', type=int, default=6, help='maximum Hamming distance for a match')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    for size in args.sizes:
+        bench_index(size, args.queries, args.distance, rng)
+    bench_hash()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Section index build time and cached lookup time for posts of increasing size.
+
+Usage: python benchmarks/section_index.py [--sections 10 50 200] [--repeat 20]
+
+Each post has the given number of H2/H3 sections of a few paragraphs, with
+an image after every third heading. Build is one index_sections() pass over
+the rendered HTML, which a suggestion request paid for on every call before
+the index was cached. Lookup is a hit in the per-process cache plus fetching
+one section by ID, which is what later requests for the same revision pay.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from post_sections import SectionIndexCache, index_sections
+
+def synthetic_post(sections):
+    parts = ['<p>An introduction to the post.</p>']
+    for position in range(sections):
+        tag = 'h3' if position % 4 == 3 else 'h2'
+        parts.append(f"<{tag}>Section {position}: planning the route</{tag}>")
+        if position % 3 == 0:
+            parts.append(f'<figure class="wp-block-image"><img src="/uploads/{position}.webp" alt=""></figure>')
+        parts.extend(f"<p>{'Details about the trail, the weather and the gear. ' * 12}</p>" for _ in range(3))
+    return '\n'.join(parts)
+
+def median_seconds(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sections', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    for sections in args.sections:
+        content = synthetic_post(sections)
+        cache = SectionIndexCache()
+        key = (1, sections, '2025-01-01T00:00:00')
+        section_id = cache.build(key, content).sections[-1]['id']
+
+        build = median_seconds(lambda: index_sections(content), args.repeat)
+        lookup = median_seconds(lambda: cache.get(key).get(section_id), args.repeat * 100)
+        print(f"{sections:4d} sections, {len(content) / 1024:7.1f}KB: "
+              f"build {build * 1000:7.2f}ms, cached lookup {lookup * 1e6:6.2f}us "
+              f"({build / lookup:,.0f}x faster)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Smart crop speed per megapixel, and output size and quality with and without the crop.
+
+Usage: python benchmarks/smart_crop.py [--aspect 16:9] [--repeat 5]
+
+Crop time covers choosing the window and cropping, on source images from
+1 to 24 megapixels. The encode comparison runs the widest variant of the
+current path (whole frame, resized to 1200px and encoded under the 100KB
+budget) against the cropped path for photos of several aspect ratios. It
+reports published pixels, bytes and the WebP quality that fit the budget.
+A final check places a detailed subject off-centre on a plain background
+and confirms that the crop keeps it.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+
+from image_pipeline import synthetic_photo
+from image_processor import ImageProcessor
+from smart_crop import crop_box, parse_aspect, smart_crop
+
+def bench_speed(aspect, repeat):
+    print("Crop time:")
+    for width, height in ((1200, 800), (2400, 1600), (4000, 3000), (6000, 4000)):
+        img = synthetic_photo(width, height, seed=width)
+        img.load()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            smart_crop(img, aspect)
+            times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        megapixels = width * height / 1e6
+        print(f"  {width}x{height:<6} {median * 1000:7.2f}ms  ({median * 1000 / megapixels:5.2f}ms per megapixel)")
+
+def encode(img, aspect):
+    """Widest published variant of img, as process_image would encode it"""
+    processor = ImageProcessor()
+    img = processor.resize_image(smart_crop(img, aspect), max_width=processor.max_width)
+    return processor.encode_to_budget(img)
+
+def bench_encode(aspect):
+    print("\nWidest variant at the 100KB budget, whole frame -> cropped:")
+    for width, height in ((1600, 1067), (1600, 1200), (1600, 1600), (1200, 1600)):
+        img = synthetic_photo(width, height, seed=height)
+        full = encode(img, None)
+        cropped = encode(img, aspect)
+        print(f"  {width}x{height:<6} {full['width']}x{full['height']} -> {cropped['width']}x{cropped['height']}  "
+              f"{full['size']:6d} -> {cropped['size']:6d} bytes  "
+              f"quality {full['quality']} -> {cropped['quality']}  "
+              f"pixels {cropped['width'] * cropped['height'] / (full['width'] * full['height']) - 1:+.0%}")
+
+def check_subject(aspect):
+    """A wide plain frame with a textured subject near one edge, which a centre crop would cut off"""
+    img = Image.new('RGB', (2400, 1000), (200, 210, 220))
+    img.paste(synthetic_photo(300, 300, seed=7), (2000, 350))
+    ImageDraw.Draw(img).rectangle((2000, 350, 2299, 649), outline=(0, 0, 0), width=4)
+    box = crop_box(img, aspect)
+    kept = box[0] <= 2000 and box[2] >= 2300
+    print(f"\nSubject at x=2000..2300 in a 2400x1000 frame: crop {box}, subject kept: {kept}")
+    return kept
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--aspect', default='16:9')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    aspect = parse_aspect(args.aspect)
+    bench_speed(aspect, args.repeat)
+    bench_encode(aspect)
+    sys.exit(0 if check_subject(aspect) else 1)
+
+if __name__ == '__main__':
+    main()
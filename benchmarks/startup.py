@@ -0,0 +1,94 @@
+"""Measure cold start: import time per module and time to the first HTTP response.
+
+Usage: python benchmarks/startup.py [--runs 5] [--top 15] [--target-ms 1200]
+
+Import time comes from `python -X importtime -c "import main"`, reported in
+total and for the top-level packages with the most self time. Time to first
+response spawns gunicorn with one worker against an empty SQLite database, the
+way an autoscale instance starts, and polls / until it answers. Exits with status 1
+when the median time to first response is above --target-ms.
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+def import_times(workdir):
+    """Total microseconds for `import main` and self time summed per top-level package"""
+    env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'import.db')}")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"import main failed:\n{result.stderr[-2000:]}")
+
+    total, packages = 0, defaultdict(int)
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE_RE.match(line)
+        if not match:
+            continue
+        module = match.group(4)
+        packages[module.split('.')[0]] += int(match.group(1))
+        if module == 'main':
+            total = int(match.group(2))
+    return total, packages
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def time_to_first_response(workdir, run):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, f'cold{run}.db')}")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', '1', '--bind', f"127.0.0.1:{port}", 'main:app'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < 60:
+            if process.poll() is not None:
+                raise SystemExit(f"gunicorn exited with status {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise SystemExit("No response within 60s")
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--target-ms', type=float, default=1200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        total, packages = import_times(workdir)
+        print(f"import main: {total / 1000:.0f}ms, slowest packages by self time:")
+        for name, micros in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"  {name:<28}{micros / 1000:8.1f}ms")
+
+        samples = [time_to_first_response(workdir, run) for run in range(args.runs)]
+
+    median = statistics.median(samples) * 1000
+    print(f"time to first response: median {median:.0f}ms, min {min(samples) * 1000:.0f}ms, "
+          f"max {max(samples) * 1000:.0f}ms over {args.runs} cold starts (target {args.target_ms:.0f}ms)")
+    sys.exit(0 if median <= args.target_ms else 1)
+
+if __name__ == '__main__':
+    main()
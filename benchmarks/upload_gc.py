@@ -0,0 +1,94 @@
+"""Upload store garbage collection time at large file counts.
+
+Usage: python benchmarks/upload_gc.py [--files 100000 300000] [--referenced 0.5] [--variants 4]
+
+For each size, a scratch upload directory is filled with tiny files in the
+sharded content-hash layout. ProcessedImage rows reference a share of them,
+--variants files per row, and the rest are orphans older than the grace
+period. The report gives the time to reference-check every file and delete
+the orphans, then the time for a second pass over the same tree, which only
+scans. It also times an eviction pass that frees a tenth of the bytes.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+def fill(store, count, referenced, variants, rng):
+    """Write count files and return ProcessedImage rows for the referenced share"""
+    old = time.time() - 2 * store.grace_seconds
+    urls = []
+    for _ in range(count):
+        digest = rng.bytes(16).hex()
+        relative = store.relative_path(digest, '.webp')
+        path = os.path.join(store.root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(path, (old, old))
+        urls.append('/uploads/' + relative.replace(os.sep, '/'))
+
+    kept = urls[:int(count * referenced)]
+    last_accessed = datetime.utcnow() - timedelta(days=1)
+    rows = []
+    for start in range(0, len(kept), variants):
+        group = kept[start:start + variants]
+        rows.append({
+            'original_url': f"https://images.example.com/{start}.jpg",
+            'processed_url': group[-1],
+            'cache_key': f"{start:064x}",
+            'last_accessed': last_accessed - timedelta(seconds=start),
+            'variants': json.dumps([{'url': url, 'filename': url.rsplit('/', 1)[-1]} for url in group])
+        })
+    return rows
+
+def bench(size, referenced, variants, rng):
+    from app import create_app, db, init_schema
+    from models import ProcessedImage
+    from upload_store import UploadStore
+
+    with tempfile.TemporaryDirectory() as workdir:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'gc.db')}"})
+        init_schema(app)
+        store = UploadStore(os.path.join(workdir, 'uploads'), max_bytes=10 ** 12)
+
+        start = time.perf_counter()
+        rows = fill(store, size, referenced, variants, rng)
+        with app.app_context():
+            db.session.execute(db.insert(ProcessedImage), rows)
+            db.session.commit()
+        setup = time.perf_counter() - start
+
+        with app.app_context():
+            first = store.collect()
+            second = store.collect()
+            store.max_bytes = int(second['total_bytes'] * 0.9)
+            evicted = store.collect()
+
+    print(f"{size:>9} files ({setup:5.1f}s to create): "
+          f"GC with {first['orphans']} orphans {first['seconds']:6.2f}s "
+          f"({first['seconds'] / size * 1e6:.1f}us/file), "
+          f"scan only {second['seconds']:6.2f}s, "
+          f"evicting {evicted['evicted']} files {evicted['seconds']:6.2f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, nargs='+', default=[100000, 300000])
+    parser.add_argument('--referenced', type=float, default=0.5, help='share of files referenced by rows')
+    parser.add_argument('--variants', type=int, default=4, help='files referenced per row')
+    args = parser.parse_args()
+
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    rng = np.random.default_rng(1)
+    for size in args.files:
+        bench(size, args.referenced, args.variants, rng)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+"""Add images to every post on a WordPress site without opening the editor.
+
+Usage: python bulk_imaging.py --connection 1 [--status draft] [--limit 500] [--in-place]
+       python bulk_imaging.py --resume 7
+
+Posts stream through fetch -> parse -> query -> search -> process -> upload -> save.
+Each stage has its own worker threads and a bounded inbox, so a slow stage
+applies back-pressure instead of buffering the whole site. Per-post progress
+is checkpointed in BulkRunItem; resuming a run skips finished posts and
+reuses the queries, images and uploads already recorded for unfinished ones.
+
+Posts are read and written as raw content (context=edit), so block comments
+and shortcodes survive. Updated posts are saved as drafts for review unless
+--in-place is given, which keeps each post's status, published ones included.
+"""
+import argparse
+import html
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from post_sections import insert_after_headings, section_indexes
+from quota import admission
+
+logger = logging.getLogger(__name__)
+
+STAGE_WORKERS = {
+    'fetch': 4,
+    'parse': 1,
+    'query': 2,
+    'search': 4,
+    'process': 2,
+    'upload': 4,
+    'save': 2
+}
+QUEUE_SIZE = 8
+LIST_PAGE_SIZE = 100
+
+# Sentinel telling a stage worker that its upstream has finished
+DONE = object()
+
+class Skip(Exception):
+    """Raised by a stage when a post needs no further work"""
+
+class Stage:
+    """One pipeline step: worker threads draining a bounded inbox"""
+
+    def __init__(self, name, handler, workers, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.first_start = None
+        self.last_finish = None
+        self._lock = threading.Lock()
+
+    def record(self, start, elapsed, failed):
+        with self._lock:
+            self.items += 1
+            self.errors += failed
+            self.busy += elapsed
+            self.first_start = min(self.first_start or start, start)
+            self.last_finish = max(self.last_finish or 0, start + elapsed)
+
+    def stats(self):
+        wall = (self.last_finish - self.first_start) if self.items else 0
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy, 2),
+            'items_per_second': round(self.items / wall, 3) if wall else None,
+            'utilisation': round(self.busy / (wall * self.workers), 3) if wall else None
+        }
+
+class BulkImagingPipeline:
+    """Runs one BulkRun: streams a site's posts through the stages and checkpoints each post"""
+
+    def __init__(self, app, run_id, stage_workers=None, queue_size=QUEUE_SIZE):
+        self.app = app
+        self.run_id = run_id
+        self.stop = threading.Event()
+        # Clients are per thread so stage workers never share a client's state
+        self._local = threading.local()
+        self.counts = {'done': 0, 'skipped': 0, 'failed': 0, 'resumed': 0}
+        self._lock = threading.Lock()
+
+        with app.app_context():
+            from app import db
+            from models import BulkRun, WordPressConnection
+
+            run = db.session.get(BulkRun, run_id)
+            self.options = json.loads(run.options or '{}')
+            self.wp_conn_id = run.wp_connection_id
+            wp_conn = db.session.get(WordPressConnection, run.wp_connection_id)
+            self.site = (wp_conn.site_url, wp_conn.username, wp_conn.app_password)
+
+        workers = dict(STAGE_WORKERS, **(stage_workers or {}))
+        self.stages = [Stage(name, getattr(self, f"stage_{name}"), workers[name], queue_size)
+                       for name in STAGE_WORKERS]
+
+    def wp_client(self):
+        if not hasattr(self._local, 'wp_client'):
+            from wordpress_client import WordPressClient
+            self._local.wp_client = WordPressClient(*self.site)
+        return self._local.wp_client
+
+    def gemini(self):
+        if not hasattr(self._local, 'gemini'):
+            from gemini_client import GeminiClient
+            self._local.gemini = GeminiClient()
+        return self._local.gemini
+
+    def pexels(self):
+        if not hasattr(self._local, 'pexels'):
+            from pexels_client import PexelsClient
+            self._local.pexels = PexelsClient()
+        return self._local.pexels
+
+    def run(self):
+        """Process every post; returns the per-stage stats"""
+        from app import db
+        from models import BulkRun
+
+        threads = []
+        for position, stage in enumerate(self.stages):
+            downstream = self.stages[position + 1] if position + 1 < len(self.stages) else None
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(stage, downstream),
+                                          name=f"bulk-{stage.name}-{number}", daemon=True)
+                thread.start()
+                threads.append((stage, thread))
+
+        started = time.perf_counter()
+        status = 'done'
+        try:
+            with admission('batch'):
+                self.feed(self.stages[0])
+            # Shut stages down in order: once every worker of a stage has exited,
+            # nothing more can reach the next one
+            for stage in self.stages:
+                for _ in range(stage.workers):
+                    self.put(stage, DONE)
+                for owner, thread in threads:
+                    if owner is stage:
+                        while thread.is_alive():
+                            thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            logger.warning("Interrupted; finished posts are checkpointed, resume with --resume")
+            self.stop.set()
+            status = 'interrupted'
+        except Exception as e:
+            logger.error(f"Bulk run {self.run_id} failed: {e}")
+            self.stop.set()
+            status = 'failed'
+
+        elapsed = time.perf_counter() - started
+        completed = self.counts['done'] + self.counts['skipped'] + self.counts['failed']
+        stats = {
+            'elapsed_seconds': round(elapsed, 2),
+            'posts': dict(self.counts),
+            'posts_per_second': round(completed / elapsed, 3) if elapsed else None,
+            'stages': {stage.name: stage.stats() for stage in self.stages}
+        }
+
+        with self.app.app_context():
+            run = db.session.get(BulkRun, self.run_id)
+            run.status = status
+            run.stats = json.dumps(stats)
+            if status == 'done':
+                run.finished_at = datetime.utcnow()
+            db.session.commit()
+        return stats
+
+    def put(self, stage, item):
+        """Block on a full inbox, but give up promptly once the run is stopping"""
+        while not self.stop.is_set():
+            try:
+                stage.inbox.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed(self, first_stage):
+        """List the site's posts and queue those not already finished in this run"""
+        from app import db
+        from models import BulkRunItem
+
+        status = self.options.get('status', 'all')
+        limit = self.options.get('limit')
+        queued = 0
+        page = 1
+
+        with self.app.app_context():
+            finished = {item.wp_id for item in BulkRunItem.query.filter(
+                BulkRunItem.run_id == self.run_id,
+                BulkRunItem.status.in_(('done', 'skipped')))}
+            checkpoints = {item.wp_id: item for item in BulkRunItem.query.filter_by(run_id=self.run_id)}
+
+            while not self.stop.is_set():
+                data = self.wp_client().get_posts(status=status, page=page, per_page=LIST_PAGE_SIZE)
+                if data is None:
+                    raise RuntimeError(f"Failed to list posts (page {page})")
+
+                for post in data['posts']:
+                    if limit and queued >= limit:
+                        return
+                    if post['id'] in finished:
+                        continue
+
+                    item = checkpoints.get(post['id'])
+                    if item is None:
+                        item = BulkRunItem(run_id=self.run_id, wp_id=post['id'])
+                        db.session.add(item)
+                        db.session.commit()
+                    elif item.state:
+                        with self._lock:
+                            self.counts['resumed'] += 1
+
+                    state = json.loads(item.state or '{}')
+                    state.setdefault('sections', {})
+                    if not self.put(first_stage, {'item_id': item.id, 'wp_id': post['id'], 'state': state}):
+                        return
+                    queued += 1
+
+                if page >= data['total_pages'] or not data['posts']:
+                    return
+                page += 1
+
+    def work(self, stage, downstream):
+        # Provider calls from a bulk run give way to interactive editor requests
+        with self.app.app_context(), admission('batch'):
+            while not self.stop.is_set():
+                try:
+                    work = stage.inbox.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if work is DONE:
+                    return
+
+                start = time.perf_counter()
+                failed = False
+                try:
+                    stage.handler(work)
+                except Skip as e:
+                    self.finish(work, 'skipped', str(e))
+                    work = None
+                except Exception as e:
+                    logger.error(f"Post {work['wp_id']} failed at {stage.name}: {e}")
+                    self.finish(work, 'failed', f"{stage.name}: {e}")
+                    work = None
+                    failed = True
+                stage.record(start, time.perf_counter() - start, failed)
+
+                if work is None:
+                    continue
+                self.checkpoint(work, stage.name)
+                if downstream:
+                    self.put(downstream, work)
+                else:
+                    self.finish(work, 'done')
+
+    def checkpoint(self, work, stage_name):
+        from app import db
+        from models import BulkRunItem
+
+        item = db.session.get(BulkRunItem, work['item_id'])
+        item.stage = stage_name
+        item.state = json.dumps(work['state'])
+        db.session.commit()
+
+    def finish(self, work, status, error=None):
+        from app import db
+        from models import BulkRunItem
+
+        item = db.session.get(BulkRunItem, work['item_id'])
+        item.status = status
+        item.error = error
+        item.attempts = (item.attempts or 0) + 1
+        if status == 'done':
+            item.state = json.dumps(work['state'])
+            item.stage = 'save'
+        db.session.commit()
+        with self._lock:
+            self.counts[status] += 1
+
+    def pending_sections(self, work, key):
+        """Sections that still need an image and have no recorded value for key yet"""
+        return [section for section in work['sections']
+                if key not in work['state']['sections'].get(section['text'], {})]
+
+    def stage_fetch(self, work):
+        post = self.wp_client().get_post(work['wp_id'], raw=True)
+        if post is None:
+            raise RuntimeError('Failed to fetch post')
+        if post['status'] != 'draft' and not self.options.get('in_place'):
+            # Saving it as a draft would take it off the site
+            raise Skip(f"Post is {post['status']}; only --in-place runs update it")
+        work['post'] = post
+
+    def stage_parse(self, work):
+        post = work['post']
+        # Raw content parses differently from the rendered HTML the editor caches, so key it apart
+        work['index'] = section_indexes.build((self.wp_conn_id, post['id'], post['modified'], 'raw'),
+                                              post['content'], post['title'])
+        sections = work['index'].pending()
+        max_images = self.options.get('max_images')
+        if max_images:
+            sections = sections[:max_images]
+        if not sections:
+            raise Skip('No headings without an image')
+        work['sections'] = sections
+
+        # Checkpoints are keyed by heading text, so edits that reorder sections keep their work
+        wanted = {section['text'] for section in sections}
+        work['state']['sections'] = {text: entry for text, entry in work['state']['sections'].items()
+                                     if text in wanted}
+
+    def stage_query(self, work):
+        pending = self.pending_sections(work, 'query')
+        if not pending:
+            return
+        title = work['index'].title
+        queries = self.gemini().generate_image_search_queries(title, pending)
+        for section in pending:
+            # Fall back to the heading itself when Gemini is unavailable
+            query = queries.get(section['index']) or section['text']
+            work['state']['sections'].setdefault(section['text'], {})['query'] = query
+
+    def stage_search(self, work):
+        entries = work['state']['sections']
+        used = {entry['image']['id'] for entry in entries.values() if entry.get('image')}
+        for section in self.pending_sections(work, 'image'):
+            entry = entries[section['text']]
+            images = self.pexels().search_images(entry['query'], per_page=10, prefetch=False)
+            # Avoid repeating a photo within the same post
+            image = next((image for image in images if image['id'] not in used), None)
+            if image:
+                used.add(image['id'])
+                entry['image'] = {key: image[key] for key in ('id', 'url', 'photographer', 'alt')}
+
+    def stage_process(self, work):
+        from image_processor import ImageProcessor
+
+        processor = ImageProcessor()
+        for section in self.pending_sections(work, 'processed'):
+            entry = work['state']['sections'][section['text']]
+            if not entry.get('image') or entry.get('media'):
+                continue
+            image = entry['image']
+            processed = processor.process_image(image['url'], image['photographer'], image['alt'])
+            if not processed:
+                raise RuntimeError(f"Failed to process image for '{section['text']}'")
+            entry['processed'] = {'variants': processed['variants'], 'phash': processed.get('phash')}
+
+    def stage_upload(self, work):
+        from image_processor import ImageProcessor
+        from job_queue import publish_variants
+
+        for section in self.pending_sections(work, 'media'):
+            entry = work['state']['sections'][section['text']]
+            if not entry.get('processed'):
+                continue
+            processed = entry['processed']
+            if not all(os.path.exists(v['file_path']) for v in processed['variants']):
+                # Evicted from the local cache since it was processed; encode it again
+                image = entry['image']
+                processed = ImageProcessor().process_image(image['url'], image['photographer'], image['alt'])
+                if not processed:
+                    raise RuntimeError(f"Failed to reprocess image for '{section['text']}'")
+            image = entry['image']
+            source = {'image_url': image['url'], 'author': image['photographer'], 'alt_text': image['alt']}
+            entry['media'] = publish_variants(processed, self.wp_client(), self.wp_conn_id, source=source)
+            # The WordPress copy is what the post uses from here on
+            entry.pop('processed')
+            self.checkpoint(work, 'upload')
+
+    def stage_save(self, work):
+        post = work['post']
+        blocks = '<!-- wp:' in post['content']
+        fragments = {}
+        for section in work['sections']:
+            entry = work['state']['sections'].get(section['text'], {})
+            if entry.get('media'):
+                fragments[section['index']] = figure_html(entry, blocks)
+        if not fragments:
+            raise Skip('No images found for any heading')
+
+        # Authors may have edited the post while it was in the pipeline, as in PostMirror.save_post
+        current = self.wp_client().get_post(post['id'], raw=True)
+        if current is None:
+            raise RuntimeError('Failed to fetch post before saving')
+        if current['modified'] != post['modified']:
+            raise RuntimeError(f"Post changed in WordPress since it was fetched ({current['modified']}); "
+                               f"resume the run to add images to the new revision")
+        if current['status'] != 'draft' and not self.options.get('in_place'):
+            raise Skip(f"Post is {current['status']}; only --in-place runs update it")
+
+        content = insert_after_headings(post['content'], fragments, index=work['index'])
+        if not self.wp_client().update_post(post['id'], content, status=current['status']):
+            raise RuntimeError('Failed to save post')
+
+def figure_html(entry, block=False):
+    """The figure markup the editor inserts, without its editing controls
+
+    With block, it is an image block as the block editor saves one, so the
+    post still validates; WordPress adds the srcset when it renders the block.
+    """
+    image = entry['image']
+    media = entry['media']
+    alt = html.escape(image.get('alt') or entry['query'])
+    attribution = html.escape(f"Photo by {image['photographer']} on Pexels")
+    if block:
+        attributes = json.dumps({'id': media['media_id'], 'sizeSlug': 'full', 'linkDestination': 'none'})
+        return (f'\n\n<!-- wp:image {attributes} -->\n'
+                f'<figure class="wp-block-image size-full">'
+                f'<img src="{media["processed_url"]}" alt="{alt}" class="wp-image-{media["media_id"]}"/>'
+                f'<figcaption class="wp-element-caption">{attribution}</figcaption></figure>\n'
+                f'<!-- /wp:image -->')
+    return (f'<figure class="wp-block-image size-full">'
+            f'<img src="{media["processed_url"]}" srcset="{media["srcset"]}" sizes="{media["sizes"]}" '
+            f'alt="{alt}" class="wp-image-{media["media_id"]}">'
+            f'<figcaption>{attribution}</figcaption></figure>')
+
+def parse_workers(values):
+    workers = {}
+    for value in values or []:
+        name, _, count = value.partition('=')
+        if name not in STAGE_WORKERS or not count.isdigit() or int(count) < 1:
+            raise argparse.ArgumentTypeError(f"Expected STAGE=N with STAGE one of {', '.join(STAGE_WORKERS)}")
+        workers[name] = int(count)
+    return workers
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--connection', type=int, help='WordPressConnection id to start a new run for')
+    target.add_argument('--resume', type=int, help='BulkRun id to continue')
+    parser.add_argument('--status', default='draft', choices=('all', 'publish', 'draft'),
+                        help='posts to add images to (defaults to drafts; others need --in-place)')
+    parser.add_argument('--limit', type=int, help='stop after queueing this many posts')
+    parser.add_argument('--max-images', type=int, help='images to add per post at most')
+    parser.add_argument('--in-place', action='store_true',
+                        help='keep each post\'s status, updating published posts live, instead of saving drafts')
+    parser.add_argument('--workers', nargs='*', metavar='STAGE=N', help='override per-stage worker counts')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    args = parser.parse_args()
+    if args.status != 'draft' and not args.in_place:
+        parser.error(f"--status {args.status} needs --in-place: saving a published post as a draft unpublishes it")
+
+    # Imported here so encode pool workers, which re-import this module, do not build the app
+    from app import app, db, init_schema
+    from models import BulkRun, WordPressConnection
+
+    init_schema(app)
+    with app.app_context():
+        if args.resume:
+            run = db.session.get(BulkRun, args.resume)
+            if run is None:
+                parser.error(f"No bulk run {args.resume}")
+            run.status = 'running'
+        else:
+            if db.session.get(WordPressConnection, args.connection) is None:
+                parser.error(f"No WordPress connection {args.connection}")
+            options = {'status': args.status, 'limit': args.limit,
+                       'max_images': args.max_images, 'in_place': args.in_place}
+            run = BulkRun(wp_connection_id=args.connection, options=json.dumps(options))
+            db.session.add(run)
+        db.session.commit()
+        run_id = run.id
+
+    logger.info(f"Starting bulk run {run_id}")
+    pipeline = BulkImagingPipeline(app, run_id, parse_workers(args.workers), args.queue_size)
+    stats = pipeline.run()
+
+    print(f"Bulk run {run_id}: {stats['posts']} in {stats['elapsed_seconds']}s")
+    for name, stage in stats['stages'].items():
+        rate = stage['items_per_second']
+        print(f"  {name:<8} workers={stage['workers']:<2} items={stage['items']:<5} errors={stage['errors']:<4} "
+              f"{rate if rate is not None else '-':>8} posts/s  utilisation={stage['utilisation']}")
+
+if __name__ == '__main__':
+    main()
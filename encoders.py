@@ -0,0 +1,102 @@
+"""Output formats processed images can be encoded in, and a quality metric to choose between them.
+
+Each Encoder wraps a Pillow save format with a quality knob. Formats the
+local Pillow build cannot write (AVIF needs Pillow 11.3+ built with libavif)
+are left out of available_encoders(), so the pipeline falls back to the rest.
+
+Only WebP is enabled by default: choosing between formats costs every extra
+format's encodes on the widest variant, and WordPress before 6.5 rejects
+AVIF uploads.
+"""
+import io
+import logging
+import os
+
+import numpy as np
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# Width of the grayscale copies compared by ssim()
+SSIM_WIDTH = 512
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+class Encoder:
+    """One output format: how to save it, what it is called and how much it needs per pixel"""
+
+    def __init__(self, name, pillow_format, mime_type, extension, reference_bpp,
+                 min_quality=30, max_quality=90, feature=None, **options):
+        self.name = name
+        self.pillow_format = pillow_format
+        self.mime_type = mime_type
+        self.extension = extension
+        # Bits per pixel a typical photo needs at quality 85, used to predict a starting quality
+        self.reference_bpp = reference_bpp
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.feature = feature
+        self.options = options
+
+    def available(self):
+        return self.feature is None or bool(features.check(self.feature))
+
+    def encode(self, img, quality):
+        buffer = io.BytesIO()
+        img.save(buffer, format=self.pillow_format, quality=quality, **self.options)
+        return buffer.getvalue()
+
+ENCODERS = {}
+
+def register(encoder):
+    ENCODERS[encoder.name] = encoder
+    return encoder
+
+register(Encoder('webp', 'WEBP', 'image/webp', '.webp', 1.2, optimize=True))
+# speed 8 keeps an AVIF encode within a few times a WebP one
+register(Encoder('avif', 'AVIF', 'image/avif', '.avif', 1.4, feature='avif', speed=8))
+register(Encoder('jpeg', 'JPEG', 'image/jpeg', '.jpg', 2.0, max_quality=92,
+                 optimize=True, progressive=True, subsampling='4:2:0'))
+
+def available_encoders(names=None):
+    """Encoders to try, in order, from names or IMAGE_FORMATS; WebP when none are usable"""
+    if names is None:
+        names = [name.strip() for name in os.environ.get('IMAGE_FORMATS', 'webp').split(',')]
+    encoders = []
+    for name in names:
+        encoder = ENCODERS.get(name)
+        if encoder is None:
+            logger.warning(f"Unknown image format: {name}")
+        elif encoder.available():
+            encoders.append(encoder)
+    return encoders or [ENCODERS['webp']]
+
+def gray_copy(img):
+    """Grayscale float array of img at most SSIM_WIDTH pixels wide"""
+    if img.width > SSIM_WIDTH:
+        img = img.resize((SSIM_WIDTH, max(1, round(img.height * SSIM_WIDTH / img.width))),
+                         Image.Resampling.BOX, reducing_gap=2.0)
+    return np.asarray(img.convert('L'), dtype=np.float64)
+
+def box_mean(values):
+    """Mean over every SSIM_WINDOW x SSIM_WINDOW window, from an integral image"""
+    integral = np.pad(values.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    n = SSIM_WINDOW
+    sums = integral[n:, n:] - integral[:-n, n:] - integral[n:, :-n] + integral[:-n, :-n]
+    return sums / (n * n)
+
+def ssim(reference, data):
+    """Mean structural similarity of encoded bytes to a gray_copy() of the source"""
+    with Image.open(io.BytesIO(data)) as decoded:
+        candidate = gray_copy(decoded)
+    if candidate.shape != reference.shape or min(reference.shape) < SSIM_WINDOW:
+        return 0.0
+
+    mean_x, mean_y = box_mean(reference), box_mean(candidate)
+    var_x = box_mean(reference * reference) - mean_x ** 2
+    var_y = box_mean(candidate * candidate) - mean_y ** 2
+    covariance = box_mean(reference * candidate) - mean_x * mean_y
+    index = (((2 * mean_x * mean_y + SSIM_C1) * (2 * covariance + SSIM_C2))
+             / ((mean_x ** 2 + mean_y ** 2 + SSIM_C1) * (var_x + var_y + SSIM_C2)))
+    return float(index.mean())
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+
+logger = logging.getLogger(__name__)
+
+# Shortest time between deletes of expired GeminiResponse rows, per process
+PURGE_INTERVAL = 600
+
+class GeminiCache:
+    """Two-tier cache of Gemini responses: an in-process LRU in front of the GeminiResponse table
+
+    Expired rows are ignored on read and deleted by the next store after
+    PURGE_INTERVAL, so the table stays bounded by what is stored within a TTL.
+    """
+
+    def __init__(self, max_entries=None, ttl_seconds=None):
+        self.max_entries = max_entries or int(os.environ.get('GEMINI_CACHE_SIZE', 1024))
+        self.ttl_seconds = ttl_seconds or int(os.environ.get('GEMINI_CACHE_TTL', 30 * 24 * 3600))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'purged': 0}
+        self._purged_at = None
+
+    def make_key(self, kind, model, prompt_version, *inputs):
+        payload = json.dumps([kind, model, prompt_version, *inputs], ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _remember(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return entry[0]
+            self._entries.pop(key, None)
+
+        if has_app_context():
+            try:
+                from models import GeminiResponse
+
+                record = GeminiResponse.query.filter_by(cache_key=key).first()
+                if record and record.expires_at > datetime.utcnow():
+                    remaining = (record.expires_at - datetime.utcnow()).total_seconds()
+                    self._remember(key, record.value, time.time() + remaining)
+                    self._count('db_hits')
+                    return record.value
+            except Exception as e:
+                logger.warning(f"Gemini cache lookup failed: {e}")
+
+        self._count('misses')
+        return None
+
+    def set(self, key, kind, value):
+        """Store a response in both tiers"""
+        self._remember(key, value, time.time() + self.ttl_seconds)
+        self._count('stores')
+
+        if not has_app_context():
+            return
+
+        from app import db
+        from models import GeminiResponse
+
+        try:
+            expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+            record = GeminiResponse.query.filter_by(cache_key=key).first()
+            if record:
+                record.value = value
+                record.expires_at = expires_at
+            else:
+                db.session.add(GeminiResponse(cache_key=key, kind=kind, value=value, expires_at=expires_at))
+            db.session.commit()
+        except Exception as e:
+            # Most likely another worker stored the same key first
+            db.session.rollback()
+            logger.warning(f"Failed to store Gemini response: {e}")
+
+        self.purge_expired()
+
+    def purge_expired(self, force=False):
+        """Delete expired GeminiResponse rows, at most once per PURGE_INTERVAL unless forced; needs an app context"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._purged_at is not None and now - self._purged_at < PURGE_INTERVAL:
+                return 0
+            self._purged_at = now
+
+        from app import db
+        from models import GeminiResponse
+
+        try:
+            deleted = (GeminiResponse.query
+                       .filter(GeminiResponse.expires_at <= datetime.utcnow())
+                       .delete(synchronize_session=False))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Failed to delete expired Gemini responses: {e}")
+            return 0
+        with self._lock:
+            self.stats['purged'] += deleted
+        if deleted:
+            logger.info(f"Deleted {deleted} expired Gemini responses")
+        return deleted
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self._entries)
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 4) if lookups else None
+        return stats
+
+gemini_cache = GeminiCache()
@@ -1,18 +1,51 @@
 import os
+import json
 import logging
 from google import genai
 from google.genai import types
+from gemini_cache import gemini_cache
+from telemetry import span
+from quota import quota
 
 logger = logging.getLogger(__name__)
 
+MODEL = "gemini-2.5-flash"
+
+# Bump when a prompt template changes so cached responses are not reused
+QUERY_PROMPT_VERSION = 1
+ALT_TEXT_PROMPT_VERSION = 1
+
+# Longest query accepted from a batched response before retrying that heading alone
+MAX_QUERY_WORDS = 10
+
 class GeminiClient:
     def __init__(self):
         api_key = os.environ.get("GEMINI_API_KEY")
-        self.client = genai.Client(api_key=api_key)
+        base_url = os.environ.get("GEMINI_BASE_URL")
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.usage = {'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0}
+    
+    def _record_usage(self, response):
+        """Count calls and tokens reported by Gemini for this client"""
+        self.usage['calls'] += 1
+        metadata = getattr(response, 'usage_metadata', None)
+        if metadata:
+            self.usage['prompt_tokens'] += metadata.prompt_token_count or 0
+            self.usage['output_tokens'] += metadata.candidates_token_count or 0
+    
+    def _query_cache_key(self, heading_text, heading_content):
+        return gemini_cache.make_key('search_query', MODEL, QUERY_PROMPT_VERSION,
+                                     heading_text, heading_content[:500])
     
     def generate_image_search_query(self, blog_title, heading_text, heading_content):
         """Generate search query for Pexels based on blog context"""
         try:
+            cache_key = self._query_cache_key(heading_text, heading_content)
+            cached = gemini_cache.get(cache_key)
+            if cached:
+                return cached
+            
             prompt = f"""You are helping me find an image for a blog post section.
 Here is the blog post section:
 
@@ -24,28 +57,140 @@ Your task:
 2. Return ONLY a short and specific Pexels search query (4–7 words max) that will show images highly relevant to this title and paragraph.
 
 Make sure your query is suitable for a visual search engine like Pexels."""
+
+            if not quota.acquire('gemini'):
+                logger.warning(f"Gemini request budget exhausted, skipping query for: {heading_text}")
+                return None
             
-            response = self.client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=prompt
-            )
+            with span('gemini_query'):
+                response = self.client.models.generate_content(
+                    model=MODEL,
+                    contents=prompt
+                )
+            self._record_usage(response)
             
             if response.text:
                 # Clean up the response
                 query = response.text.strip().replace('"', '').replace("'", '')
                 logger.info(f"Generated search query: {query}")
+                gemini_cache.set(cache_key, 'search_query', query)
                 return query
             else:
                 logger.error("Empty response from Gemini")
                 return None
-                
+        
         except Exception as e:
             logger.error(f"Error generating search query: {e}")
             return None
     
+    def generate_image_search_queries(self, blog_title, sections, fallback=True):
+        """Generate search queries for many sections in one request; returns {index: query}
+        
+        Sections already cached are skipped. Any heading whose batched answer is
+        missing or malformed is retried with generate_image_search_query, unless
+        fallback is off and the caller retries those headings itself.
+        """
+        queries = {}
+        pending = []
+        for section in sections:
+            cached = gemini_cache.get(self._query_cache_key(section['text'], section['content']))
+            if cached:
+                queries[section['index']] = cached
+            else:
+                pending.append(section)
+        
+        if not pending:
+            return queries
+        
+        batched = self._generate_query_batch(pending) if len(pending) > 1 else {}
+        
+        for section in pending:
+            query = batched.get(section['index'])
+            if query:
+                gemini_cache.set(self._query_cache_key(section['text'], section['content']),
+                                 'search_query', query)
+            elif fallback:
+                query = self.generate_image_search_query(blog_title, section['text'], section['content'])
+            if query:
+                queries[section['index']] = query
+        
+        return queries
+    
+    def _generate_query_batch(self, sections):
+        """One structured-output call covering every section; only well-formed entries are returned"""
+        try:
+            payload = json.dumps([
+                {'index': section['index'], 'title': section['text'], 'paragraph': section['content'][:500]}
+                for section in sections
+            ], ensure_ascii=False)
+            
+            prompt = f"""You are helping me find images for the sections of a blog post.
+Here are the H2/H3 sections as JSON, each with its index, title and paragraph:
+
+{payload}
+
+For every section:
+1. Understand the visual context of its H2 or H3 title and paragraph.
+2. Write a short and specific Pexels search query (4–7 words max) that will show images highly relevant to that section.
+
+Make sure each query is suitable for a visual search engine like Pexels.
+Return one entry per section index."""
+
+            if not quota.acquire('gemini'):
+                logger.warning(f"Gemini request budget exhausted, skipping {len(sections)} batched queries")
+                return {}
+            
+            with span('gemini_query_batch'):
+                response = self.client.models.generate_content(
+                    model=MODEL,
+                    contents=prompt,
+                    config=types.GenerateContentConfig(
+                        response_mime_type="application/json",
+                        response_schema={
+                            'type': 'ARRAY',
+                            'items': {
+                                'type': 'OBJECT',
+                                'properties': {
+                                    'index': {'type': 'INTEGER'},
+                                    'query': {'type': 'STRING'}
+                                },
+                                'required': ['index', 'query']
+                            }
+                        }
+                    )
+                )
+            self._record_usage(response)
+            
+            entries = json.loads(response.text or '[]')
+        except Exception as e:
+            logger.error(f"Error generating batched search queries: {e}")
+            return {}
+        
+        wanted = {section['index'] for section in sections}
+        queries = {}
+        for entry in entries if isinstance(entries, list) else []:
+            if not isinstance(entry, dict):
+                continue
+            index = entry.get('index')
+            query = entry.get('query')
+            if index not in wanted or index in queries or not isinstance(query, str):
+                continue
+            query = query.strip().replace('"', '').replace("'", '')
+            if query and len(query.split()) <= MAX_QUERY_WORDS:
+                queries[index] = query
+        
+        logger.info(f"Batched search queries: {len(queries)} of {len(sections)} sections answered")
+        return queries
+    
     def generate_alt_text(self, image_url, context):
         """Generate alt text for an image based on context"""
         try:
+            # The prompt only sees the context, so the image URL is not part of the key
+            cache_key = gemini_cache.make_key('alt_text', MODEL, ALT_TEXT_PROMPT_VERSION, context)
+            cached = gemini_cache.get(cache_key)
+            if cached:
+                return cached
+            
             prompt = f"""
             Generate a descriptive alt text for a stock photo that will be used in a blog post.
             
@@ -60,17 +205,24 @@ Make sure your query is suitable for a visual search engine like Pexels."""
             Return only the alt text, nothing else.
             """
             
-            response = self.client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=prompt
-            )
+            if not quota.acquire('gemini'):
+                logger.warning("Gemini request budget exhausted, skipping alt text")
+                return None
+            
+            with span('gemini_alt_text'):
+                response = self.client.models.generate_content(
+                    model=MODEL,
+                    contents=prompt
+                )
+            self._record_usage(response)
             
             if response.text:
                 alt_text = response.text.strip().replace('"', '').replace("'", '')
+                gemini_cache.set(cache_key, 'alt_text', alt_text)
                 return alt_text
             else:
                 return None
-                
+        
         except Exception as e:
             logger.error(f"Error generating alt text: {e}")
             return None
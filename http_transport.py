@@ -0,0 +1,191 @@
+import http.cookiejar
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, EmptyPoolError
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# Longest wait for a free pooled connection before giving up on the request
+POOL_TIMEOUT = float(os.environ.get('HTTP_POOL_TIMEOUT', 10))
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    """A blocking pool whose callers wait at most POOL_TIMEOUT for a connection"""
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout if timeout is not None else POOL_TIMEOUT)
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout if timeout is not None else POOL_TIMEOUT)
+
+class TimedPoolAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+def failed_to_connect(error):
+    """Whether a ConnectionError happened before the request could reach the server"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying failure
+    reason = getattr(reason, 'reason', reason)
+    # NewConnectionError (refused, DNS failure) is a ConnectTimeoutError subclass
+    return isinstance(reason, ConnectTimeoutError)
+
+class HostMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latencies = deque(maxlen=500)
+
+    def to_dict(self, connections_opened):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4)
+
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'errors': self.errors,
+            'connections_opened': connections_opened,
+            'connection_reuse_ratio': round(1 - connections_opened / self.requests, 4) if self.requests else None,
+            'latency_avg': round(self.latency_total / self.requests, 4) if self.requests else None,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95)
+        }
+
+class HttpTransport:
+    """Per-host pooled requests sessions with keep-alive and retry with jittered backoff"""
+
+    def __init__(self, pool_maxsize=None, max_retries=None, backoff_base=0.5, backoff_max=8.0):
+        self.pool_maxsize = pool_maxsize or int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get('HTTP_MAX_RETRIES', 3))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sessions = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session_for(self, url):
+        """Return the shared session for the URL's host, creating it on first use"""
+        host = self._host(url)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    # Shared by every user's client for this host, so never carry one caller's cookies to another
+                    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                    # pool_block bounds open connections per host; extra callers wait up to POOL_TIMEOUT
+                    adapter = TimedPoolAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize,
+                                               pool_block=True, max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._sessions[host] = session
+                    self._metrics[host] = HostMetrics()
+        return session
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying failures that are safe to repeat
+
+        Idempotent methods are retried on connection errors, 429 and 5xx. Others,
+        such as a media upload POST, only when the connection was never made:
+        a dropped keep-alive socket or a 429 may come after the server acted on it.
+        """
+        method = method.upper()
+        session = self.session_for(url)
+        metrics = self._metrics[self._host(url)]
+        attempt = 0
+
+        while True:
+            start = time.perf_counter()
+            idempotent = method in IDEMPOTENT_METHODS
+            try:
+                response = session.request(method, url, **kwargs)
+            except EmptyPoolError as e:
+                with self._lock:
+                    metrics.errors += 1
+                raise requests.ConnectionError(f"No free connection to {self._host(url)} "
+                                               f"within {POOL_TIMEOUT:g}s") from e
+            except requests.ConnectionError as e:
+                # Connect timeouts, refused connections and keep-alive sockets the server dropped
+                with self._lock:
+                    metrics.errors += 1
+                if attempt >= self.max_retries or not (idempotent or failed_to_connect(e)):
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Retrying {method} {url} in {delay:.1f}s after connection error: {e}")
+            else:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    metrics.requests += 1
+                    metrics.latency_total += elapsed
+                    metrics.latencies.append(elapsed)
+
+                retryable = idempotent and response.status_code in RETRY_STATUSES
+                if not retryable or attempt >= self.max_retries:
+                    return response
+
+                delay = self._backoff(attempt, response)
+                if delay > self.backoff_max:
+                    # The server asked for a longer pause than we are willing to hold a worker
+                    return response
+                logger.warning(f"Retrying {method} {url} in {delay:.1f}s after HTTP {response.status_code}")
+                response.close()
+
+            with self._lock:
+                metrics.retries += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def metrics(self):
+        """Per-host request counts, retries, connection reuse and latency"""
+        with self._lock:
+            items = list(self._metrics.items())
+        stats = {}
+        for host, metrics in items:
+            pools = self._sessions[host].get_adapter(host).poolmanager.pools
+            opened = sum(pools[key].num_connections for key in pools.keys() if key in pools)
+            stats[host] = metrics.to_dict(opened)
+        return stats
+
+transport = HttpTransport()
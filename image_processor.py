@@ -1,84 +1,498 @@
-import requests
+from http_transport import transport
+from media_index import perceptual_hash
+from upload_store import upload_store
+from smart_crop import configured_aspect, crop_fraction, smart_crop
+from encoders import available_encoders, gray_copy, ssim
+import telemetry
+from flask import current_app, has_app_context
 import os
 import logging
 from PIL import Image
-import io
 import hashlib
+import tempfile
+import math
+import json
+import multiprocessing
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Bump when the encode pipeline changes so stale cache entries are not reused
+ENCODER_VERSION = 6
+
+# Recent (budget bits per pixel, chosen quality) pairs per format, used to predict a starting quality
+quality_history = defaultdict(lambda: deque(maxlen=64))
+
+# Formats whose SSIM is this close to the best are compared on bytes instead
+SSIM_TOLERANCE = 0.002
+
+# Responsive widths produced for every image; the widest also gets the full size budget
+VARIANT_WIDTHS = (480, 800, 1200)
+
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+def get_encode_pool():
+    """Shared process pool for WebP encoding, or None to encode inline"""
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            workers = int(os.environ.get('IMAGE_ENCODE_WORKERS', os.cpu_count() or 1))
+            if workers <= 1:
+                return None
+            # spawn avoids forking a process that already runs request and job threads
+            _encode_pool = ProcessPoolExecutor(max_workers=workers,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return _encode_pool
+
+def discard_encode_pool(pool):
+    """Drop a broken encode pool, e.g. after a worker was OOM-killed, so the next call starts a new one"""
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is pool:
+            _encode_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def encode_variant(mode, size, pixels, width, max_file_size, formats=None):
+    """Resize raw pixels to width and encode under max_file_size (runs in the encode pool)
+    
+    formats names the encoders to choose from; by default every configured one.
+    """
+    processor = ImageProcessor()
+    processor.max_file_size = max_file_size
+    if formats:
+        processor.encoders = available_encoders(formats)
+    img = Image.frombytes(mode, size, pixels)
+    img = processor.resize_image(img, max_width=width)
+    return processor.encode_to_budget(img)
+
 class ImageProcessor:
-    def __init__(self):
-        self.upload_dir = 'static/uploads'
+    def __init__(self, formats=None):
+        self.store = upload_store
         self.max_file_size = 100 * 1024  # 100KB
-        self.ensure_upload_dir()
+        self.encoders = available_encoders(formats)
+        # Formats after the first are only tried while the image has spent less than this
+        self.format_time_budget = float(os.environ.get('IMAGE_FORMAT_TIME_BUDGET', 2.0))
+        self.max_encodes_per_size = 4
+        self.min_width = 320
+        self.max_width = 1200  # widest image we publish
+        self.crop_aspect = configured_aspect()  # width / height, or None to keep the whole frame
+        self.variant_widths = VARIANT_WIDTHS
+        self.max_download_bytes = int(os.environ.get('IMAGE_MAX_DOWNLOAD_BYTES', 20 * 1024 * 1024))
+        self.max_source_pixels = 50 * 1000 * 1000
+        self.download_spool_bytes = 1024 * 1024
+        self.encode_seconds = []  # (format, duration) of every encode attempt by this instance
     
-    def ensure_upload_dir(self):
-        """Ensure upload directory exists"""
-        if not os.path.exists(self.upload_dir):
-            os.makedirs(self.upload_dir, exist_ok=True)
+    def download_image(self, image_url):
+        """Stream an image into a spooled temp file, refusing bodies over max_download_bytes"""
+        try:
+            with transport.get(image_url, stream=True, timeout=15) as response:
+                if response.status_code != 200:
+                    logger.error(f"Failed to download image: {response.status_code}")
+                    return None
+                
+                content_length = int(response.headers.get('Content-Length') or 0)
+                if content_length > self.max_download_bytes:
+                    logger.error(f"Image too large to download: {content_length} bytes")
+                    return None
+                
+                # Small bodies stay in memory, larger ones spill to disk
+                source = tempfile.SpooledTemporaryFile(max_size=self.download_spool_bytes)
+                received = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    if received > self.max_download_bytes:
+                        source.close()
+                        logger.error(f"Image exceeded {self.max_download_bytes} bytes while downloading")
+                        return None
+                    source.write(chunk)
+                
+                source.seek(0)
+                return source
+        
+        except Exception as e:
+            logger.error(f"Error downloading image: {e}")
+            return None
     
-    def process_image(self, image_url, author=None, alt_text=None):
-        """Download, compress, and convert image to WebP"""
+    def open_image(self, source):
+        """Decode an image no larger than needed for max_width, cropped to crop_aspect, as RGB"""
         try:
-            # Download image
-            response = requests.get(image_url, timeout=15)
-            if response.status_code != 200:
-                logger.error(f"Failed to download image: {response.status_code}")
+            img = Image.open(source)
+            
+            # Image.open only reads the header, so reject oversized sources before decoding
+            if img.width * img.height > self.max_source_pixels:
+                logger.error(f"Image has too many pixels: {img.width}x{img.height}")
                 return None
             
-            # Open image with PIL
-            img = Image.open(io.BytesIO(response.content))
+            # The crop keeps only part of the width, so decode wide enough for it to reach max_width
+            keep_width, _ = crop_fraction(img.size, self.crop_aspect)
+            target_width = math.ceil(self.max_width / keep_width)
+            if img.width > target_width:
+                # JPEGs decode straight at a reduced DCT scale no smaller than the target
+                target_height = max(1, round(img.height * target_width / img.width))
+                img.draft('RGB', (target_width, target_height))
             
-            # Convert to RGB if necessary
-            if img.mode in ('RGBA', 'LA', 'P'):
+            # Convert to RGB if necessary (palette images cannot be resampled smoothly)
+            if img.mode != 'RGB':
                 img = img.convert('RGB')
             
-            # Generate filename
-            url_hash = hashlib.md5(image_url.encode()).hexdigest()[:8]
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"img_{timestamp}_{url_hash}.webp"
-            filepath = os.path.join(self.upload_dir, filename)
-            
-            # Compress and save as WebP
-            quality = 85
-            while quality > 10:
-                # Save to bytes buffer first to check size
-                buffer = io.BytesIO()
-                img.save(buffer, format='WEBP', quality=quality, optimize=True)
-                
-                if buffer.tell() <= self.max_file_size:
-                    # Size is acceptable, save to file
-                    with open(filepath, 'wb') as f:
-                        f.write(buffer.getvalue())
-                    break
-                
-                # Reduce quality and try again
-                quality -= 10
+            # Spend the byte budget only on the part of the frame the theme shows
+            with telemetry.span('image_crop'):
+                img = smart_crop(img, self.crop_aspect)
             
-            if not os.path.exists(filepath):
-                logger.error("Failed to compress image within size limit")
+            img = self.resize_image(img, max_width=self.max_width)
+            
+            # Finish decoding before the caller closes the source file
+            img.load()
+            return img
+        
+        except Exception as e:
+            logger.error(f"Error decoding image: {e}")
+            return None
+    
+    def cache_key(self, image_url):
+        """Digest of the source URL and every parameter that affects the output"""
+        widths = ','.join(str(width) for width in self.variant_widths)
+        crop = f"{self.crop_aspect:.4f}" if self.crop_aspect else 'full'
+        formats = ','.join(encoder.name for encoder in self.encoders)
+        params = f"{image_url}|{formats}|{self.max_file_size}|{self.max_width}|{widths}|{crop}|v{ENCODER_VERSION}"
+        return hashlib.sha256(params.encode()).hexdigest()
+    
+    def get_cached(self, cache_key, author=None, alt_text=None):
+        """Return a previously processed image for this cache key, if its file still exists"""
+        try:
+            from app import db
+            from models import ProcessedImage
+            
+            record = (ProcessedImage.query
+                      .filter_by(cache_key=cache_key)
+                      .order_by(ProcessedImage.id.desc())
+                      .first())
+            if record is None:
                 return None
             
-            file_size = os.path.getsize(filepath)
-            relative_path = f"/static/uploads/{filename}"
+            filepath = self.store.path_for_url(record.processed_url)
+            variants = json.loads(record.variants) if record.variants else []
+            if not filepath or not all(os.path.exists(path) for path in [filepath] + [v['file_path'] for v in variants]):
+                return None
             
-            logger.info(f"Processed image: {relative_path} ({file_size} bytes)")
+            record.last_accessed = datetime.utcnow()
+            db.session.commit()
             
+            logger.info(f"Cache hit for image: {record.processed_url}")
             return {
-                'url': relative_path,
+                'url': record.processed_url,
                 'file_path': filepath,
-                'filename': filename,
-                'file_size': file_size,
+                'filename': variants[-1]['filename'] if variants else os.path.basename(filepath),
+                'file_size': record.file_size,
+                'variants': variants,
+                'phash': record.phash,
+                'format': record.format or 'webp',
                 'author': author,
-                'alt_text': alt_text
+                'alt_text': alt_text,
+                'cached': True
             }
+        
+        except Exception as e:
+            logger.warning(f"Image cache lookup failed: {e}")
+            return None
+    
+    def record_processed(self, cache_key, image_url, result):
+        """Index a newly processed image in the ProcessedImage table"""
+        try:
+            from app import db
+            from models import ProcessedImage
             
+            db.session.add(ProcessedImage(
+                original_url=image_url,
+                processed_url=result['url'],
+                author=result['author'],
+                alt_text=result['alt_text'],
+                file_size=result['file_size'],
+                cache_key=cache_key,
+                variants=json.dumps(result['variants']),
+                phash=result['phash'],
+                format=result['format'],
+                format_stats=json.dumps(result['format_stats'])
+            ))
+            db.session.commit()
+        
+        except Exception as e:
+            logger.warning(f"Failed to record processed image: {e}")
+    
+    def process_image(self, image_url, author=None, alt_text=None):
+        """Download, compress, and encode an image in the format that looks best within budget"""
+        try:
+            cache_key = self.cache_key(image_url)
+            cached = self.get_cached(cache_key, author, alt_text)
+            if cached:
+                return cached
+            
+            # Download image
+            with telemetry.span('image_download'):
+                source = self.download_image(image_url)
+            if source is None:
+                return None
+            
+            # Decode at (or near) the published size
+            with source, telemetry.span('image_decode'):
+                img = self.open_image(source)
+            if img is None:
+                return None
+            
+            # Fingerprint the source so near-duplicates can reuse uploaded media
+            with telemetry.span('image_hash'):
+                phash = perceptual_hash(img)
+            
+            # Encode every responsive width from the single decode
+            variants = self.encode_variants(img, cache_key)
+            if not variants:
+                logger.error("Failed to compress image within size limit")
+                return None
+            
+            largest = variants[-1]
+            format_stats = largest.pop('format_stats', {})
+            logger.info(f"Processed image: {largest['url']} ({largest['format']}, {largest['file_size']} bytes, "
+                        f"{len(variants)} widths)")
+            
+            result = {
+                'url': largest['url'],
+                'file_path': largest['file_path'],
+                'filename': largest['filename'],
+                'file_size': largest['file_size'],
+                'variants': variants,
+                'phash': phash,
+                'format': largest['format'],
+                'format_stats': format_stats,
+                'author': author,
+                'alt_text': alt_text,
+                'cached': False
+            }
+            
+            self.record_processed(cache_key, image_url, result)
+            if has_app_context():
+                self.store.collect_if_due(current_app._get_current_object())
+            
+            return result
+        
         except Exception as e:
             logger.error(f"Error processing image: {e}")
             return None
     
+    def encode_variants(self, img, cache_key):
+        """Encode and save each responsive width, in parallel when an encode pool is available"""
+        widths = sorted({width for width in self.variant_widths if width < img.width} | {img.width})
+        
+        # Narrower variants get a proportionally smaller share of the size budget
+        tasks = [(img.mode, img.size, img.tobytes(), width,
+                  int(self.max_file_size * width / img.width)) for width in widths]
+        
+        def run(batch, formats):
+            batch = [task + (formats,) for task in batch]
+            for attempt in range(2):
+                pool = get_encode_pool()
+                if not pool:
+                    break
+                try:
+                    return list(pool.map(encode_variant, *zip(*batch)))
+                except BrokenProcessPool:
+                    # Every later encode would fail on this pool too; retry once on a new one
+                    logger.warning("Encode pool process died, starting a new pool")
+                    discard_encode_pool(pool)
+                    if attempt:
+                        raise
+            return [encode_variant(*task) for task in batch]
+        
+        formats = [encoder.name for encoder in self.encoders]
+        with telemetry.span('image_encode'):
+            if len(formats) > 1:
+                # Choose the format on the widest variant so the whole srcset shares it
+                widest = run(tasks[-1:], formats)
+                encoded = run(tasks[:-1], [widest[0]['format']]) + widest if widest[0] else widest
+            else:
+                encoded = run(tasks, formats)
+        
+        # Attempts may have run in pool processes, so their timings come back with the result
+        for result in encoded:
+            for name, seconds in (result or {}).get('encode_seconds', ()):
+                telemetry.observe(f"{name}_encode", seconds)
+        
+        variants = []
+        if len(encoded) < len(widths):
+            return None
+        for width, result in zip(widths, encoded):
+            if result is None:
+                return None
+            
+            # Files are stored by content hash; the name is what WordPress shows for the upload
+            extension = result['extension']
+            if width == img.width:
+                filename = f"img_{cache_key[:16]}{extension}"
+            else:
+                filename = f"img_{cache_key[:16]}_{width}w{extension}"
+            stored = self.store.put(result['data'], extension)
+            
+            logger.debug(f"Encoded {filename}: quality {result['quality']}, {result['encodes']} encodes")
+            variants.append({
+                'width': result['width'],
+                'height': result['height'],
+                'url': stored['url'],
+                'file_path': stored['file_path'],
+                'filename': filename,
+                'file_size': result['size'],
+                'format': result['format'],
+                'mime_type': result['mime_type']
+            })
+        # What every tried format scored on the widest variant, for ProcessedImage.format_stats
+        variants[-1]['format_stats'] = encoded[-1]['candidates']
+        
+        return variants
+    
+    def encode(self, img, quality, encoder):
+        """Encode an image in encoder's format at the given quality"""
+        start = time.perf_counter()
+        data = encoder.encode(img, quality)
+        self.encode_seconds.append((encoder.name, time.perf_counter() - start))
+        return data
+    
+    def predict_quality(self, pixels, encoder):
+        """Predict a starting quality from the byte budget per pixel and earlier results"""
+        budget_bpp = self.max_file_size * 8 / pixels
+        
+        # A typical photo needs reference_bpp bits per pixel at quality 85
+        quality = 85 + 20 * math.log2(budget_bpp / encoder.reference_bpp)
+        
+        similar = sorted(q for bpp, q in quality_history[encoder.name] if 0.67 <= bpp / budget_bpp <= 1.5)
+        if len(similar) >= 5:
+            quality = (quality + similar[len(similar) // 2]) / 2
+        
+        return int(min(encoder.max_quality, max(encoder.min_quality, quality)))
+    
+    def search_quality(self, img, encoder, quality=None):
+        """Bisect quality for the largest encode that fits the size budget
+        
+        Returns the best fitting (quality, size, data), or None together with
+        the estimated size at min_quality so the caller can pick a downscale.
+        """
+        target = self.max_file_size * 0.95
+        lo, hi = encoder.min_quality, encoder.max_quality
+        if quality is None:
+            quality = self.predict_quality(img.width * img.height, encoder)
+        fit = None
+        over = None
+        encodes = 0
+        
+        while encodes < self.max_encodes_per_size:
+            data = self.encode(img, quality, encoder)
+            size = len(data)
+            encodes += 1
+            
+            if size <= self.max_file_size:
+                fit = (quality, size, data)
+                lo = quality + 1
+            else:
+                over = (quality, size)
+                hi = quality - 1
+            
+            # Size grows roughly exponentially with quality, so interpolate in log space
+            if fit and over:
+                slope = (math.log(over[1]) - math.log(fit[1])) / max(1, over[0] - fit[0])
+            else:
+                slope = 0.02
+            slope = max(slope, 0.005)
+            
+            # Close enough to the budget, or too few qualities left to matter
+            if fit and (fit[1] >= self.max_file_size * 0.9 or hi - lo < 3):
+                break
+            if lo > hi:
+                break
+            
+            estimate = quality + math.log(target / size) / slope
+            if not fit and estimate < encoder.min_quality - 5:
+                # Even the lowest quality will not fit, so stop encoding at this size
+                break
+            quality = min(hi, max(lo, round(estimate)))
+        
+        if fit:
+            return fit, None, encodes
+        return None, size * math.exp(slope * (encoder.min_quality - quality)), encodes
+    
+    def choose_format(self, img, fits):
+        """The (encoder, fit) to publish and the quality, bytes and SSIM of every candidate
+        
+        Every fit is under budget, so the highest SSIM wins; formats within
+        SSIM_TOLERANCE of it are close enough that the smallest one is used.
+        """
+        if len(fits) == 1:
+            encoder, (quality, size, _) = fits[0]
+            return fits[0], {encoder.name: {'quality': quality, 'size': size}}
+        
+        reference = gray_copy(img)
+        scored = [(ssim(reference, fit[2]), encoder, fit) for encoder, fit in fits]
+        best = max(score for score, _, _ in scored)
+        score, encoder, fit = min((item for item in scored if item[0] >= best - SSIM_TOLERANCE),
+                                  key=lambda item: item[2][1])
+        candidates = {candidate.name: {'quality': quality, 'size': size, 'ssim': round(value, 4)}
+                      for value, candidate, (quality, size, _) in scored}
+        return (encoder, fit), candidates
+    
+    def encode_to_budget(self, img):
+        """Encode under max_file_size in the best of self.encoders, downscaling when none fits"""
+        started = time.perf_counter()
+        encodes = 0
+        downscaled = False
+        while True:
+            fits = []
+            min_quality_size = None
+            for position, encoder in enumerate(self.encoders):
+                if position and time.perf_counter() - started > self.format_time_budget:
+                    logger.debug(f"Format time budget spent, skipping {encoder.name} and later formats")
+                    break
+                start_quality = encoder.min_quality + 5 if downscaled else None
+                fit, estimate, attempts = self.search_quality(img, encoder, start_quality)
+                encodes += attempts
+                if fit:
+                    fits.append((encoder, fit))
+                elif min_quality_size is None or estimate < min_quality_size:
+                    min_quality_size = estimate
+            
+            if fits:
+                budget_bpp = self.max_file_size * 8 / (img.width * img.height)
+                for candidate, fit in fits:
+                    quality_history[candidate.name].append((budget_bpp, fit[0]))
+                (encoder, (quality, size, data)), candidates = self.choose_format(img, fits)
+                return {
+                    'data': data,
+                    'quality': quality,
+                    'size': size,
+                    'format': encoder.name,
+                    'mime_type': encoder.mime_type,
+                    'extension': encoder.extension,
+                    'candidates': candidates,
+                    'encodes': encodes,
+                    'encode_seconds': list(self.encode_seconds),
+                    'width': img.width,
+                    'height': img.height
+                }
+            
+            if img.width <= self.min_width:
+                return None
+            
+            # Shrink the area by the ratio the lowest quality is expected to miss by
+            # (detail gets denser as the image shrinks, hence the extra margin)
+            scale = math.sqrt(self.max_file_size / min_quality_size) * 0.9
+            scale = min(0.9, max(0.3, scale))
+            max_width = max(self.min_width, int(img.width * scale))
+            logger.debug(f"No quality fits at {img.width}px wide, downscaling to {max_width}px")
+            img = self.resize_image(img, max_width=max_width)
+            # The new size was chosen so a low quality fits, so start the search there
+            downscaled = True
+    
     def resize_image(self, img, max_width=1200):
         """Resize image while maintaining aspect ratio"""
         width, height = img.size
@@ -86,6 +500,7 @@ class ImageProcessor:
         if width > max_width:
             ratio = max_width / width
             new_height = int(height * ratio)
-            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+            # reducing_gap lets Pillow shrink by whole factors with reduce() before resampling
+            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
         
         return img
@@ -0,0 +1,277 @@
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from telemetry import profiled
+
+logger = logging.getLogger(__name__)
+
+class JobQueue:
+    """Runs image processing and WordPress uploads on a local thread pool.
+
+    Job state lives in the ImageJob table so any worker process can answer
+    status requests; execution happens in the process that accepted the job.
+    That process touches heartbeat_at on its jobs while they are pending, so
+    jobs orphaned by a restart are noticed once the heartbeat goes stale and
+    are taken over (or failed, when out of retries) by the next submit.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        self.max_depth = 50
+        self.max_retries = 2
+        self.heartbeat_seconds = 30
+        self.stale_seconds = 120
+        self._lock = threading.Lock()
+        self._active = set()
+        self._heartbeat = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_depth = app.config.get("JOB_QUEUE_DEPTH", self.max_depth)
+        self.max_retries = app.config.get("JOB_MAX_RETRIES", self.max_retries)
+        self.heartbeat_seconds = app.config.get("JOB_HEARTBEAT_SECONDS", self.heartbeat_seconds)
+        self.stale_seconds = app.config.get("JOB_STALE_SECONDS", self.stale_seconds)
+        self.executor = ThreadPoolExecutor(max_workers=app.config.get("JOB_WORKERS", 2),
+                                           thread_name_prefix="image-job")
+
+    def submit(self, image_url, author=None, alt_text=None, wp_connection_id=None, alt_context=None):
+        """Queue an image job, or return None when the queue is full"""
+        from app import db
+        from models import ImageJob
+
+        with self._lock:
+            self._recover_stale()
+            pending = ImageJob.query.filter(ImageJob.status.in_(('queued', 'running'))).count()
+            if pending >= self.max_depth:
+                logger.warning(f"Job queue full ({pending} pending)")
+                return None
+
+            job = ImageJob(
+                image_url=image_url,
+                author=author,
+                alt_text=alt_text,
+                alt_context=alt_context,
+                wp_connection_id=wp_connection_id,
+                status='queued',
+                stage='queued',
+                heartbeat_at=datetime.utcnow()
+            )
+            db.session.add(job)
+            db.session.commit()
+            self._start(job.id)
+
+        return job
+
+    def _start(self, job_id):
+        """Run a job here and keep its heartbeat fresh until it finishes (caller holds _lock)"""
+        self._active.add(job_id)
+        if self._heartbeat is None or not self._heartbeat.is_alive():
+            # Started on first use so each forked worker process gets its own thread
+            self._heartbeat = threading.Thread(target=self._beat, name="image-job-heartbeat", daemon=True)
+            self._heartbeat.start()
+        # Carry the request ID (and any profiling request) into the worker thread
+        self.executor.submit(contextvars.copy_context().run, self._run, job_id)
+
+    def _beat(self):
+        from app import db
+        from models import ImageJob
+
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            try:
+                with self.app.app_context():
+                    (ImageJob.query.filter(ImageJob.id.in_(active))
+                     .update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False))
+                    db.session.commit()
+            except Exception as e:
+                logger.warning(f"Image job heartbeat failed: {e}")
+
+    def _recover_stale(self):
+        """Take over pending jobs whose process stopped heartbeating, or fail them once out of retries"""
+        from app import db
+        from models import ImageJob
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        stale_filter = (ImageJob.status.in_(('queued', 'running')),
+                        db.func.coalesce(ImageJob.heartbeat_at, ImageJob.created_at) < cutoff)
+        for job in ImageJob.query.filter(*stale_filter).all():
+            exhausted = (job.attempts or 0) > self.max_retries
+            changes = {'heartbeat_at': datetime.utcnow()}
+            if exhausted:
+                changes.update(status='failed', stage='failed', finished_at=datetime.utcnow(),
+                               error='The worker running this job stopped')
+            else:
+                changes.update(status='queued', stage='queued')
+            # The stale condition is re-checked in the UPDATE, so only one process claims each job
+            claimed = (ImageJob.query.filter(ImageJob.id == job.id, *stale_filter)
+                       .update(changes, synchronize_session=False))
+            db.session.commit()
+            if claimed and not exhausted:
+                logger.warning(f"Image job {job.id} was orphaned by a stopped worker, running it again")
+                self._start(job.id)
+            elif claimed:
+                logger.warning(f"Image job {job.id} was orphaned by a stopped worker and is out of retries")
+
+    def _run(self, job_id):
+        try:
+            self._execute(job_id)
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _execute(self, job_id):
+        with self.app.app_context():
+            from app import db
+            from models import ImageJob
+
+            job = db.session.get(ImageJob, job_id)
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            db.session.commit()
+
+            while True:
+                job.attempts = (job.attempts or 0) + 1
+                db.session.commit()
+                try:
+                    with profiled(f"image-job-{job.id}"):
+                        result = self._process(job)
+                    job.status = 'done'
+                    job.stage = 'done'
+                    job.result = json.dumps(result)
+                    job.error = None
+                    break
+                except Exception as e:
+                    logger.error(f"Image job {job.id} attempt {job.attempts} failed: {e}")
+                    job.error = str(e)
+                    if job.attempts > self.max_retries:
+                        job.status = 'failed'
+                        job.stage = 'failed'
+                        break
+                    job.stage = 'retrying'
+                    db.session.commit()
+                    # Jittered exponential backoff before the next attempt
+                    time.sleep(2 ** job.attempts * random.uniform(0.5, 1.0))
+
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+
+    def _process(self, job):
+        from app import db
+        from models import WordPressConnection
+        from image_processor import ImageProcessor
+        from wordpress_client import WordPressClient
+
+        if not job.alt_text and job.alt_context:
+            from gemini_client import GeminiClient
+
+            job.stage = 'describing'
+            db.session.commit()
+            # Optional: without alt text the image is still processed and uploaded
+            job.alt_text = GeminiClient().generate_alt_text(job.image_url, job.alt_context)
+
+        job.stage = 'processing'
+        db.session.commit()
+        processed = ImageProcessor().process_image(job.image_url, job.author, job.alt_text)
+        if not processed:
+            raise RuntimeError('Failed to process image')
+
+        result = {
+            'processed_url': processed['url'],
+            'file_size': processed['file_size'],
+            'attribution': f"Photo by {job.author} on Pexels" if job.author else '',
+            'alt_text': job.alt_text,
+            'media_id': None
+        }
+
+        wp_conn = db.session.get(WordPressConnection, job.wp_connection_id) if job.wp_connection_id else None
+        wp_client = None
+        if wp_conn:
+            job.stage = 'uploading'
+            db.session.commit()
+            wp_client = WordPressClient(wp_conn.site_url, wp_conn.username, wp_conn.app_password)
+
+        result.update(publish_variants(processed, wp_client, job.wp_connection_id,
+                                       source={'image_url': job.image_url, 'author': job.author,
+                                               'alt_text': job.alt_text}))
+        return result
+
+def upload_variants(processed, wp_client):
+    """Upload every variant; returns (media, width) pairs, or None when the site rejected one
+
+    Variants already uploaded when one fails are deleted again, so retries
+    do not leave orphaned attachments in the media library.
+    """
+    sources = []
+    for variant in processed['variants']:
+        media = wp_client.upload_media(variant['file_path'], variant['filename'],
+                                       variant.get('mime_type', 'image/webp'))
+        if not media:
+            for uploaded, _ in sources:
+                if not wp_client.delete_media(uploaded['id']):
+                    logger.warning(f"Media {uploaded['id']} is orphaned by a failed upload")
+            return None
+        sources.append((media, variant['width']))
+    return sources
+
+def publish_variants(processed, wp_client=None, wp_connection_id=None, source=None):
+    """Upload every responsive variant to WordPress (when a client is given) and build the srcset
+
+    With a wp_connection_id, a near-duplicate of media already uploaded to
+    the client's site, over any connection, is reused instead of uploading the image again. source, when
+    given, is a dict of the image_url, author and alt_text the image was
+    processed from; if the site rejects an upload in another format (WordPress before
+    6.5 has no AVIF), the image is encoded again as WebP and uploaded once more.
+    """
+    phash = None
+    if wp_client and wp_connection_id:
+        from media_index import media_index
+
+        phash = media_index.image_hash(processed)
+        reused = media_index.find_uploaded(phash, wp_client)
+        if reused:
+            return reused
+
+    if wp_client:
+        sources = upload_variants(processed, wp_client)
+        fmt = processed['variants'][-1].get('format', 'webp')
+        if sources is None and source is not None and fmt != 'webp':
+            from image_processor import ImageProcessor
+
+            logger.warning(f"Upload of {fmt} image was rejected, retrying as WebP")
+            processed = ImageProcessor(formats=['webp']).process_image(source['image_url'], source['author'],
+                                                                       source['alt_text'])
+            sources = upload_variants(processed, wp_client) if processed else None
+        if sources is None:
+            raise RuntimeError('Failed to upload image to WordPress')
+        # The widest variant is the main attachment
+        media, _ = sources[-1]
+        media_id = media['id']
+    else:
+        sources = [({'url': v['url']}, v['width']) for v in processed['variants']]
+        media_id = None
+
+    widest = sources[-1][1]
+    published = {
+        'processed_url': sources[-1][0]['url'],
+        'media_id': media_id,
+        'srcset': ', '.join(f"{media['url']} {width}w" for media, width in sources),
+        'sizes': f"(max-width: {widest}px) 100vw, {widest}px"
+    }
+    if phash:
+        media_index.remember(wp_connection_id, wp_client.site_url, phash, published)
+    return published
+
+job_queue = JobQueue()
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import threading
+from array import array
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+def site_key(site_url):
+    """Host and path of a WordPress site, lowercased and without the scheme or trailing slash"""
+    parts = urlsplit(site_url.strip() if '//' in site_url else f"//{site_url.strip()}")
+    return f"{parts.netloc.lower()}{parts.path.rstrip('/')}"
+
+def perceptual_hash(img):
+    """64-bit difference hash as 16 hex digits
+
+    Each bit says whether a cell of a 9x8 grayscale thumbnail is brighter
+    than its right-hand neighbour, so re-encodes and resized copies of a
+    photo land within a few bits of each other.
+    """
+    gray = img.convert('L').resize((9, 8), Image.Resampling.BOX, reducing_gap=2.0)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return np.packbits(bits).tobytes().hex()
+
+def file_hash(file_path):
+    """Perceptual hash of an image file, or None when it cannot be read"""
+    try:
+        with Image.open(file_path) as img:
+            return perceptual_hash(img)
+    except Exception as e:
+        logger.warning(f"Could not hash {file_path}: {e}")
+        return None
+
+class MultiIndexHash:
+    """Hamming-distance search over 64-bit hashes using one table per 16-bit range
+
+    When two hashes differ in at most max_distance bits, at least one of the
+    four ranges differs in at most max_distance // 4 bits. A search therefore
+    probes each table with every value that close to the query's range, and
+    compares only the entries found there in full. Each table holds about
+    N / 65536 entries per value. Entries are stored in typed arrays, roughly
+    40 bytes each, so hundreds of thousands of entries per site fit easily.
+    """
+
+    RANGES = 4
+    RANGE_BITS = HASH_BITS // RANGES
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.probes = self._probes(max_distance // self.RANGES)
+        self.tables = [{} for _ in range(self.RANGES)]
+        self.hashes = array('Q')
+        self.values = array('q')
+
+    def _probes(self, radius):
+        """XOR masks for every 16-bit value within radius bits"""
+        masks = [0]
+        for _ in range(radius):
+            masks = sorted(set(masks) | {mask | (1 << bit) for mask in masks for bit in range(self.RANGE_BITS)})
+        return masks
+
+    def _keys(self, value_hash):
+        mask = (1 << self.RANGE_BITS) - 1
+        return [(value_hash >> (part * self.RANGE_BITS)) & mask for part in range(self.RANGES)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, value_hash, value):
+        position = len(self.hashes)
+        self.hashes.append(value_hash)
+        self.values.append(value)
+        for table, key in zip(self.tables, self._keys(value_hash)):
+            bucket = table.get(key)
+            if bucket is None:
+                bucket = table[key] = array('I')
+            bucket.append(position)
+
+    def search(self, query):
+        """(distance, value) for every entry within max_distance bits of query, nearest first"""
+        candidates = set()
+        for table, key in zip(self.tables, self._keys(query)):
+            for probe in self.probes:
+                bucket = table.get(key ^ probe)
+                if bucket:
+                    candidates.update(bucket)
+
+        matches = []
+        for position in candidates:
+            distance = (self.hashes[position] ^ query).bit_count()
+            if distance <= self.max_distance:
+                matches.append((distance, self.values[position]))
+        return sorted(matches)
+
+class MediaIndex:
+    """Perceptual hashes of media already uploaded to each WordPress site
+
+    Fingerprints live in the MediaFingerprint table; each process keeps a
+    MultiIndexHash per site and loads rows added since its last lookup,
+    so uploads made by other workers are found as well. Sites are keyed by
+    site_key() rather than connection, since every login to /connect
+    creates a new WordPressConnection for the same site.
+    """
+
+    def __init__(self, max_distance=None):
+        if max_distance is None:
+            max_distance = int(os.environ.get('MEDIA_DEDUPE_DISTANCE', 6))
+        self.max_distance = max_distance
+        self._indexes = {}  # site_key -> (MultiIndexHash, highest MediaFingerprint id loaded)
+        self._backfilled = False
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'stored': 0}
+
+    @property
+    def enabled(self):
+        return self.max_distance >= 0
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _backfill(self):
+        """Set the site of fingerprints recorded before they had one, once per process"""
+        from app import db
+        from models import MediaFingerprint, WordPressConnection
+
+        if self._backfilled:
+            return
+        connection_ids = [row[0] for row in (MediaFingerprint.query
+                                             .with_entities(MediaFingerprint.wp_connection_id)
+                                             .filter(MediaFingerprint.site.is_(None))
+                                             .distinct())]
+        for wp_conn in WordPressConnection.query.filter(WordPressConnection.id.in_(connection_ids)):
+            (MediaFingerprint.query
+             .filter(MediaFingerprint.wp_connection_id == wp_conn.id, MediaFingerprint.site.is_(None))
+             .update({'site': site_key(wp_conn.site_url)}, synchronize_session=False))
+        db.session.commit()
+        self._backfilled = True
+
+    def _refresh(self, site):
+        from models import MediaFingerprint
+
+        self._backfill()
+        index, last_id = self._indexes.get(site) or (MultiIndexHash(self.max_distance), 0)
+        rows = (MediaFingerprint.query
+                .with_entities(MediaFingerprint.id, MediaFingerprint.phash)
+                .filter(MediaFingerprint.site == site,
+                        MediaFingerprint.id > last_id)
+                .order_by(MediaFingerprint.id)
+                .all())
+        for row_id, phash in rows:
+            index.add(int(phash, 16), row_id)
+        if rows:
+            last_id = rows[-1][0]
+        self._indexes[site] = (index, last_id)
+        return index
+
+    def image_hash(self, processed):
+        """The processed image's perceptual hash, computed from its widest file if it has none"""
+        return processed.get('phash') or file_hash(processed['variants'][-1]['file_path'])
+
+    def find_uploaded(self, phash, wp_client):
+        """Publish result of a near-duplicate already in wp_client's site media library, or None"""
+        if not self.enabled or not phash:
+            return None
+
+        try:
+            from app import db
+            from models import MediaFingerprint
+
+            with self._lock:
+                matches = self._refresh(site_key(wp_client.site_url)).search(int(phash, 16))
+
+            for distance, row_id in matches:
+                record = db.session.get(MediaFingerprint, row_id)
+                if record is None:
+                    continue
+                exists = wp_client.media_exists(record.media_id)
+                if exists is False:
+                    # Deleted from the media library since it was uploaded
+                    logger.info(f"Media {record.media_id} is gone, forgetting its fingerprint")
+                    db.session.delete(record)
+                    db.session.commit()
+                    self._count('stale')
+                    continue
+                if exists is None:
+                    break
+                self._count('hits')
+                logger.info(f"Reusing media {record.media_id} ({distance} bits from {phash})")
+                return dict(json.loads(record.published), reused=True)
+
+        except Exception as e:
+            logger.warning(f"Media index lookup failed: {e}")
+
+        self._count('misses')
+        return None
+
+    def remember(self, wp_connection_id, site_url, phash, published):
+        """Record media just uploaded to the site"""
+        if not self.enabled or not phash or not published.get('media_id'):
+            return
+
+        try:
+            from app import db
+            from models import MediaFingerprint
+
+            db.session.add(MediaFingerprint(
+                wp_connection_id=wp_connection_id,
+                site=site_key(site_url),
+                phash=phash,
+                media_id=published['media_id'],
+                published=json.dumps(published)
+            ))
+            db.session.commit()
+            self._count('stored')
+
+        except Exception as e:
+            logger.warning(f"Failed to record media fingerprint: {e}")
+
+media_index = MediaIndex()
@@ -7,25 +7,70 @@ class WordPressConnection(db.Model):
     username = db.Column(db.String(100), nullable=False)
     app_password = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    posts_synced_at = db.Column(db.DateTime)
+    posts_full_synced_at = db.Column(db.DateTime)
     
     def __repr__(self):
         return f'<WordPressConnection {self.site_url}>'
 
 class BlogPost(db.Model):
+    __table_args__ = (
+        db.Index('ix_blog_post_connection_wp_id', 'wp_connection_id', 'wp_id', unique=True),
+        db.Index('ix_blog_post_connection_status_date', 'wp_connection_id', 'status', 'date'),
+        db.Index('ix_blog_post_connection_modified', 'wp_connection_id', 'modified'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     wp_id = db.Column(db.Integer, nullable=False)
     title = db.Column(db.Text, nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    content = db.Column(db.Text, nullable=False, default='')  # fetched lazily when the post is opened
     status = db.Column(db.String(20), nullable=False)
     featured_image_url = db.Column(db.String(500))
     wp_connection_id = db.Column(db.Integer, db.ForeignKey('word_press_connection.id'), nullable=False)
     last_synced = db.Column(db.DateTime, default=datetime.utcnow)
+    excerpt = db.Column(db.Text)
+    link = db.Column(db.String(500))
+    featured_media = db.Column(db.Integer)
+    # Site-local ISO 8601 timestamps exactly as the REST API returns them
+    date = db.Column(db.String(30))
+    modified = db.Column(db.String(30))
+    # The modified timestamp and ETag the cached content was fetched at
+    content_modified = db.Column(db.String(30))
+    content_etag = db.Column(db.String(255))
     
     wp_connection = db.relationship('WordPressConnection', backref=db.backref('posts', lazy=True))
     
+    def to_dict(self):
+        return {
+            'id': self.wp_id,
+            'title': self.title,
+            'excerpt': self.excerpt or '',
+            'content': self.content,
+            'status': self.status,
+            'date': self.date or '',
+            'modified': self.modified or '',
+            'link': self.link,
+            'featured_media': self.featured_media or 0
+        }
+    
     def __repr__(self):
         return f'<BlogPost {self.title}>'
 
+class PostRevision(db.Model):
+    __table_args__ = (
+        db.Index('ix_post_revision_connection_wp_id_modified', 'wp_connection_id', 'wp_id', 'modified', unique=True),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    wp_connection_id = db.Column(db.Integer, db.ForeignKey('word_press_connection.id'), nullable=False)
+    wp_id = db.Column(db.Integer, nullable=False)
+    modified = db.Column(db.String(30), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<PostRevision {self.wp_id} {self.modified}>'
+
 class ProcessedImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     original_url = db.Column(db.String(500), nullable=False)
@@ -33,7 +78,105 @@ class ProcessedImage(db.Model):
     author = db.Column(db.String(255))
     alt_text = db.Column(db.Text)
     file_size = db.Column(db.Integer)
+    cache_key = db.Column(db.String(64), index=True)
+    variants = db.Column(db.Text)  # JSON list of responsive widths and their files
+    phash = db.Column(db.String(16))  # perceptual hash of the source image, see media_index.py
+    format = db.Column(db.String(10))  # output format chosen for every variant, see encoders.py
+    format_stats = db.Column(db.Text)  # JSON quality, bytes and SSIM of each format tried on the widest variant
+    last_accessed = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
         return f'<ProcessedImage {self.original_url}>'
+
+class MediaFingerprint(db.Model):
+    __table_args__ = (
+        db.Index('ix_media_fingerprint_connection_id', 'wp_connection_id', 'id'),
+        db.Index('ix_media_fingerprint_site_id', 'site', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    wp_connection_id = db.Column(db.Integer, db.ForeignKey('word_press_connection.id'), nullable=False)
+    site = db.Column(db.String(255))  # media_index.site_key() of the connection's site_url
+    phash = db.Column(db.String(16), nullable=False)
+    media_id = db.Column(db.Integer, nullable=False)
+    published = db.Column(db.Text, nullable=False)  # JSON media ID, URL and srcset as publish_variants returned them
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<MediaFingerprint {self.wp_connection_id}:{self.media_id} {self.phash}>'
+
+class ImageJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    stage = db.Column(db.String(50))
+    image_url = db.Column(db.String(500), nullable=False)
+    author = db.Column(db.String(255))
+    alt_text = db.Column(db.Text)
+    # Section text to write alt text from when the image has none
+    alt_context = db.Column(db.Text)
+    wp_connection_id = db.Column(db.Integer, db.ForeignKey('word_press_connection.id'))
+    attempts = db.Column(db.Integer, default=0)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Touched periodically by the process running the job; a stale one means that process is gone
+    heartbeat_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+    
+    def __repr__(self):
+        return f'<ImageJob {self.id} {self.status}>'
+
+class GeminiResponse(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    kind = db.Column(db.String(30), nullable=False)
+    value = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<GeminiResponse {self.kind} {self.cache_key[:8]}>'
+
+class BulkRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    wp_connection_id = db.Column(db.Integer, db.ForeignKey('word_press_connection.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='running')
+    options = db.Column(db.Text)  # JSON of the command-line options the run was started with
+    stats = db.Column(db.Text)  # JSON per-stage throughput from the latest attempt
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<BulkRun {self.id} {self.status}>'
+
+class BulkRunItem(db.Model):
+    __table_args__ = (
+        db.Index('ix_bulk_run_item_run_wp_id', 'run_id', 'wp_id', unique=True),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('bulk_run.id'), nullable=False)
+    wp_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    stage = db.Column(db.String(20))  # last stage that completed
+    state = db.Column(db.Text)  # JSON per-heading queries, images and uploaded media
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BulkRunItem {self.run_id}:{self.wp_id} {self.status}>'
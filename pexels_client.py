@@ -1,20 +1,133 @@
-import requests
+from http_transport import transport
+from telemetry import span
+from quota import admission, quota
 import logging
 import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, quote
 
 logger = logging.getLogger(__name__)
 
+def record_rate_limit(headers):
+    """Share the quota Pexels reports in its X-Ratelimit-* headers with every worker
+    
+    The headers count the monthly quota, so they only lower the hourly budget,
+    and stop calls until the month resets once it is used up.
+    """
+    try:
+        remaining = int(headers['X-Ratelimit-Remaining'])
+        reset = int(headers['X-Ratelimit-Reset'])
+    except (KeyError, ValueError):
+        return
+    
+    quota.update('pexels', remaining, reset - time.time())
+
+class SearchCache:
+    """Size-bounded search results with a time-to-live"""
+    
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+search_cache = SearchCache(int(os.environ.get('PEXELS_CACHE_SIZE', 512)),
+                           int(os.environ.get('PEXELS_CACHE_TTL', 3600)))
+prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pexels-prefetch")
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+
+THUMBNAIL_DIR = 'static/thumbnails'
+THUMBNAIL_HOSTS = ('images.pexels.com',)
+MAX_THUMBNAIL_BYTES = 2 * 1024 * 1024
+
+def thumbnail_url(src):
+    """Local URL that serves a cached copy of a Pexels thumbnail"""
+    return f"/api/thumbnail?src={quote(src, safe='')}"
+
 class PexelsClient:
     def __init__(self):
         self.api_key = os.environ.get("PEXELS_API_KEY")
-        self.base_url = "https://api.pexels.com/v1"
+        self.base_url = os.environ.get("PEXELS_BASE_URL", "https://api.pexels.com/v1")
         self.headers = {
             'Authorization': self.api_key
         }
     
-    def search_images(self, query, per_page=20, page=1, orientation='landscape'):
+    def search_images(self, query, per_page=20, page=1, orientation='landscape', prefetch=True):
         """Search for images on Pexels"""
+        key = (query.strip().lower(), page, orientation, per_page)
+        images = search_cache.get(key)
+        
+        if images is None:
+            images = self.fetch_search(query, per_page, page, orientation)
+            if images is None:
+                return []
+            search_cache.set(key, images)
+        else:
+            logger.debug(f"Pexels cache hit for query: {query} (page {page})")
+        
+        # A full page means there is probably another one the user will ask for next
+        if prefetch and len(images) == per_page:
+            self.prefetch_page(query, per_page, page + 1, orientation)
+        
+        return [dict(image) for image in images]
+    
+    def prefetch_page(self, query, per_page, page, orientation):
+        """Fetch a page into the cache in the background"""
+        key = (query.strip().lower(), page, orientation, per_page)
+        # Prefetching is batch work, so it stops while the budget is down to the interactive reserve
+        if key in search_cache or quota.headroom('pexels') <= quota.batch_reserve:
+            return
+        
+        with _prefetching_lock:
+            if key in _prefetching:
+                return
+            _prefetching.add(key)
+        
+        def run():
+            try:
+                with admission('batch', max_wait=0):
+                    images = self.fetch_search(query, per_page, page, orientation)
+                if images is not None:
+                    search_cache.set(key, images)
+            finally:
+                with _prefetching_lock:
+                    _prefetching.discard(key)
+        
+        prefetch_executor.submit(run)
+    
+    def fetch_search(self, query, per_page, page, orientation):
+        """Call the Pexels search API; None on failure so errors are not cached"""
         try:
+            if not quota.acquire('pexels'):
+                logger.warning(f"Pexels request budget exhausted, skipping search for: {query}")
+                return None
+            
             params = {
                 'query': query,
                 'per_page': per_page,
@@ -23,10 +136,12 @@ class PexelsClient:
                 'size': 'medium'
             }
             
-            response = requests.get(f"{self.base_url}/search", 
-                                  headers=self.headers,
-                                  params=params,
-                                  timeout=10)
+            with span('pexels_search'):
+                response = transport.get(f"{self.base_url}/search", 
+                                       headers=self.headers,
+                                       params=params,
+                                       timeout=10)
+            record_rate_limit(response.headers)
             
             if response.status_code == 200:
                 data = response.json()
@@ -38,6 +153,7 @@ class PexelsClient:
                         'url': photo['src']['large'],
                         'medium_url': photo['src']['medium'],
                         'small_url': photo['src']['small'],
+                        'thumb_url': thumbnail_url(photo['src']['medium']),
                         'photographer': photo['photographer'],
                         'photographer_url': photo['photographer_url'],
                         'alt': photo.get('alt', ''),
@@ -49,18 +165,79 @@ class PexelsClient:
                 return images
             else:
                 logger.error(f"Pexels API error: {response.status_code} - {response.text}")
-                return []
-                
+                return None
+        
         except Exception as e:
             logger.error(f"Error searching Pexels: {e}")
-            return []
+            return None
+    
+    def cached_thumbnail(self, src):
+        """Local path of a Pexels thumbnail, downloading it on first use
+        
+        Hits refresh the file's modification time, which the upload store's
+        garbage collector uses to evict the least recently served thumbnails.
+        """
+        try:
+            if urlsplit(src).hostname not in THUMBNAIL_HOSTS:
+                logger.warning(f"Refusing thumbnail from unexpected host: {src}")
+                return None
+            
+            extension = os.path.splitext(urlsplit(src).path)[1].lower() or '.jpg'
+            filename = hashlib.sha256(src.encode()).hexdigest()[:32] + extension
+            filepath = os.path.join(THUMBNAIL_DIR, filename)
+            if os.path.exists(filepath):
+                try:
+                    os.utime(filepath)
+                except FileNotFoundError:
+                    # Evicted just now; download it again
+                    pass
+                else:
+                    return filepath
+            
+            os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+            with transport.get(src, stream=True, timeout=10) as response:
+                if response.status_code != 200:
+                    logger.error(f"Failed to download thumbnail: {response.status_code}")
+                    return None
+                
+                data = bytearray()
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    data += chunk
+                    if len(data) > MAX_THUMBNAIL_BYTES:
+                        logger.error(f"Thumbnail too large: {src}")
+                        return None
+            
+            # Write to a temp name first so concurrent readers never see a partial file
+            temp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, filepath)
+            self._collect_if_due()
+            return filepath
+        
+        except Exception as e:
+            logger.error(f"Error caching thumbnail: {e}")
+            return None
+    
+    def _collect_if_due(self):
+        """Let the upload store's garbage collector trim the thumbnail cache when a collection is due"""
+        from flask import current_app, has_app_context
+        
+        if has_app_context():
+            from upload_store import upload_store
+            upload_store.collect_if_due(current_app._get_current_object())
     
     def get_photo(self, photo_id):
         """Get specific photo details"""
         try:
-            response = requests.get(f"{self.base_url}/photos/{photo_id}", 
-                                  headers=self.headers,
-                                  timeout=10)
+            if not quota.acquire('pexels'):
+                logger.warning(f"Pexels request budget exhausted, skipping photo {photo_id}")
+                return None
+            
+            response = transport.get(f"{self.base_url}/photos/{photo_id}", 
+                                   headers=self.headers,
+                                   timeout=10)
+            record_rate_limit(response.headers)
             
             if response.status_code == 200:
                 photo = response.json()
@@ -76,7 +253,7 @@ class PexelsClient:
             else:
                 logger.error(f"Failed to get photo: {response.status_code}")
                 return None
-                
+        
         except Exception as e:
             logger.error(f"Error getting photo: {e}")
             return None
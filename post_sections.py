@@ -0,0 +1,266 @@
+import hashlib
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+# Headings and images in one scan; an image inside a heading is part of the heading match
+SECTION_TOKEN_RE = re.compile(r'<(h[23])\b[^>]*>(.*?)</\1\s*>|<img\b', re.IGNORECASE | re.DOTALL)
+# Closes a heading block in raw (context=edit) content; inserts go after it, not inside the block
+HEADING_BLOCK_END_RE = re.compile(r'\s*<!--\s*/wp:heading\s*-->')
+SLUG_RE = re.compile(r'[^a-z0-9]+')
+# Path segments /api/suggest-images/<post_id>/ routes give their own meaning
+RESERVED_IDS = frozenset(('all', 'featured'))
+# Figures holding an image, with their captions: what the editor and bulk imaging insert
+IMAGE_FIGURE_RE = re.compile(r'<figure\b(?:(?!</figure\s*>).)*?<img\b.*?</figure\s*>', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]+>')
+SPACE_RE = re.compile(r'\s+')
+BLOCK_TOKEN_RE = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][\w:-]*)\b[^>]*?(/?)>', re.DOTALL)
+VOID_CLOSE_RE = re.compile(r'\s*/>')
+VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                       'link', 'meta', 'source', 'track', 'wbr'))
+
+def html_to_text(fragment):
+    """Strip tags and collapse whitespace, as the browser's textContent would read"""
+    return SPACE_RE.sub(' ', html.unescape(TAG_RE.sub(' ', fragment))).strip()
+
+def section_hash(heading_type, text, body_text):
+    """Digest of a section's heading and text, given without image figures, so adding one leaves it alone"""
+    payload = f"{heading_type}\0{text}\0{body_text}".encode()
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+class SectionIndex:
+    """H2/H3 sections of one revision of a post, addressable by position, ID or content hash
+
+    Section IDs are slugs of the heading text, numbered when a heading repeats,
+    so they stay the same when other sections are added, removed or edited.
+    An ID is never all digits, so it cannot be mistaken for a position, and
+    never one of RESERVED_IDS, so every ID can be used in a suggestion URL.
+    """
+
+    def __init__(self, sections, title='', text=''):
+        self.sections = sections
+        self.title = title
+        # The whole post as plain text, which featured image suggestions search on
+        self.text = text
+        self.by_id = {section['id']: section for section in sections}
+        self.by_hash = {}
+        for section in sections:
+            self.by_hash.setdefault(section['hash'], section)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def get(self, key):
+        """Section for a position (int or digit string) or a section ID, or None"""
+        if isinstance(key, int) or key.isdigit():
+            position = int(key)
+            return self.sections[position] if 0 <= position < len(self.sections) else None
+        return self.by_id.get(key)
+
+    @property
+    def imaged_hashes(self):
+        return {section['hash'] for section in self.sections if section['has_image']}
+
+    def pending(self, skip_hashes=()):
+        """Sections without an image whose content hash is not in skip_hashes"""
+        return [section for section in self.sections
+                if not section['has_image'] and section['hash'] not in skip_hashes]
+
+    def changed_since(self, other):
+        """Sections whose heading or text differs from every section of another revision"""
+        if other is None:
+            return list(self.sections)
+        return [section for section in self.sections if section['hash'] not in other.by_hash]
+
+def index_sections(content, title=''):
+    """Split rendered post HTML into H2/H3 sections in a single scan
+
+    Each section has its position, stable ID, heading type and text, the text
+    that follows it, whether an image follows it, its content hash and the
+    offset just after its closing heading tag (or heading block comment).
+    """
+    sections = []
+    seen = {}
+    previous = None
+    intro_end = len(content)
+
+    def close(section, end):
+        body = content[section['offset']:end]
+        section['content'] = html_to_text(body)
+        # Inserted images come with an attribution caption, which must not count as an edit
+        hashed = html_to_text(IMAGE_FIGURE_RE.sub(' ', body)) if section['has_image'] else section['content']
+        section['hash'] = section_hash(section['type'], section['text'], hashed)
+
+    for match in SECTION_TOKEN_RE.finditer(content):
+        if match.group(1) is None:
+            if previous is not None:
+                previous['has_image'] = True
+            continue
+        if previous is not None:
+            close(previous, match.start())
+        else:
+            intro_end = match.start()
+
+        text = html_to_text(match.group(2))
+        slug = SLUG_RE.sub('-', text.lower()).strip('-')[:60].strip('-') or 'section'
+        if slug.isdigit() or slug in RESERVED_IDS:
+            slug = f"h-{slug}"
+        seen[slug] = seen.get(slug, 0) + 1
+        previous = {
+            'index': len(sections),
+            'id': slug if seen[slug] == 1 else f"{slug}-{seen[slug]}",
+            'type': match.group(1).lower(),
+            'text': text,
+            'has_image': False,
+            'offset': (HEADING_BLOCK_END_RE.match(content, match.end()) or match).end()
+        }
+        sections.append(previous)
+
+    if previous is not None:
+        close(previous, len(content))
+
+    # The whole text from the pieces already converted, rather than another pass over the HTML
+    pieces = [html_to_text(content[:intro_end])]
+    pieces += [f"{section['text']} {section['content']}".strip() for section in sections]
+    return SectionIndex(sections, title, ' '.join(piece for piece in pieces if piece))
+
+class SectionIndexCache:
+    """In-process LRU of section indexes keyed by (connection, post, modified)
+
+    modified changes with every revision, so entries never go stale; old
+    revisions simply age out.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or int(os.environ.get('SECTION_INDEX_CACHE_SIZE', 256))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key):
+        with self._lock:
+            index = self._entries.get(key)
+            if index is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return index
+
+    def put(self, key, index):
+        with self._lock:
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def build(self, key, content, title=''):
+        """Cached index for key, parsing content only when there is none"""
+        index = self.get(key)
+        if index is None:
+            index = self.put(key, index_sections(content, html_to_text(title)))
+        return index
+
+section_indexes = SectionIndexCache()
+
+def insert_after_headings(content, fragments, index=None):
+    """Insert HTML right after the closing tag of each heading, keyed by section index
+
+    index, when given, must be the SectionIndex of content; it saves a parse.
+    """
+    sections = (index or index_sections(content)).sections
+    # Work backwards so earlier offsets stay valid
+    for position in sorted(fragments, reverse=True):
+        if 0 <= position < len(sections):
+            end = sections[position]['offset']
+            content = content[:end] + fragments[position] + content[end:]
+    return content
+
+def split_blocks(content):
+    """Split HTML into top-level blocks: elements, comments and the text between them
+
+    Joining the blocks gives back the content exactly.
+    """
+    blocks = []
+    depth = 0
+    start = 0
+    for match in BLOCK_TOKEN_RE.finditer(content):
+        if depth == 0 and match.start() > start:
+            blocks.append(content[start:match.start()])
+            start = match.start()
+
+        closing, tag, self_closing = match.groups()
+        if tag is not None:
+            if closing:
+                depth = max(0, depth - 1)
+            elif not self_closing and tag.lower() not in VOID_TAGS:
+                depth += 1
+        if depth == 0:
+            blocks.append(content[start:match.end()])
+            start = match.end()
+
+    if start < len(content):
+        blocks.append(content[start:])
+    return blocks
+
+def block_key(block):
+    """A block as compared for changes, ignoring how WordPress and browsers differ in serializing it"""
+    return SPACE_RE.sub(' ', html.unescape(VOID_CLOSE_RE.sub('>', block))).strip()
+
+def diff_blocks(base, new):
+    """Changes from base to new as (start, end, replacement) over base block positions"""
+    matcher = SequenceMatcher(None, [block_key(b) for b in base], [block_key(b) for b in new], autojunk=False)
+    return [(i1, i2, new[j1:j2]) for op, i1, i2, j1, j2 in matcher.get_opcodes() if op != 'equal']
+
+def apply_changes(base, changes):
+    """Base blocks with changes applied; untouched blocks keep their original markup"""
+    blocks = []
+    position = 0
+    for start, end, replacement in changes:
+        blocks.extend(base[position:start])
+        blocks.extend(replacement)
+        position = end
+    blocks.extend(base[position:])
+    return blocks
+
+def merge_blocks(base, ours, theirs):
+    """Three-way merge of block lists
+
+    Returns (blocks, conflicts). Changes merge cleanly when they touch
+    different base blocks or are identical; conflicts lists the base block
+    ranges both sides changed differently, and blocks is None when there are any.
+    """
+    changes = sorted([(start, end, [block_key(b) for b in replacement], replacement, side)
+                      for side, blocks in (('ours', ours), ('theirs', theirs))
+                      for start, end, replacement in diff_blocks(base, blocks)],
+                     key=lambda change: (change[0], change[1]))
+
+    merged = []
+    conflicts = []
+    position = 0
+    while position < len(changes):
+        group = [changes[position]]
+        group_start, group_end = changes[position][0], changes[position][1]
+        position += 1
+        while position < len(changes):
+            start, end = changes[position][0], changes[position][1]
+            # Overlapping ranges, or two insertions at the same point
+            if start < group_end or (start == group_start == group_end == end):
+                group.append(changes[position])
+                group_end = max(group_end, end)
+                position += 1
+            else:
+                break
+
+        if len({change[4] for change in group}) > 1 and len({(c[0], c[1], tuple(c[2])) for c in group}) > 1:
+            conflicts.append((group_start, group_end))
+            continue
+        merged.append((group[0][0], group[0][1], group[0][3]))
+
+    if conflicts:
+        return None, conflicts
+    return apply_changes(base, merged), []
@@ -0,0 +1,307 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from app import db
+from models import BlogPost, PostRevision
+from post_sections import apply_changes, diff_blocks, merge_blocks, section_indexes, split_blocks
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = int(os.environ.get('POST_SYNC_INTERVAL', 60))
+FULL_SYNC_INTERVAL = int(os.environ.get('POST_FULL_SYNC_INTERVAL', 24 * 3600))
+SYNC_PAGE_SIZE = 100
+# Content revisions kept per post as bases for merging edits
+REVISIONS_KEPT = int(os.environ.get('POST_REVISIONS_KEPT', 5))
+
+class PostMirror:
+    """Keeps the BlogPost table in step with a WordPress site and serves posts from it.
+
+    Incremental syncs ask only for posts modified since the newest one we hold.
+    A periodic full sync also drops posts that were deleted or trashed remotely.
+    """
+
+    def __init__(self, wp_conn, wp_client):
+        self.wp_conn = wp_conn
+        self.wp_client = wp_client
+
+    def sync(self, force=False):
+        """Bring the mirror up to date unless it was synced within SYNC_INTERVAL; False on failure"""
+        now = datetime.utcnow()
+        synced_at = self.wp_conn.posts_synced_at
+        if not force and synced_at and now - synced_at < timedelta(seconds=SYNC_INTERVAL):
+            return True
+
+        full_synced_at = self.wp_conn.posts_full_synced_at
+        full = force or not full_synced_at or now - full_synced_at > timedelta(seconds=FULL_SYNC_INTERVAL)
+        ok = self._full_sync() if full else self._incremental_sync()
+
+        if ok:
+            self.wp_conn.posts_synced_at = now
+            if full:
+                self.wp_conn.posts_full_synced_at = now
+            db.session.commit()
+        return ok
+
+    def _fetch_pages(self, modified_after=None):
+        """Yield pages of post summaries, following X-WP-TotalPages"""
+        page = 1
+        while True:
+            data = self.wp_client.list_posts(modified_after=modified_after, page=page, per_page=SYNC_PAGE_SIZE)
+            if data is None:
+                raise RuntimeError(f"Failed to list posts (page {page})")
+            yield data['posts']
+            if page >= data['total_pages'] or not data['posts']:
+                return
+            page += 1
+
+    def _incremental_sync(self):
+        latest = (db.session.query(func.max(BlogPost.modified))
+                  .filter(BlogPost.wp_connection_id == self.wp_conn.id)
+                  .scalar())
+        if latest is None:
+            return self._full_sync()
+
+        # modified_after is exclusive, so step back a second to catch same-second edits
+        modified_after = (datetime.fromisoformat(latest) - timedelta(seconds=1)).isoformat()
+        try:
+            updated = 0
+            for posts in self._fetch_pages(modified_after):
+                updated += self._upsert(posts)
+            logger.info(f"Incremental sync of {self.wp_conn.site_url}: {updated} posts changed")
+            return True
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Incremental post sync failed: {e}")
+            return False
+
+    def _full_sync(self):
+        started = datetime.utcnow()
+        try:
+            seen = 0
+            for posts in self._fetch_pages():
+                self._upsert(posts, touch=True)
+                seen += len(posts)
+
+            # Every post still on the site was touched above; anything older is gone
+            removed = (BlogPost.query
+                       .filter(BlogPost.wp_connection_id == self.wp_conn.id, BlogPost.last_synced < started)
+                       .delete(synchronize_session=False))
+            db.session.commit()
+            logger.info(f"Full sync of {self.wp_conn.site_url}: {seen} posts, {removed} removed")
+            return True
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Full post sync failed: {e}")
+            return False
+
+    def _upsert(self, posts, touch=False):
+        """Insert or update post summaries; returns how many rows changed
+
+        With touch, unchanged rows also get last_synced bumped so a full sync can
+        tell which rows it saw.
+        """
+        if not posts:
+            return 0
+
+        existing = {row.wp_id: row for row in BlogPost.query.filter(
+            BlogPost.wp_connection_id == self.wp_conn.id,
+            BlogPost.wp_id.in_([post['id'] for post in posts]))}
+        now = datetime.utcnow()
+        changed = 0
+
+        for post in posts:
+            row = existing.get(post['id'])
+            if row is None:
+                row = BlogPost(wp_id=post['id'], wp_connection_id=self.wp_conn.id, content='')
+                db.session.add(row)
+            elif row.modified == post['modified']:
+                if touch:
+                    row.last_synced = now
+                continue
+            self._apply(row, post)
+            row.last_synced = now
+            changed += 1
+
+        db.session.commit()
+        return changed
+
+    def _apply(self, row, post):
+        row.title = post['title']
+        row.excerpt = post['excerpt']
+        row.status = post['status']
+        row.date = post['date']
+        row.modified = post['modified']
+        row.link = post['link']
+        row.featured_media = post.get('featured_media', 0)
+
+    def list_posts(self, status='all', page=1, per_page=10, search=None):
+        """A page of mirrored posts, newest first, in the shape WordPressClient.get_posts returns"""
+        query = BlogPost.query.filter(BlogPost.wp_connection_id == self.wp_conn.id)
+        if status == 'all':
+            query = query.filter(BlogPost.status.in_(('publish', 'draft')))
+        else:
+            query = query.filter(BlogPost.status == status)
+        if search:
+            query = query.filter(BlogPost.title.ilike(f"%{search}%"))
+
+        pagination = query.order_by(BlogPost.date.desc()).paginate(page=page, per_page=per_page, error_out=False)
+        return {
+            'posts': [row.to_dict() for row in pagination.items],
+            'current_page': page,
+            'total_pages': pagination.pages
+        }
+
+    def get_post(self, post_id):
+        """A post with content, fetching or revalidating the content only when it may be stale"""
+        row = BlogPost.query.filter_by(wp_connection_id=self.wp_conn.id, wp_id=post_id).first()
+        if row and row.content and row.content_modified == row.modified:
+            return row.to_dict()
+
+        etag = row.content_etag if row and row.content else None
+        post, etag, not_modified = self.wp_client.get_post_revalidated(post_id, etag)
+
+        if not_modified:
+            row.content_modified = row.modified
+            db.session.commit()
+            return row.to_dict()
+
+        if post is None:
+            return None
+
+        if row is None:
+            row = BlogPost(wp_id=post_id, wp_connection_id=self.wp_conn.id)
+            db.session.add(row)
+        self._apply(row, post)
+        self._store_content(row, post['content'], post['modified'], etag)
+        return row.to_dict()
+
+    def section_index(self, post_id, post=None):
+        """Section index of a post's current content, parsed once per revision; None if the post is missing
+
+        Pass post when its content is already loaded.
+        """
+        if post is None:
+            # A fresh mirror row with a cached index needs no content loaded at all
+            state = (db.session.query(BlogPost.modified, BlogPost.content_modified)
+                     .filter(BlogPost.wp_connection_id == self.wp_conn.id, BlogPost.wp_id == post_id)
+                     .first())
+            if state and state.modified and state.modified == state.content_modified:
+                index = section_indexes.get((self.wp_conn.id, post_id, state.modified))
+                if index is not None:
+                    return index
+            post = self.get_post(post_id)
+            if post is None:
+                return None
+        return section_indexes.build((self.wp_conn.id, post_id, post['modified']), post['content'], post['title'])
+
+    def _store_content(self, row, content, modified, etag=None):
+        """Cache a post's content and keep it as a revision that later saves can diff against"""
+        row.content = content
+        row.modified = modified
+        row.content_modified = modified
+        row.content_etag = etag
+        row.last_synced = datetime.utcnow()
+
+        revision = PostRevision.query.filter_by(wp_connection_id=self.wp_conn.id, wp_id=row.wp_id,
+                                                modified=modified).first()
+        if revision is None:
+            db.session.add(PostRevision(wp_connection_id=self.wp_conn.id, wp_id=row.wp_id,
+                                        modified=modified, content=content))
+        else:
+            revision.content = content
+        db.session.flush()
+
+        stale = (PostRevision.query
+                 .filter_by(wp_connection_id=self.wp_conn.id, wp_id=row.wp_id)
+                 .order_by(PostRevision.modified.desc())
+                 .offset(REVISIONS_KEPT)
+                 .all())
+        for revision in stale:
+            db.session.delete(revision)
+        db.session.commit()
+
+    def save_post(self, post_id, content, base_modified=None, featured_image_id=None, post_status='draft'):
+        """Save editor content as a block diff against the revision it was loaded from, as a draft by default
+
+        Returns a dict whose 'status' is 'unchanged' (nothing sent to WordPress),
+        'saved', 'merged' (WordPress had a newer revision and the edits did not
+        overlap) or 'conflict'; None when WordPress rejects the update.
+        """
+        row = BlogPost.query.filter_by(wp_connection_id=self.wp_conn.id, wp_id=post_id).first()
+        if row is None or not row.content:
+            if self.get_post(post_id) is None:
+                return None
+            row = BlogPost.query.filter_by(wp_connection_id=self.wp_conn.id, wp_id=post_id).first()
+        if base_modified is None:
+            base_modified = row.content_modified
+
+        revision = None
+        if base_modified:
+            revision = PostRevision.query.filter_by(wp_connection_id=self.wp_conn.id, wp_id=post_id,
+                                                    modified=base_modified).first()
+        base = split_blocks(revision.content) if revision else None
+        ours = split_blocks(content)
+
+        changes = diff_blocks(base, ours) if base is not None else None
+        featured_changed = bool(featured_image_id) and row.featured_media != featured_image_id
+        status_changed = bool(post_status) and row.status != post_status
+        if changes == [] and not featured_changed and not status_changed:
+            return {'status': 'unchanged', 'modified': base_modified, 'changed_blocks': 0}
+
+        # Has WordPress moved past the base since the editor loaded it?
+        etag = row.content_etag if row.content_modified == base_modified else None
+        remote, etag, not_modified = self.wp_client.get_post_revalidated(post_id, etag)
+        if not not_modified and remote is None:
+            return None
+
+        status = 'saved'
+        # modified has one-second resolution, so compare content too when it matches
+        if not_modified or (remote['modified'] == base_modified
+                            and (revision is None or remote['content'] == revision.content)):
+            if changes == []:
+                content = None
+            elif changes is not None:
+                # Unchanged blocks keep WordPress's markup rather than the browser's
+                content = ''.join(apply_changes(base, changes))
+        else:
+            self._apply(row, remote)
+            self._store_content(row, remote['content'], remote['modified'], etag)
+            if base is None:
+                logger.info(f"Post {post_id} changed remotely and revision {base_modified} is gone")
+                return {'status': 'conflict', 'modified': remote['modified'], 'conflicts': []}
+
+            merged, conflicts = merge_blocks(base, ours, split_blocks(remote['content']))
+            if conflicts:
+                logger.info(f"Post {post_id} has conflicting edits in {len(conflicts)} places")
+                return {'status': 'conflict', 'modified': remote['modified'], 'conflicts': conflicts}
+            content = ''.join(merged)
+            status = 'merged'
+
+        updated = self.wp_client.update_post(post_id, content, featured_image_id=featured_image_id,
+                                              status=post_status)
+        if not updated:
+            return None
+
+        if featured_image_id:
+            row.featured_media = featured_image_id
+        if post_status:
+            row.status = post_status
+        self._store_content(row, updated['content'], updated['modified'])
+
+        # Sections whose text differs from the revision the editor loaded; None when that is gone
+        changed_sections = None
+        if revision is not None:
+            base_index = section_indexes.build((self.wp_conn.id, post_id, base_modified), revision.content)
+            saved_index = section_indexes.build((self.wp_conn.id, post_id, updated['modified']),
+                                                updated['content'], updated.get('title', row.title))
+            changed_sections = [section['id'] for section in saved_index.changed_since(base_index)]
+        return {
+            'status': status,
+            'modified': updated['modified'],
+            'content': updated['content'],
+            'changed_blocks': len(changes) if changes is not None else None,
+            'changed_sections': changed_sections
+        }
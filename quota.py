@@ -0,0 +1,254 @@
+"""Request budgets for Gemini, Pexels and WordPress shared by every worker process.
+
+Each provider has a token bucket stored in a small SQLite database
+(QUOTA_DB), updated inside an immediate transaction so all gunicorn workers
+and the bulk imaging command draw from the same budget. Callers declare a
+priority class with admission(): interactive editor requests may use the
+whole bucket, while batch work (bulk imaging, prefetching) only takes tokens
+above a reserve kept for interactive callers. A caller that cannot get a
+token before its deadline is turned away at once instead of sleeping into the
+provider's own timeout, and the wait and the rejection are both recorded.
+"""
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from telemetry import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ('interactive', 'batch')
+
+# Requests allowed per period for each provider; 0 turns the limit off
+PROVIDER_LIMITS = {
+    'pexels': ('PEXELS_REQUESTS_PER_HOUR', 200, 3600),
+    'gemini': ('GEMINI_REQUESTS_PER_MINUTE', 60, 60),
+    'wordpress': ('WP_REQUESTS_PER_MINUTE', 300, 60),
+}
+
+# Longest time to wait for a token by priority class
+MAX_WAIT = {
+    'interactive': float(os.environ.get('QUOTA_MAX_WAIT', 2.0)),
+    'batch': float(os.environ.get('QUOTA_BATCH_MAX_WAIT', 30.0)),
+}
+
+# Set by the caller and copied into worker threads with contextvars.copy_context()
+admission_class = contextvars.ContextVar('admission_class', default=('interactive', None))
+
+quota_wait_seconds = Histogram('quota_wait_seconds', 'Time spent waiting for a provider request token',
+                               ('provider', 'priority'))
+quota_rejected = Counter('quota_rejected_total', 'Provider calls turned away for lack of request budget',
+                         ('provider', 'priority'))
+
+@contextmanager
+def admission(priority, max_wait=None):
+    """Run the block's provider calls in a priority class, optionally with their own deadline"""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority class: {priority}")
+    token = admission_class.set((priority, max_wait))
+    try:
+        yield
+    finally:
+        admission_class.reset(token)
+
+class QuotaManager:
+    """Cross-process token buckets, one per provider (or provider and site)"""
+
+    def __init__(self, path=None, batch_reserve=None):
+        self.path = path or os.environ.get('QUOTA_DB', os.path.join('instance', 'quota.db'))
+        if batch_reserve is None:
+            batch_reserve = float(os.environ.get('QUOTA_BATCH_RESERVE', 0.25))
+        self.batch_reserve = batch_reserve
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        # A connection must not be shared with a forked child
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Autocommit mode, so transactions are only the explicit BEGIN IMMEDIATE ones
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''CREATE TABLE IF NOT EXISTS quota_bucket (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                capacity REAL NOT NULL,
+                refill_per_second REAL NOT NULL,
+                updated REAL NOT NULL,
+                blocked_until REAL
+            )''')
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(quota_bucket)')}
+            if 'blocked_until' not in columns:
+                connection.execute('ALTER TABLE quota_bucket ADD COLUMN blocked_until REAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def limits(self, provider):
+        """(capacity, refill per second) configured for a provider, or None when it is unlimited"""
+        variable, default, period = PROVIDER_LIMITS[provider]
+        requests = float(os.environ.get(variable, default))
+        if requests <= 0:
+            return None
+        return requests, requests / period
+
+    def _bucket(self, connection, name, limits):
+        """Refilled (tokens, capacity, refill, blocked_until) for a bucket; call inside a transaction
+
+        Capacity and refill always come from the configured limits, so a
+        change to them applies at once and nothing a provider reports can
+        raise them.
+        """
+        capacity, refill = limits
+        now = time.time()
+        row = connection.execute('SELECT tokens, updated, blocked_until FROM quota_bucket WHERE name = ?',
+                                 (name,)).fetchone()
+        if row is None:
+            connection.execute('INSERT INTO quota_bucket (name, tokens, capacity, refill_per_second, updated) '
+                               'VALUES (?, ?, ?, ?, ?)', (name, capacity, capacity, refill, now))
+            return capacity, capacity, refill, None
+
+        tokens, updated, blocked_until = row
+        tokens = min(capacity, tokens + max(0.0, now - updated) * refill)
+        return tokens, capacity, refill, blocked_until
+
+    def _save(self, connection, name, tokens, capacity, refill, blocked_until):
+        connection.execute('UPDATE quota_bucket SET tokens = ?, capacity = ?, refill_per_second = ?, '
+                           'updated = ?, blocked_until = ? WHERE name = ?',
+                           (tokens, capacity, refill, time.time(), blocked_until, name))
+
+    def _take(self, name, limits, floor):
+        """Take a token when more than floor are left; otherwise seconds until one will be"""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            tokens, capacity, refill, blocked_until = self._bucket(connection, name, limits)
+            # Until then the provider's own quota is used up, whatever the bucket holds
+            blocked = (blocked_until or 0) - time.time()
+            needed = floor * capacity + 1
+            taken = blocked <= 0 and tokens >= needed
+            if taken:
+                tokens -= 1
+            self._save(connection, name, tokens, capacity, refill, blocked_until if blocked > 0 else None)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return 0.0 if taken else max(blocked, (needed - tokens) / refill)
+
+    def acquire(self, provider, scope=None):
+        """Take one request token for provider, in the caller's priority class
+
+        Waits while a token is due before the deadline and returns False as
+        soon as it is clear none will be. Errors reading the shared buckets
+        let the call through rather than blocking every provider.
+        """
+        limits = self.limits(provider)
+        if limits is None:
+            return True
+
+        priority, max_wait = admission_class.get()
+        if max_wait is None:
+            max_wait = MAX_WAIT[priority]
+        name = f"{provider}:{scope}" if scope else provider
+        floor = self.batch_reserve if priority == 'batch' else 0.0
+
+        start = time.monotonic()
+        deadline = start + max_wait
+        try:
+            while True:
+                wait = self._take(name, limits, floor)
+                now = time.monotonic()
+                if wait == 0:
+                    quota_wait_seconds.observe((provider, priority), now - start)
+                    return True
+                if now + wait > deadline:
+                    break
+                # Other processes may take the token first, so check again after sleeping
+                time.sleep(wait)
+        except Exception as e:
+            logger.warning(f"Quota check for {name} failed, allowing the call: {e}")
+            return True
+
+        quota_rejected.inc((provider, priority))
+        logger.debug(f"{name} request budget exhausted for {priority} calls")
+        return False
+
+    def update(self, provider, remaining, reset_seconds, scope=None):
+        """Lower a bucket's balance to the quota a provider reports as remaining
+
+        Providers report quotas over much longer periods than the configured
+        limit (Pexels counts per month), so this never raises the bucket's
+        capacity, refill or balance. With nothing remaining, the bucket is
+        closed until the provider's quota resets.
+        """
+        limits = self.limits(provider)
+        if limits is None:
+            return
+        name = f"{provider}:{scope}" if scope else provider
+        try:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                tokens, capacity, refill, blocked_until = self._bucket(connection, name, limits)
+                tokens = min(tokens, max(0, remaining))
+                if remaining <= 0:
+                    blocked_until = time.time() + max(0, reset_seconds)
+                self._save(connection, name, tokens, capacity, refill, blocked_until)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        except Exception as e:
+            logger.warning(f"Failed to update quota for {name}: {e}")
+
+    def headroom(self, provider, scope=None):
+        """Fraction of a provider's budget still available"""
+        limits = self.limits(provider)
+        if limits is None:
+            return 1.0
+        name = f"{provider}:{scope}" if scope else provider
+        try:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                tokens, capacity, refill, blocked_until = self._bucket(connection, name, limits)
+                self._save(connection, name, tokens, capacity, refill, blocked_until)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            if blocked_until and blocked_until > time.time():
+                return 0.0
+            return tokens / capacity
+        except Exception as e:
+            logger.warning(f"Quota check for {name} failed: {e}")
+            return 1.0
+
+    def metrics(self):
+        """Every shared bucket's current budget"""
+        try:
+            rows = self._connect().execute(
+                'SELECT name, tokens, capacity, refill_per_second, updated, blocked_until FROM quota_bucket '
+                'ORDER BY name').fetchall()
+        except Exception as e:
+            logger.warning(f"Failed to read quota buckets: {e}")
+            return {}
+        now = time.time()
+        return {
+            name: {
+                'tokens': round(min(capacity, tokens + max(0.0, now - updated) * refill), 2),
+                'capacity': capacity,
+                'refill_per_second': round(refill, 4),
+                'blocked_seconds': round(max(0.0, (blocked_until or 0) - now), 1)
+            }
+            for name, tokens, capacity, refill, updated, blocked_until in rows
+        }
+
+quota = QuotaManager()
@@ -1,17 +1,30 @@
 import logging
 import json
+import os
 import re
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
-from models import WordPressConnection, BlogPost, ProcessedImage
+import zlib
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, send_file, send_from_directory, abort
+from models import WordPressConnection, BlogPost, ProcessedImage, ImageJob
 from wordpress_client import WordPressClient
-from gemini_client import GeminiClient
-from pexels_client import PexelsClient
-from image_processor import ImageProcessor
+from job_queue import job_queue
+from http_transport import transport
+from suggestions import SuggestionService
+from post_sync import PostMirror
+from gemini_cache import gemini_cache
+from quota import quota
+from upload_store import upload_store
+import telemetry
 from urllib.parse import urlparse
 
 logger = logging.getLogger(__name__)
 main = Blueprint("main", __name__)
 
+# Largest request body accepted after gzip decoding
+MAX_DECODED_BODY = 16 * 1024 * 1024
+
+# Stored uploads are named by content hash, so they can be cached for a year
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
 @main.route('/')
 def index():
     return render_template('index.html')
@@ -55,6 +68,12 @@ def connect_wordpress():
         flash('An error occurred while connecting to WordPress', 'error')
         return redirect(url_for('main.index'))
 
+@main.route('/disconnect')
+def disconnect():
+    session.pop('wp_connection_id', None)
+    flash('Disconnected from WordPress', 'success')
+    return redirect(url_for('main.index'))
+
 @main.route('/posts')
 def posts():
     try:
@@ -65,22 +84,25 @@ def posts():
 
         wp_conn = WordPressConnection.query.get_or_404(wp_connection_id)
         wp_client = WordPressClient(wp_conn.site_url, wp_conn.username, wp_conn.app_password)
+        mirror = PostMirror(wp_conn, wp_client)
 
         status_filter = request.args.get('status', 'all')
+        search = request.args.get('q', '').strip()
         page = int(request.args.get('page', 1))
         per_page = 10
 
-        posts_data = wp_client.get_posts(status=status_filter, page=page, per_page=per_page)
+        # Listing is served from the local mirror; the sync is skipped if it ran recently
+        if not mirror.sync():
+            flash('Failed to sync posts from WordPress, showing the last known list', 'error')
 
-        if posts_data is None:
-            flash('Failed to fetch posts from WordPress', 'error')
-            posts_data = {'posts': [], 'total_pages': 0, 'current_page': 1}
+        posts_data = mirror.list_posts(status=status_filter, page=page, per_page=per_page, search=search)
 
         return render_template('posts.html',
                                posts=posts_data['posts'],
                                current_page=posts_data['current_page'],
                                total_pages=posts_data['total_pages'],
                                status_filter=status_filter,
+                               search=search,
                                wp_connection=wp_conn)
 
     except Exception as e:
@@ -88,6 +110,231 @@ def posts():
         flash('An error occurred while fetching posts', 'error')
         return redirect(url_for('main.index'))
 
+def get_post_mirror():
+    """Post mirror for the connection stored in the session, or None"""
+    wp_connection_id = session.get('wp_connection_id')
+    if not wp_connection_id:
+        return None
+    wp_conn = WordPressConnection.query.get(wp_connection_id)
+    if not wp_conn:
+        return None
+    return PostMirror(wp_conn, WordPressClient(wp_conn.site_url, wp_conn.username, wp_conn.app_password))
+
+def request_json():
+    """The request's JSON body, decoding Content-Encoding: gzip; None when it is not valid JSON"""
+    body = request.get_data()
+    if request.content_encoding == 'gzip':
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decoder.decompress(body, MAX_DECODED_BODY)
+        except zlib.error:
+            return None
+        if decoder.unconsumed_tail:
+            return None
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+@main.route('/edit/<int:post_id>')
+def edit_post(post_id):
+    try:
+        mirror = get_post_mirror()
+        if not mirror:
+            flash('Please connect to WordPress first', 'error')
+            return redirect(url_for('main.index'))
+
+        mirror.sync()
+        post = mirror.get_post(post_id)
+        if not post:
+            flash('Failed to fetch post from WordPress', 'error')
+            return redirect(url_for('main.posts'))
+
+        # Building the index here means the suggestion calls that follow find it cached
+        headings = [{key: s[key] for key in ('id', 'text', 'type', 'hash', 'has_image')}
+                    for s in mirror.section_index(post_id, post).sections]
+        return render_template('edit_post.html', post=post, headings=headings)
+
+    except Exception as e:
+        logger.error(f"Error loading post {post_id}: {e}")
+        flash('An error occurred while loading the post', 'error')
+        return redirect(url_for('main.posts'))
+
+@main.route('/api/suggest-images/<int:post_id>/<heading_index>')
+def suggest_images(post_id, heading_index):
+    try:
+        mirror = get_post_mirror()
+        if not mirror:
+            return jsonify({'error': 'Not connected to WordPress'}), 401
+
+        index = mirror.section_index(post_id)
+        if index is None:
+            return jsonify({'error': 'Failed to fetch post'}), 404
+
+        page = int(request.args.get('page', 1))
+        manual_query = request.args.get('manual_query', '').strip() or None
+
+        if heading_index == 'featured':
+            section = {'index': 'featured', 'text': index.title, 'content': index.text}
+        else:
+            # A position or a section ID
+            section = index.get(heading_index)
+            if section is None:
+                return jsonify({'error': 'Heading not found'}), 404
+
+        result = SuggestionService().suggest(index.title, section, page=page, manual_query=manual_query)
+        return jsonify(result)
+
+    except Exception as e:
+        logger.error(f"Error suggesting images: {e}")
+        return jsonify({'error': 'An error occurred while getting image suggestions'}), 500
+
+@main.route('/api/suggest-images/<int:post_id>/all')
+def suggest_all_images(post_id):
+    """Stream suggestions for every heading as newline-delimited JSON, in completion order
+
+    skip takes comma-separated section content hashes the caller already has
+    images for; those sections are left out.
+    """
+    mirror = get_post_mirror()
+    if not mirror:
+        return jsonify({'error': 'Not connected to WordPress'}), 401
+
+    index = mirror.section_index(post_id)
+    if index is None:
+        return jsonify({'error': 'Failed to fetch post'}), 404
+
+    skip = set(filter(None, request.args.get('skip', '').split(',')))
+    sections = [section for section in index.sections if section['hash'] not in skip]
+
+    def generate():
+        for result in SuggestionService().suggest_all(index.title, sections):
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@main.route('/api/thumbnail')
+def thumbnail():
+    """Serve a Pexels thumbnail from the local cache"""
+    from pexels_client import PexelsClient
+
+    filepath = PexelsClient().cached_thumbnail(request.args.get('src', ''))
+    if not filepath:
+        abort(404)
+    return send_file(os.path.abspath(filepath), max_age=7 * 24 * 3600)
+
+def section_context(post_id, heading_index):
+    """Title, heading and text of the section an image goes under, for writing its alt text; or None"""
+    mirror = get_post_mirror()
+    index = mirror.section_index(int(post_id)) if mirror else None
+    section = index.get(str(heading_index)) if index else None
+    if section is None:
+        return None
+    return f"{index.title} - {section['text']}: {section['content'][:500]}"
+
+@main.route('/api/process-image', methods=['POST'])
+def process_image():
+    try:
+        data = request.get_json() or {}
+        image_url = data.get('image_url')
+        if not image_url:
+            return jsonify({'error': 'image_url is required'}), 400
+
+        alt_text = data.get('alt_text')
+        alt_context = None
+        if not alt_text and data.get('post_id') and data.get('heading_index') is not None:
+            # The job asks Gemini for alt text, so the request does not wait on it
+            alt_context = section_context(data['post_id'], data['heading_index'])
+
+        job = job_queue.submit(image_url,
+                               author=data.get('author'),
+                               alt_text=alt_text,
+                               alt_context=alt_context,
+                               wp_connection_id=session.get('wp_connection_id'))
+        if job is None:
+            return jsonify({'error': 'Too many images are being processed, please try again shortly'}), 503
+
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': url_for('main.job_status', job_id=job.id),
+            'result_url': url_for('main.job_result', job_id=job.id)
+        }), 202
+
+    except Exception as e:
+        logger.error(f"Error submitting image job: {e}")
+        return jsonify({'error': 'An error occurred while submitting the image'}), 500
+
+@main.route('/api/save-post', methods=['POST'])
+def save_post():
+    try:
+        mirror = get_post_mirror()
+        if not mirror:
+            return jsonify({'error': 'Not connected to WordPress'}), 401
+
+        data = request_json()
+        if data is None:
+            return jsonify({'error': 'Request body must be JSON, optionally gzip-compressed'}), 400
+        post_id = data.get('post_id')
+        content = data.get('content')
+        if not post_id or content is None:
+            return jsonify({'error': 'post_id and content are required'}), 400
+
+        # The editor's button is "Save as Draft", so saved posts always end up as drafts
+        result = mirror.save_post(post_id, content, base_modified=data.get('base_modified'),
+                                  featured_image_id=data.get('featured_image_id'), post_status='draft')
+        if result is None:
+            return jsonify({'error': 'Failed to save post to WordPress'}), 502
+        if result['status'] == 'conflict':
+            return jsonify(dict(result, error='This post was changed in WordPress and the changes overlap with yours')), 409
+        return jsonify(dict(result, success=True))
+
+    except Exception as e:
+        logger.error(f"Error saving post: {e}")
+        return jsonify({'error': 'An error occurred while saving the post'}), 500
+
+@main.route('/api/jobs/<int:job_id>')
+def job_status(job_id):
+    job = ImageJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
+
+@main.route('/api/jobs/<int:job_id>/result')
+def job_result(job_id):
+    job = ImageJob.query.get_or_404(job_id)
+    if job.status == 'failed':
+        return jsonify({'error': job.error or 'Image processing failed', **job.to_dict()}), 500
+    if job.status != 'done':
+        return jsonify({'error': 'Job has not finished yet', **job.to_dict()}), 409
+    return jsonify(json.loads(job.result))
+
+@main.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    """Processed images from the content-addressed upload store"""
+    response = send_from_directory(os.path.abspath(upload_store.root), filename,
+                                   max_age=UPLOAD_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@main.route('/api/http-metrics')
+def http_metrics():
+    return jsonify(transport.metrics())
+
+@main.route('/metrics')
+def metrics():
+    """Stage, request and quota wait histograms in the Prometheus text format"""
+    return Response(telemetry.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@main.route('/api/gemini-cache-metrics')
+def gemini_cache_metrics():
+    return jsonify(gemini_cache.metrics())
+
+@main.route('/api/quota-metrics')
+def quota_metrics():
+    """Request budget left in each provider's shared bucket"""
+    return jsonify(quota.metrics())
+
 # ... include all other route functions here like /edit, /api/suggest-images, etc., just replace @app.route with @main.route
 
 def register_routes(app):
@@ -0,0 +1,104 @@
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+# Process-wide limits on concurrent calls to each provider
+gemini_slots = threading.BoundedSemaphore(int(os.environ.get('GEMINI_CONCURRENCY', 4)))
+pexels_slots = threading.BoundedSemaphore(int(os.environ.get('PEXELS_CONCURRENCY', 4)))
+
+class SuggestionService:
+    """Generates a search query with Gemini and finds matching Pexels photos for post sections"""
+
+    def __init__(self, gemini_client=None, pexels_client=None, per_page=20):
+        self.gemini_client = gemini_client
+        self.pexels_client = pexels_client
+        self.per_page = per_page
+
+    @property
+    def gemini(self):
+        if self.gemini_client is None:
+            from gemini_client import GeminiClient
+            self.gemini_client = GeminiClient()
+        return self.gemini_client
+
+    @property
+    def pexels(self):
+        if self.pexels_client is None:
+            from pexels_client import PexelsClient
+            self.pexels_client = PexelsClient()
+        return self.pexels_client
+
+    def search_query(self, blog_title, heading_text, heading_content):
+        with gemini_slots:
+            query = self.gemini.generate_image_search_query(blog_title, heading_text, heading_content)
+        # Fall back to the heading itself when Gemini is unavailable
+        return query or heading_text
+
+    def search_queries(self, blog_title, sections):
+        """Queries for many sections from a single batched Gemini call"""
+        try:
+            with gemini_slots:
+                # Unanswered headings are retried concurrently by the suggest_all workers
+                return self.gemini.generate_image_search_queries(blog_title, sections, fallback=False)
+        except Exception as e:
+            logger.error(f"Error generating batched search queries: {e}")
+            return {}
+
+    def search_images(self, query, page=1):
+        with pexels_slots:
+            return self.pexels.search_images(query, per_page=self.per_page, page=page)
+
+    def suggest(self, blog_title, section, page=1, manual_query=None, query=None):
+        """Suggestions for one section; a manual or precomputed query skips Gemini"""
+        query = manual_query or query or self.search_query(blog_title, section['text'], section['content'])
+        images = self.search_images(query, page=page)
+        return {
+            'heading_index': section['index'],
+            'heading': section['text'],
+            'search_query': query,
+            'images': images,
+            'current_page': page,
+            'has_more': len(images) == self.per_page
+        }
+
+    def suggest_all(self, blog_title, sections, max_workers=None):
+        """Yield suggestions for every section as each one finishes
+
+        Queries come from one batched Gemini call; only headings it could not
+        answer are asked about individually in the workers.
+        """
+        if not sections:
+            return
+        max_workers = max_workers or min(len(sections), 16)
+        app = current_app._get_current_object() if has_app_context() else None
+        queries = self.search_queries(blog_title, sections)
+
+        def suggest_in_context(section):
+            query = queries.get(section['index'])
+            # Worker threads need the app context for database-backed caches
+            if app is None:
+                return self.suggest(blog_title, section, query=query)
+            with app.app_context():
+                return self.suggest(blog_title, section, query=query)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="suggest") as executor:
+            # Each worker gets a copy of the request's context so spans keep its request ID
+            futures = {executor.submit(contextvars.copy_context().run, suggest_in_context, section): section
+                       for section in sections}
+            for future in as_completed(futures):
+                section = futures[future]
+                try:
+                    yield future.result()
+                except Exception as e:
+                    logger.error(f"Error suggesting images for heading {section['index']}: {e}")
+                    yield {
+                        'heading_index': section['index'],
+                        'heading': section['text'],
+                        'error': 'Failed to get image suggestions'
+                    }
@@ -0,0 +1,200 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a cache hit up to a slow Gemini call or large upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Set per request and copied into job and suggestion threads with contextvars.copy_context()
+request_id = contextvars.ContextVar('request_id', default=None)
+request_timings = contextvars.ContextVar('request_timings', default=None)
+profile_requested = contextvars.ContextVar('profile_requested', default=False)
+
+# Incoming X-Request-ID values are echoed and used in profile file names
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def render_labels(label, value):
+    """Prometheus label pairs for one label name or a tuple of names and values"""
+    if isinstance(label, tuple):
+        return ','.join(f'{name}="{part}"' for name, part in zip(label, value))
+    return f'{label}="{value}"'
+
+class Histogram:
+    """Cumulative Prometheus histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series['counts'][position] += 1
+                    break
+            series['sum'] += seconds
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {value: dict(data, counts=list(data['counts'])) for value, data in self._series.items()}
+        for value, data in sorted(series.items()):
+            labels = render_labels(self.label, value)
+            cumulative = 0
+            for bound, count in zip(self.buckets, data['counts']):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {data["count"]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {data["sum"]:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {data["count"]}')
+        return lines
+
+class Counter:
+    """Prometheus counter with one series per label value"""
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for value, count in sorted(values.items()):
+            lines.append(f'{self.name}{{{render_labels(self.label, value)}}} {count}')
+        return lines
+
+stage_seconds = Histogram('stage_duration_seconds', 'Time spent in each pipeline stage', 'stage')
+stage_errors = Counter('stage_errors_total', 'Stage spans that ended with an exception', 'stage')
+http_seconds = Histogram('http_request_duration_seconds', 'Flask request latency by endpoint', 'endpoint')
+
+_timings_lock = threading.Lock()
+
+def observe(stage, seconds):
+    """Record a stage duration measured elsewhere, e.g. in an encode pool process"""
+    stage_seconds.observe(stage, seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        with _timings_lock:
+            total, count = timings.get(stage, (0.0, 0))
+            timings[stage] = (total + seconds, count + 1)
+
+@contextmanager
+def span(stage):
+    """Time a block as one occurrence of stage, tagged with the current request ID"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(stage, elapsed)
+        logger.debug(f"{stage} took {elapsed * 1000:.1f}ms [request {request_id.get() or '-'}]")
+
+def server_timing():
+    """Server-Timing header value summing this request's spans per stage"""
+    timings = request_timings.get() or {}
+    with _timings_lock:
+        items = sorted(timings.items())
+    return ', '.join(f"{stage};dur={total * 1000:.1f};desc=\"{count}x\"" for stage, (total, count) in items)
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format"""
+    from quota import quota_rejected, quota_wait_seconds
+
+    lines = stage_seconds.render() + stage_errors.render() + http_seconds.render()
+    lines += quota_wait_seconds.render() + quota_rejected.render()
+    return '\n'.join(lines) + '\n'
+
+def save_profile(profiler, name):
+    """Write a profile to PROFILE_DIR as <request id>-<name>.prof and log its hot spots"""
+    profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{request_id.get() or 'anonymous'}-{name}.prof")
+    profiler.dump_stats(path)
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+    logger.info(f"Profile of {name} saved to {path}\n{summary.getvalue()}")
+    return path
+
+@contextmanager
+def profiled(name):
+    """cProfile the block when profiling was requested for the originating request"""
+    if not profile_requested.get():
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        save_profile(profiler, name)
+
+def init_app(app):
+    """Assign request IDs, time requests, add Server-Timing and honour the profiling header
+
+    Profiling is opt-in: PROFILE_TOKEN must be set and sent back in X-Profile.
+    Background work started by a profiled request is profiled as well.
+    """
+    from flask import g, request
+
+    profile_token = os.environ.get('PROFILE_TOKEN')
+
+    @app.before_request
+    def start_request():
+        # Every request sets these, so values never leak from one request to the next
+        incoming = request.headers.get('X-Request-ID', '')
+        request_id.set(incoming if REQUEST_ID_RE.match(incoming) else os.urandom(8).hex())
+        request_timings.set({})
+        profile_requested.set(bool(profile_token) and request.headers.get('X-Profile') == profile_token)
+        g.request_started = time.perf_counter()
+        if profile_requested.get():
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def finish_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+
+        profiler = g.pop('profiler', None)
+        if profiler:
+            profiler.disable()
+            response.headers['X-Profile-Path'] = save_profile(profiler, 'request')
+
+        http_seconds.observe(request.endpoint or 'unmatched', time.perf_counter() - started)
+        response.headers['X-Request-ID'] = request_id.get()
+        timing = server_timing()
+        if timing:
+            response.headers['Server-Timing'] = timing
+        return response
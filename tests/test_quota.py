@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from quota import QuotaManager
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setenv('PEXELS_REQUESTS_PER_HOUR', '200')
+    return QuotaManager(path=str(tmp_path / 'quota.db'), batch_reserve=0)
+
+def burst(manager, attempts):
+    """Calls let through back to back, without waiting for a refill"""
+    return sum(manager._take('pexels', manager.limits('pexels'), 0.0) == 0 for _ in range(attempts))
+
+def test_burst_is_the_configured_capacity(manager):
+    assert burst(manager, 1000) == 200
+
+def test_large_provider_quota_does_not_raise_the_burst(manager):
+    # Pexels reports its monthly quota, resetting weeks from now
+    manager.update('pexels', remaining=19990, reset_seconds=25 * 86400)
+    assert burst(manager, 1000) == 200
+    assert manager.metrics()['pexels']['capacity'] == 200
+
+def test_provider_quota_survives_a_new_process(manager):
+    manager.update('pexels', remaining=5, reset_seconds=3600)
+    other = QuotaManager(path=manager.path, batch_reserve=0)
+    assert burst(other, 1000) == 5
+
+def test_exhausted_provider_quota_blocks_until_reset(manager):
+    manager.update('pexels', remaining=0, reset_seconds=3600)
+    assert not manager.acquire('pexels')
+    assert manager.headroom('pexels') == 0.0
+    assert manager._take('pexels', manager.limits('pexels'), 0.0) > 3500
+
+def test_block_lifts_after_reset(manager):
+    manager.update('pexels', remaining=0, reset_seconds=0)
+    # Only the usual refill is left to wait for
+    assert manager._take('pexels', manager.limits('pexels'), 0.0) <= 3600 / 200
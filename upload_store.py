@@ -0,0 +1,303 @@
+"""Processed image files, stored by content hash under the upload directory.
+
+A file's name is the first 128 bits of the SHA-256 of its bytes, sharded two
+levels deep by its first four hex digits (static/uploads/ab/cd/abcd....webp),
+so no directory grows past a few hundred entries even at millions of files and
+identical encodes are stored once. Because a URL always names the same bytes,
+files are served from /uploads/ with a far-future immutable Cache-Control.
+
+collect() reconciles the files with the ProcessedImage rows that reference
+them: unreferenced files (including the flat img_*.webp files written before
+sharding) are deleted once older than a grace period, and when the directory
+is still over its budget, images already uploaded to WordPress are evicted
+before those that are only stored here, least recently used first. The same
+pass trims the Pexels thumbnail cache to its own budget, least recently
+served first.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+URL_PREFIX = '/uploads/'
+LEGACY_URL_PREFIX = '/static/uploads/'
+DIGEST_HEX = 32
+SHARD_RE = re.compile(r'^[0-9a-f]{2}$')
+NAME_RE = re.compile(r'^([0-9a-f]{32})\.[a-z0-9]+$')
+
+def digest_prefix(name):
+    """First 64 bits of a stored file's digest, or None for names outside the sharded layout"""
+    match = NAME_RE.match(name)
+    return int(match.group(1)[:16], 16) if match else None
+
+def contains_sorted(haystack, needles):
+    """Membership of each needle in a sorted array, by binary search"""
+    import numpy as np
+
+    if not len(haystack):
+        return np.zeros(len(needles), dtype=bool)
+    positions = np.minimum(np.searchsorted(haystack, needles), len(haystack) - 1)
+    return haystack[positions] == needles
+
+class UploadStore:
+    """Content-addressed file storage with garbage collection against ProcessedImage"""
+
+    def __init__(self, root='static/uploads', max_bytes=None, grace_seconds=None, gc_interval=None,
+                 thumbnail_max_bytes=None):
+        self.root = root
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+        self.max_bytes = max_bytes
+        if thumbnail_max_bytes is None:
+            thumbnail_max_bytes = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+        self.thumbnail_max_bytes = thumbnail_max_bytes
+        # Files younger than this may belong to an encode that has not been recorded yet
+        self.grace_seconds = grace_seconds if grace_seconds is not None else int(os.environ.get('UPLOAD_GC_GRACE', 3600))
+        self.gc_interval = gc_interval if gc_interval is not None else int(os.environ.get('UPLOAD_GC_INTERVAL', 600))
+        self._collecting = threading.Lock()
+
+    def relative_path(self, digest, extension):
+        return os.path.join(digest[:2], digest[2:4], f"{digest[:DIGEST_HEX]}{extension}")
+
+    def put(self, data, extension='.webp'):
+        """Store bytes under their content hash; returns the file path and URL"""
+        digest = hashlib.sha256(data).hexdigest()
+        relative = self.relative_path(digest, extension)
+        file_path = os.path.join(self.root, relative)
+        if not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            # Write to a temp name first so concurrent readers never see a partial file
+            temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, file_path)
+        return {
+            'file_path': file_path,
+            'url': URL_PREFIX + relative.replace(os.sep, '/')
+        }
+
+    def path_for_url(self, url):
+        """Local file behind a stored image URL, sharded or legacy; None for other URLs"""
+        for prefix in (URL_PREFIX, LEGACY_URL_PREFIX):
+            if url.startswith(prefix):
+                relative = url[len(prefix):]
+                if '..' in relative.split('/'):
+                    return None
+                return os.path.join(self.root, *relative.split('/'))
+        return None
+
+    def _referenced(self):
+        """Digest prefixes of sharded files and names of legacy files that ProcessedImage rows use"""
+        import numpy as np
+        from models import ProcessedImage
+
+        prefixes = []
+        legacy = set()
+        rows = (ProcessedImage.query
+                .with_entities(ProcessedImage.processed_url, ProcessedImage.variants)
+                .yield_per(5000))
+        for processed_url, variants in rows:
+            urls = [processed_url] + [v['url'] for v in json.loads(variants or '[]')]
+            for url in urls:
+                name = url.rsplit('/', 1)[-1]
+                prefix = digest_prefix(name)
+                if prefix is not None:
+                    prefixes.append(prefix)
+                elif url.startswith(LEGACY_URL_PREFIX):
+                    legacy.add(name)
+        return np.unique(np.array(prefixes, dtype=np.uint64)), legacy
+
+    def _remove(self, path):
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def _sweep_shard(self, shard_path, referenced, cutoff, stats):
+        """Delete unreferenced files in one top-level shard; returns bytes still stored there"""
+        import numpy as np
+
+        names, paths, sizes, mtimes = [], [], [], []
+        with os.scandir(shard_path) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir() or not SHARD_RE.match(subdir.name):
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    for entry in entries:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                        names.append(entry.name)
+                        paths.append(entry.path)
+                        sizes.append(stat.st_size)
+                        mtimes.append(stat.st_mtime)
+
+        stats['files'] += len(names)
+        if not names:
+            return 0
+        prefixes = np.array([digest_prefix(name) or 0 for name in names], dtype=np.uint64)
+        valid = np.array([NAME_RE.match(name) is not None for name in names])
+        sizes = np.array(sizes, dtype=np.int64)
+        # Leftover temp files and unreferenced images, once past the grace period
+        orphan = (~valid | ~contains_sorted(referenced, prefixes)) & (np.array(mtimes) < cutoff)
+        for position in np.nonzero(orphan)[0]:
+            stats['orphan_bytes'] += self._remove(paths[position])
+            stats['orphans'] += 1
+        return int(sizes[~orphan].sum())
+
+    def _sweep_legacy(self, legacy, cutoff, stats):
+        """Delete unreferenced files from the flat layout; returns bytes still stored there"""
+        total = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                stats['files'] += 1
+                stat = entry.stat()
+                if entry.name not in legacy and stat.st_mtime < cutoff:
+                    stats['orphan_bytes'] += self._remove(entry.path)
+                    stats['orphans'] += 1
+                else:
+                    total += stat.st_size
+        return total
+
+    def _evict(self, total, stats):
+        """Delete files of the least recently used images until total fits max_bytes"""
+        from app import db
+        from models import MediaFingerprint, ProcessedImage
+
+        recent = datetime.utcnow() - timedelta(seconds=self.grace_seconds)
+        # Identical encodes share a file, so one an older row names may also belong to a recent row
+        keep = set()
+        rows = (ProcessedImage.query
+                .with_entities(ProcessedImage.processed_url, ProcessedImage.variants)
+                .filter(db.or_(ProcessedImage.last_accessed >= recent, ProcessedImage.last_accessed.is_(None)))
+                .yield_per(1000))
+        for processed_url, variants in rows:
+            keep.update(self.path_for_url(url) for url in [processed_url] + [v['url'] for v in json.loads(variants or '[]')])
+
+        published = ProcessedImage.phash.in_(db.select(MediaFingerprint.phash))
+        # Images already in a WordPress media library are only previews here, so they go first
+        passes = [ProcessedImage.query.filter(published), ProcessedImage.query]
+        for query in passes:
+            rows = (query
+                    .with_entities(ProcessedImage.processed_url, ProcessedImage.variants)
+                    .filter(ProcessedImage.last_accessed < recent)
+                    .order_by(ProcessedImage.last_accessed)
+                    .yield_per(1000))
+            for processed_url, variants in rows:
+                if total <= self.max_bytes:
+                    return total
+                urls = {processed_url} | {v['url'] for v in json.loads(variants or '[]')}
+                for url in urls:
+                    path = self.path_for_url(url)
+                    freed = self._remove(path) if path and path not in keep else 0
+                    if freed:
+                        total -= freed
+                        stats['evicted'] += 1
+                        stats['evicted_bytes'] += freed
+        return total
+
+    def _trim_thumbnails(self, cutoff, stats):
+        """Delete the least recently served Pexels thumbnails until they fit thumbnail_max_bytes"""
+        from pexels_client import THUMBNAIL_DIR
+
+        if not os.path.isdir(THUMBNAIL_DIR):
+            return
+        files = []
+        total = 0
+        with os.scandir(THUMBNAIL_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    # Left behind by a download that died before it was renamed
+                    if stat.st_mtime < cutoff:
+                        self._remove(entry.path)
+                    continue
+                # cached_thumbnail touches a file each time it serves it
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(files):
+            if total <= self.thumbnail_max_bytes:
+                break
+            freed = self._remove(path)
+            total -= freed
+            stats['thumbnails_evicted'] += 1
+            stats['thumbnail_evicted_bytes'] += freed
+        stats['thumbnail_bytes'] = total
+
+    def collect(self):
+        """Delete orphaned files, then evict images until the store fits its budget
+
+        Needs an app context. Returns counts of files scanned and deleted.
+        """
+        start = time.perf_counter()
+        stats = {'files': 0, 'orphans': 0, 'orphan_bytes': 0, 'evicted': 0, 'evicted_bytes': 0,
+                 'thumbnails_evicted': 0, 'thumbnail_evicted_bytes': 0, 'thumbnail_bytes': 0}
+        cutoff = time.time() - self.grace_seconds
+        self._trim_thumbnails(cutoff, stats)
+        if not os.path.isdir(self.root):
+            return dict(stats, total_bytes=0, seconds=0.0)
+
+        referenced, legacy = self._referenced()
+
+        total = self._sweep_legacy(legacy, cutoff, stats)
+        with os.scandir(self.root) as shards:
+            for shard in shards:
+                if shard.is_dir() and SHARD_RE.match(shard.name):
+                    total += self._sweep_shard(shard.path, referenced, cutoff, stats)
+
+        if total > self.max_bytes:
+            total = self._evict(total, stats)
+
+        stats['total_bytes'] = total
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        logger.info(f"Upload GC: {stats['files']} files, removed {stats['orphans']} orphans "
+                    f"and evicted {stats['evicted']} files, {total} bytes stored; "
+                    f"evicted {stats['thumbnails_evicted']} thumbnails, {stats['thumbnail_bytes']} bytes stored")
+        return stats
+
+    def collect_if_due(self, app):
+        """Start a background collection when none has run in any process for gc_interval seconds"""
+        marker = os.path.join(self.root, '.gc')
+        try:
+            if time.time() - os.stat(marker).st_mtime < self.gc_interval:
+                return False
+        except FileNotFoundError:
+            pass
+        if not self._collecting.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                with open(marker, 'a') as lock:
+                    # Only one process collects at a time; the others skip this round
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return
+                    os.utime(marker)
+                    with app.app_context():
+                        self.collect()
+            except Exception as e:
+                logger.error(f"Upload GC failed: {e}")
+            finally:
+                self._collecting.release()
+
+        threading.Thread(target=run, name="upload-gc", daemon=True).start()
+        return True
+
+upload_store = UploadStore()
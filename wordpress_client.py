@@ -1,10 +1,20 @@
-import requests
+from http_transport import transport
+from telemetry import span
+from quota import quota
 import logging
+import os
+import gzip
 from base64 import b64encode
 import json
 
 logger = logging.getLogger(__name__)
 
+# Smallest JSON body worth compressing
+GZIP_MIN_BYTES = 1024
+
+# Whether each site decodes gzip request bodies, learned from its responses (RFC 7694)
+request_gzip = {}
+
 class WordPressClient:
     def __init__(self, site_url, username, app_password):
         self.site_url = site_url.rstrip('/')
@@ -20,13 +30,20 @@ class WordPressClient:
             'Content-Type': 'application/json'
         }
     
+    def admitted(self, action):
+        """Whether the site's shared request budget allows another call"""
+        if quota.acquire('wordpress', scope=self.site_url):
+            return True
+        logger.warning(f"Request budget for {self.site_url} exhausted, skipping {action}")
+        return False
+    
     def test_connection(self):
         """Test WordPress connection"""
         try:
-            response = requests.get(f"{self.api_base}/posts", 
-                                  headers=self.headers, 
-                                  params={'per_page': 1},
-                                  timeout=10)
+            response = transport.get(f"{self.api_base}/posts", 
+                                   headers=self.headers, 
+                                   params={'per_page': 1},
+                                   timeout=10)
             return response.status_code == 200
         except Exception as e:
             logger.error(f"Connection test failed: {e}")
@@ -47,10 +64,13 @@ class WordPressClient:
             else:
                 params['status'] = 'publish,draft'
             
-            response = requests.get(f"{self.api_base}/posts", 
-                                  headers=self.headers, 
-                                  params=params,
-                                  timeout=15)
+            if not self.admitted('listing posts'):
+                return None
+            
+            response = transport.get(f"{self.api_base}/posts", 
+                                   headers=self.headers, 
+                                   params=params,
+                                   timeout=15)
             
             if response.status_code == 200:
                 posts = response.json()
@@ -77,24 +97,36 @@ class WordPressClient:
             else:
                 logger.error(f"Failed to fetch posts: {response.status_code} - {response.text}")
                 return None
-                
+        
         except Exception as e:
             logger.error(f"Error fetching posts: {e}")
             return None
     
-    def get_post(self, post_id):
-        """Get single blog post"""
+    def get_post(self, post_id, raw=False):
+        """Get single blog post
+        
+        With raw, content is the stored markup (context=edit), with block comments
+        and shortcodes intact, which is what must be sent back when updating it.
+        """
         try:
-            response = requests.get(f"{self.api_base}/posts/{post_id}", 
-                                  headers=self.headers,
-                                  timeout=10)
+            if not self.admitted(f"fetching post {post_id}"):
+                return None
+            
+            response = transport.get(f"{self.api_base}/posts/{post_id}", 
+                                   headers=self.headers,
+                                   params={'context': 'edit'} if raw else None,
+                                   timeout=10)
             
             if response.status_code == 200:
                 post = response.json()
+                content = post['content'].get('raw' if raw else 'rendered')
+                if content is None:
+                    logger.error(f"Post {post_id} has no raw content; the user may lack edit rights")
+                    return None
                 return {
                     'id': post['id'],
                     'title': post['title']['rendered'],
-                    'content': post['content']['rendered'],
+                    'content': content,
                     'status': post['status'],
                     'date': post['date'],
                     'modified': post['modified'],
@@ -103,49 +135,237 @@ class WordPressClient:
             else:
                 logger.error(f"Failed to fetch post: {response.status_code}")
                 return None
-                
+        
         except Exception as e:
             logger.error(f"Error fetching post: {e}")
             return None
     
-    def update_post(self, post_id, content, featured_image_id=None):
-        """Update blog post"""
+    def list_posts(self, modified_after=None, page=1, per_page=100):
+        """Get a page of post summaries in every status, oldest modification first, for syncing"""
         try:
-            data = {
-                'content': content,
-                'status': 'draft'
+            params = {
+                'page': page,
+                'per_page': per_page,
+                'status': 'publish,draft,pending,private,future',
+                'orderby': 'modified',
+                'order': 'asc',
+                '_fields': 'id,title,excerpt,status,date,modified,link,featured_media'
             }
             
+            if modified_after:
+                params['modified_after'] = modified_after
+            
+            if not self.admitted('syncing posts'):
+                return None
+            
+            response = transport.get(f"{self.api_base}/posts", 
+                                   headers=self.headers, 
+                                   params=params,
+                                   timeout=15)
+            
+            if response.status_code == 200:
+                posts = []
+                for post in response.json():
+                    posts.append({
+                        'id': post['id'],
+                        'title': post['title']['rendered'],
+                        'excerpt': post['excerpt']['rendered'],
+                        'status': post['status'],
+                        'date': post['date'],
+                        'modified': post['modified'],
+                        'link': post['link'],
+                        'featured_media': post.get('featured_media', 0)
+                    })
+                
+                return {
+                    'posts': posts,
+                    'total': int(response.headers.get('X-WP-Total', len(posts))),
+                    'total_pages': int(response.headers.get('X-WP-TotalPages', 1))
+                }
+            else:
+                logger.error(f"Failed to list posts: {response.status_code} - {response.text}")
+                return None
+        
+        except Exception as e:
+            logger.error(f"Error listing posts: {e}")
+            return None
+    
+    def get_post_revalidated(self, post_id, etag=None):
+        """Get a post unless it still matches etag
+        
+        Returns (post, etag, not_modified); post is None on errors and when not modified.
+        """
+        try:
+            headers = dict(self.headers)
+            if etag:
+                headers['If-None-Match'] = etag
+            
+            if not self.admitted(f"fetching post {post_id}"):
+                return None, None, False
+            
+            response = transport.get(f"{self.api_base}/posts/{post_id}", 
+                                   headers=headers,
+                                   timeout=10)
+            self.note_request_encodings(response)
+            
+            if response.status_code == 304:
+                return None, etag, True
+            
+            if response.status_code == 200:
+                post = response.json()
+                return {
+                    'id': post['id'],
+                    'title': post['title']['rendered'],
+                    'excerpt': post['excerpt']['rendered'],
+                    'content': post['content']['rendered'],
+                    'status': post['status'],
+                    'date': post['date'],
+                    'modified': post['modified'],
+                    'link': post['link'],
+                    'featured_media': post.get('featured_media', 0)
+                }, response.headers.get('ETag'), False
+            else:
+                logger.error(f"Failed to fetch post: {response.status_code}")
+                return None, None, False
+        
+        except Exception as e:
+            logger.error(f"Error fetching post: {e}")
+            return None, None, False
+    
+    def gzip_requests(self):
+        """Whether to gzip request bodies: WP_GZIP_REQUESTS is auto, always or never"""
+        mode = os.environ.get('WP_GZIP_REQUESTS', 'auto')
+        if mode == 'auto':
+            return request_gzip.get(self.site_url, False)
+        return mode == 'always'
+    
+    def note_request_encodings(self, response):
+        """Remember whether the site advertises gzip in Accept-Encoding on its responses"""
+        accepted = response.headers.get('Accept-Encoding')
+        if accepted is not None:
+            request_gzip[self.site_url] = 'gzip' in accepted.lower()
+    
+    def update_post(self, post_id, content=None, featured_image_id=None, status=None):
+        """Update blog post, leaving its status alone unless one is given
+        
+        Returns the updated post's id, content and modified timestamp, or None.
+        """
+        try:
+            data = {}
+            if content is not None:
+                data['content'] = content
+            if status:
+                data['status'] = status
             if featured_image_id:
                 data['featured_media'] = featured_image_id
             
-            response = requests.post(f"{self.api_base}/posts/{post_id}", 
-                                   headers=self.headers,
-                                   json=data,
-                                   timeout=15)
+            body = json.dumps(data).encode()
+            headers = dict(self.headers)
+            compressed = self.gzip_requests() and len(body) >= GZIP_MIN_BYTES
+            if compressed:
+                headers['Content-Encoding'] = 'gzip'
             
-            return response.status_code == 200
+            if not self.admitted(f"updating post {post_id}"):
+                return None
             
+            with span('wp_update_post'):
+                response = transport.post(f"{self.api_base}/posts/{post_id}", 
+                                        headers=headers,
+                                        data=gzip.compress(body) if compressed else body,
+                                        timeout=15)
+                self.note_request_encodings(response)
+                
+                if compressed and response.status_code in (400, 415):
+                    # The site did not decode the compressed body; send it plain
+                    del headers['Content-Encoding']
+                    response = transport.post(f"{self.api_base}/posts/{post_id}", 
+                                            headers=headers,
+                                            data=body,
+                                            timeout=15)
+                    if response.status_code == 200:
+                        logger.info(f"{self.site_url} does not accept gzip request bodies")
+                        request_gzip[self.site_url] = False
+            
+            if response.status_code == 200:
+                post = response.json()
+                return {
+                    'id': post['id'],
+                    'content': post['content']['rendered'],
+                    'modified': post['modified']
+                }
+            else:
+                logger.error(f"Failed to update post: {response.status_code}")
+                return None
+        
         except Exception as e:
             logger.error(f"Error updating post: {e}")
+            return None
+    
+    def media_exists(self, media_id):
+        """Whether an attachment is still in the media library, or None when that cannot be told"""
+        try:
+            if not self.admitted(f"checking media {media_id}"):
+                return None
+            
+            with span('wp_media_check'):
+                response = transport.get(f"{self.api_base}/media/{media_id}", 
+                                       headers=self.headers,
+                                       params={'_fields': 'id'},
+                                       timeout=10)
+            
+            if response.status_code == 200:
+                return True
+            if response.status_code in (404, 410):
+                return False
+            logger.warning(f"Could not check media {media_id}: {response.status_code}")
+            return None
+        
+        except Exception as e:
+            logger.error(f"Error checking media {media_id}: {e}")
+            return None
+    
+    def delete_media(self, media_id):
+        """Delete an attachment and its files for good; returns whether it is gone"""
+        try:
+            if not self.admitted(f"deleting media {media_id}"):
+                return False
+            
+            # Attachments cannot be trashed, so force is required
+            response = transport.delete(f"{self.api_base}/media/{media_id}", 
+                                      headers=self.headers,
+                                      params={'force': 'true'},
+                                      timeout=15)
+            
+            if response.status_code in (200, 404, 410):
+                return True
+            logger.warning(f"Could not delete media {media_id}: {response.status_code}")
+            return False
+        
+        except Exception as e:
+            logger.error(f"Error deleting media {media_id}: {e}")
             return False
     
-    def upload_media(self, file_path, filename):
+    def upload_media(self, file_path, filename, mime_type='image/webp'):
         """Upload media file to WordPress"""
         try:
+            if not self.admitted(f"uploading {filename}"):
+                return None
+            
             with open(file_path, 'rb') as f:
+                # Send bytes rather than the file object so a retried request has a body
                 files = {
-                    'file': (filename, f, 'image/webp')
+                    'file': (filename, f.read(), mime_type)
                 }
                 
                 headers = {
                     'Authorization': self.headers['Authorization']
                 }
                 
-                response = requests.post(f"{self.api_base}/media", 
-                                       headers=headers,
-                                       files=files,
-                                       timeout=30)
+                with span('wp_media_upload'):
+                    response = transport.post(f"{self.api_base}/media", 
+                                            headers=headers,
+                                            files=files,
+                                            timeout=30)
                 
                 if response.status_code == 201:
                     media = response.json()
@@ -156,7 +376,7 @@ class WordPressClient:
                 else:
                     logger.error(f"Failed to upload media: {response.status_code}")
                     return None
-                    
+        
         except Exception as e:
             logger.error(f"Error uploading media: {e}")
             return None